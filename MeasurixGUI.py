@@ -2,23 +2,14 @@ import os
 import re
 import time
 import multiprocessing
-from multiprocessing.queues import Queue
-import sys
 import numpy as np
 
-from readRecipe import MeasurixRecipe
-from writeLog import logPrintMessages
-
-
-class StdOutQueue(Queue):
-    def __init__(self, *args, **kwargs):
-        Queue.__init__(self, *args, **kwargs)
-
-    def write(self, msg):
-        self.put(msg)
-
-    def flush(self):
-        sys.__stdout__.flush()
+import logChannel
+import metrics
+import recipeCatalog
+import recipeValidator
+from readRecipe import MeasurixRecipe, findUnknowns
+from writeLog import logPrintMessages, openLogFile, closeLogFiles
 
 
 class MeasurixGUI(object):
@@ -31,8 +22,11 @@ class MeasurixGUI(object):
         self.recipeFolder = self.systemState["recipeFolder"]
         self.outputDirRoot = self.systemState["outputDir"]
         self.logFile = self.systemState["logFile"]
+        self.eventLogDir = self.systemState.get("eventLogDir", None)
 
-        self.recipeList = dict()
+        self.recipeCatalog = None
+        self.recipeFolderPollInterval = 2.0  # [s] only used when the recipe folder can't be watched
+        self.checkAllProcess = None
 
         self.time0 = None
         self.plots = dict()
@@ -40,9 +34,12 @@ class MeasurixGUI(object):
         self.axesAvailable = None
         self.timeResolution = 0.5  # [s]
         self.maxTimePlot = 1000.0  # [s] In the real time plots, we see data going back to 1000 seconds in the past
-
-        self.stdOut = StdOutQueue()
-        sys.stdout = self.stdOut
+        self.metricsRefreshInterval = 1.0  # [s]
+        self.metricsStore = None
+        self.previousMetrics = None
+        self.jobQueue = MeasurixProgram.jobQueue
+        self.jobsStore = None
+        self.jobsRefreshInterval = 2.0  # [s]
 
         self.logWindow = None
         self.scrolledWindow = None
@@ -113,10 +110,23 @@ class MeasurixGUI(object):
         self.win.add(vbox1)
         self.win.show_all()
 
-        self._getRecipeListFromLocalFolder()
+        self.recipeCatalog = recipeCatalog.recipeCatalog(self.recipeFolder,
+                                                         recipeCatalog.catalogIndexFile(self.systemState))
+
+        if self.recipeCatalog.fileno() is not None:
+            self.GObject.io_add_watch(self.recipeCatalog.fileno(), self.GObject.IO_IN, self._onRecipeFolderChanged)
+        else:
+            self.GObject.timeout_add(int(self.recipeFolderPollInterval * 1E3), self._onRecipeFolderChanged)
 
+        self._fillRecipeList()
+
+        self.logWriter = openLogFile(self.logFile,
+                                     maxFileSizeInMB=self.systemState.get("logFileMaxSizeInMB", 10.0),
+                                     flushIntervalInS=self.systemState.get("logFileFlushIntervalInS", 1.0))
+
+        self.GObject.timeout_add(int(self.logWriter.flushIntervalInS * 1E3), self._flushLogFile)
         self.GObject.io_add_watch(self.childConnection, self.GObject.IO_IN, self._handleMessagesFromPublicInterface)
-        self.GObject.io_add_watch(self.stdOut._reader.fileno(), self.GObject.IO_IN | self.GObject.IO_HUP, self._print)
+        self.GObject.io_add_watch(logChannel.channel.fileno(), self.GObject.IO_IN | self.GObject.IO_HUP, self._print)
 
         self.Gtk.main()
 
@@ -175,6 +185,12 @@ class MeasurixGUI(object):
 
         labelRecipe = self.Gtk.Label("Please select recipe", xalign=0)
         self.comboRecipe = self.Gtk.ComboBoxText()
+        self.comboRecipe.connect("changed", self._onRecipeSelected)
+        self.comboVersion = self.Gtk.ComboBoxText()
+
+        hboxRecipe = self.Gtk.Box(orientation=self.Gtk.Orientation.HORIZONTAL, spacing=1)
+        hboxRecipe.pack_start(self.comboRecipe, True, True, 0)
+        hboxRecipe.pack_start(self.comboVersion, False, True, 0)
 
         executeButton = self.Gtk.Button(label="execute")
         executeButton.connect("clicked", self._onExecuteButtonClick)
@@ -188,16 +204,28 @@ class MeasurixGUI(object):
         checkRecipeButton = self.Gtk.Button(label="check recipe")
         checkRecipeButton.connect("clicked", self._onCheckRecipeButtonClick)
 
+        checkAllButton = self.Gtk.Button(label="check all recipes")
+        checkAllButton.connect("clicked", self._onCheckAllButtonClick)
+
         regenerateReportButton = self.Gtk.Button(label="regenerate a measurement report")
         regenerateReportButton.connect("clicked", self._onRegenerateReportButtonClick)
 
         refreshRecipeListButton = self.Gtk.Button(label="refresh recipe list")
         refreshRecipeListButton.connect("clicked", self._onRefreshRecipeListButtonClick)
 
+        addToQueueButton = self.Gtk.Button(label="add to queue")
+        addToQueueButton.connect("clicked", self._onAddToQueueButtonClick)
+
+        runQueueButton = self.Gtk.Button(label="run queue")
+        runQueueButton.connect("clicked", self._onRunQueueButtonClick)
+
+        pauseQueueButton = self.Gtk.Button(label="pause queue")
+        pauseQueueButton.connect("clicked", self._onPauseQueueButtonClick)
+
         grid.attach(labelSoftwareVersion, 0, 0, 2, 1)
 
         grid.attach_next_to(labelRecipe, labelSoftwareVersion, self.Gtk.PositionType.BOTTOM, 1, 1)
-        grid.attach_next_to(self.comboRecipe, labelRecipe, self.Gtk.PositionType.BOTTOM, 1, 1)
+        grid.attach_next_to(hboxRecipe, labelRecipe, self.Gtk.PositionType.BOTTOM, 1, 1)
 
         hboxButtons = self.Gtk.Box(orientation=self.Gtk.Orientation.HORIZONTAL, spacing=1)
 
@@ -205,10 +233,11 @@ class MeasurixGUI(object):
         hboxButtons.pack_start(quitButton, True, True, 0)
         hboxButtons.pack_start(abortButton, True, True, 0)
 
-        grid.attach_next_to(hboxButtons, self.comboRecipe, self.Gtk.PositionType.BOTTOM, 1, 1)
+        grid.attach_next_to(hboxButtons, hboxRecipe, self.Gtk.PositionType.BOTTOM, 1, 1)
 
         hboxButtons2 = self.Gtk.Box(orientation=self.Gtk.Orientation.HORIZONTAL, spacing=1)
         hboxButtons2.pack_start(checkRecipeButton, True, True, 0)
+        hboxButtons2.pack_start(checkAllButton, True, True, 0)
         hboxButtons2.pack_start(refreshRecipeListButton, True, True, 0)
 
         grid.attach_next_to(hboxButtons2, hboxButtons, self.Gtk.PositionType.BOTTOM, 1, 1)
@@ -217,8 +246,99 @@ class MeasurixGUI(object):
         hboxButtons3.pack_start(regenerateReportButton, True, True, 0)
         grid.attach_next_to(hboxButtons3, hboxButtons2, self.Gtk.PositionType.BOTTOM, 1, 1)
 
+        hboxButtons4 = self.Gtk.Box(orientation=self.Gtk.Orientation.HORIZONTAL, spacing=1)
+        hboxButtons4.pack_start(addToQueueButton, True, True, 0)
+        hboxButtons4.pack_start(runQueueButton, True, True, 0)
+        hboxButtons4.pack_start(pauseQueueButton, True, True, 0)
+        grid.attach_next_to(hboxButtons4, hboxButtons3, self.Gtk.PositionType.BOTTOM, 1, 1)
+
+        jobsPanel = self._makeJobsPanel()
+        grid.attach_next_to(jobsPanel, hboxButtons4, self.Gtk.PositionType.BOTTOM, 1, 1)
+
+        if metrics.isEnabled():
+            grid.attach_next_to(self._makeMetricsPanel(), jobsPanel, self.Gtk.PositionType.BOTTOM, 1, 1)
+
         return grid
 
+    def _makeJobsPanel(self):
+
+        columns = ["job", "status", "recipe", "started", "duration [s]"]
+
+        self.jobsStore = self.Gtk.ListStore(*([str] * len(columns)))
+        treeView = self.Gtk.TreeView(model=self.jobsStore)
+
+        for count, title in enumerate(columns):
+            treeView.append_column(self.Gtk.TreeViewColumn(title, self.Gtk.CellRendererText(), text=count))
+
+        sw = self.Gtk.ScrolledWindow()
+        sw.set_min_content_height(150)
+        sw.set_shadow_type(self.Gtk.ShadowType.ETCHED_IN)
+        sw.add(treeView)
+
+        self._updateJobsPanel()
+        self.GObject.timeout_add(int(self.jobsRefreshInterval * 1E3), self._updateJobsPanel)
+
+        return sw
+
+    def _updateJobsPanel(self):
+
+        # The queue file is shared with the program and the command line, so read it instead of keeping a copy
+        self.jobsStore.clear()
+
+        for job in self.jobQueue.jobs():
+
+            started = time.strftime("%H:%M:%S", time.localtime(job["timeStarted"])) if job["timeStarted"] else ""
+            duration = "%.0f" % job["durationInS"] if job["durationInS"] is not None else ""
+
+            self.jobsStore.append([str(job["id"]), job["status"], os.path.basename(job["recipe"]), started, duration])
+
+        return True  # keep the time out call back alive
+
+    def _makeMetricsPanel(self):
+
+        columns = ["metric", "kind", "last", "rate [1/s]", "mean", "p99"]
+
+        self.metricsStore = self.Gtk.ListStore(*([str] * len(columns)))
+        treeView = self.Gtk.TreeView(model=self.metricsStore)
+
+        for count, title in enumerate(columns):
+            treeView.append_column(self.Gtk.TreeViewColumn(title, self.Gtk.CellRendererText(), text=count))
+
+        sw = self.Gtk.ScrolledWindow()
+        sw.set_min_content_height(200)
+        sw.set_shadow_type(self.Gtk.ShadowType.ETCHED_IN)
+        sw.add(treeView)
+
+        self.GObject.timeout_add(int(self.metricsRefreshInterval * 1E3), self._updateMetricsPanel)
+
+        return sw
+
+    def _updateMetricsPanel(self):
+
+        # The metrics live in shared memory, reading them does not involve the processes reporting them
+        tNow = time.time()
+        snapshot = metrics.snapshot()
+
+        self.metricsStore.clear()
+
+        for name in sorted(snapshot.keys()):
+
+            entry = snapshot[name]
+            rate = ""
+
+            if self.previousMetrics and name in self.previousMetrics[1]:
+                tPrevious, previousSnapshot = self.previousMetrics
+                key = "sum" if entry["kind"] == "counter" else "count"
+                rate = "%.4g" % ((entry[key] - previousSnapshot[name][key]) / (tNow - tPrevious))
+
+            self.metricsStore.append([name, entry["kind"], "%.4g" % entry["last"], rate,
+                                      "%.4g" % entry["mean"] if "mean" in entry else "",
+                                      "%.4g" % entry["p99"] if "p99" in entry else ""])
+
+        self.previousMetrics = (tNow, snapshot)
+
+        return True  # keep the time out call back alive
+
     def removeGraphicFromRealTimePlot(self, plotName):
 
         for count, (axis, available) in enumerate(self.axesAvailable):
@@ -359,34 +479,38 @@ class MeasurixGUI(object):
 
         return sw
 
-    def _getRecipeListFromLocalFolder(self):
+    def _fillRecipeList(self):
 
-        listOfFiles = os.listdir(self.recipeFolder)
-        recipeNamePattern = "measurixRecipe_(.*)-|_(v\d*-\d*).zip"
-        self.recipeList = dict()
+        selected = self.comboRecipe.get_active_text()
+        self.comboRecipe.remove_all()
 
-        for fileName in listOfFiles:
+        for count, name in enumerate(self.recipeCatalog.names()):
 
-            m = re.search(recipeNamePattern, fileName)
+            self.comboRecipe.insert(count, str(count), name)
 
-            if not m:
-                continue
+            if name == selected:
+                self.comboRecipe.set_active(count)
 
-            key = m.groups()[0]
-            versionInfo = m.groups()[1]
+    def _onRecipeSelected(self, widget):
 
-            if key in self.recipeList.keys():
-                print "detected two recipes with same name but different revisions: %s, %s" % (
-                fileName, self.recipeList[key])
-                print "using recipe %s" % self.recipeList[key]
-                continue
+        # The latest version is used unless the operator picks a version
+        self.comboVersion.remove_all()
+        self.comboVersion.insert(0, "latest", "latest")
 
-            self.recipeList[m.groups()[0]] = {"file": fileName, "version": versionInfo}
+        name = self.comboRecipe.get_active_text()
 
-        self.comboRecipe.remove_all()
+        if name:
+            for count, (version, fileName) in enumerate(reversed(self.recipeCatalog.versions(name))):
+                self.comboVersion.insert(count + 1, version, version)
+
+        self.comboVersion.set_active(0)
+
+    def _onRecipeFolderChanged(self, *args):
 
-        for count, item in enumerate(self.recipeList.keys()):
-            self.comboRecipe.insert(count, str(count), item)
+        if self.recipeCatalog.update():
+            self._fillRecipeList()
+
+        return True  # keep the call back alive
 
     def _addPlot(self, plotData, requesterPid):
 
@@ -395,28 +519,28 @@ class MeasurixGUI(object):
             numberOfPlotsAvailable = sum(v[1] for v in self.axesAvailable)
 
             if numberOfPlotsAvailable == 0:
-                print "error: Can't add additional plot, maximum received"
+                logChannel.error("Can't add additional plot, maximum received")
                 return
 
             if "xDataSource" in plotData[plotDataKey].keys():
                 try:
                     eval(plotData[plotDataKey]["xDataSource"])
                 except KeyError:
-                    print "error: Plot command %s is erroneous" % plotData[plotDataKey]
+                    logChannel.error("Plot command %s is erroneous", plotData[plotDataKey])
                     return
 
             if "yDataSource" in plotData[plotDataKey].keys():
                 try:
                     eval(plotData[plotDataKey]["yDataSource"])
                 except KeyError:
-                    print "error: Plot command %s is erroneous" % plotData[plotDataKey]
+                    logChannel.error("Plot command %s is erroneous", plotData[plotDataKey])
                     return
 
             if "imageDataSource" in plotData[plotDataKey].keys():
                 try:
                     eval(plotData[plotDataKey]["imageDataSource"])
                 except KeyError:
-                    print "Plot command %s is erroneous" % plotData[plotDataKey]
+                    logChannel.error("Plot command %s is erroneous", plotData[plotDataKey])
                     return
 
             newAxis = None
@@ -447,19 +571,31 @@ class MeasurixGUI(object):
 
     def _print(self, stream, condition):
 
-        while self.stdOut.qsize():
-            data = self.stdOut.get()
-            data = data.strip()
-            if data != "":
-                self._addLogLine(data)
-                logPrintMessages(data, self.systemState["logFile"])
+        # Every process logs through the log channel, which hands us the records in batches
+        records = [record for record in logChannel.drain() if record["message"].strip() != ""]
+
+        if records:
+            self._addLogLines(["%s: %s" % (record["level"], record["message"].strip()) for record in records])
+            logPrintMessages(records, self.logFile, self.eventLogDir)
 
         return True
 
+    def _flushLogFile(self):
+
+        self.logWriter.flushIfDue()
+
+        return True  # keep the time out call back alive
+
     def _addLogLine(self, logTxt):
+        self._addLogLines([logTxt])
+
+    def _addLogLines(self, logLines):
 
         text = self.logWindow.get_text()
-        text += "{timeStamp}: {logTxt}\n".format(timeStamp=time.strftime("%Y%m%d-%H%M%S"), logTxt=logTxt)
+        timeStamp = time.strftime("%Y%m%d-%H%M%S")
+
+        for logTxt in logLines:
+            text += "{timeStamp}: {logTxt}\n".format(timeStamp=timeStamp, logTxt=logTxt)
 
         text = text.replace("info", "<span color=\"green\">info</span>")
         text = text.replace("warning", "<span color=\"orange\">warning</span>")
@@ -473,9 +609,9 @@ class MeasurixGUI(object):
 
     def _getUnknowns(self, string):
 
-        regex = ur"{(.+?)}+?"  # for example, if outputDir = /home/{object type}/{serial number}/RGA/
+        # for example, if outputDir = /home/{object type}/{serial number}/RGA/
         # then the parts within the curly brackets are unknown. Ask the user to give these as input
-        unknowns = re.findall(regex, string)
+        unknowns = findUnknowns(string)
 
         if not len(unknowns):
             return "no unknowns"
@@ -488,71 +624,97 @@ class MeasurixGUI(object):
 
         return answers
 
-    def _fillInAnswers(self, string, answers):
+    def _getSelectedRecipe(self):
+
+        recipeSelected = self.comboRecipe.get_active_text()
 
-        regex = ur"{(.+?)}+?"
-        unknowns = re.findall(regex, string)
+        if not recipeSelected:
+            logChannel.error("no recipe selected")
+            return None, None
 
-        for unknown in unknowns:
+        version = self.comboVersion.get_active_text()
+        recipeFileName = self.recipeCatalog.get(recipeSelected, None if version in [None, "latest"] else version)
 
-            if ";" in unknown:
-                unknownNew = unknown.split(";")[0]  # e.g. if unknown = "object type; PL, PLWPPF",
-                #  make into "object type"
-                string = string.replace("{" + unknown + "}", "{" + unknownNew + "}")
+        if recipeFileName is None:
+            logChannel.error("recipe %s version %s not found", recipeSelected, version)
+            return None, None
 
-        return string.format(**answers)
+        return recipeSelected, recipeFileName
 
     def _onExecuteButtonClick(self, widget):
 
-        tree_iter = self.comboRecipe.get_active_iter()
+        recipeSelected, recipeFileName = self._getSelectedRecipe()
 
-        if tree_iter:
-            model = self.comboRecipe.get_model()
-            recipeSelected = model[tree_iter][0]
-        else:
-            print "error: no recipe selected"
+        if not recipeFileName:
             return
 
-        recipeFileBaseName = self.recipeList[recipeSelected]["file"]
-        recipeVersion = self.recipeList[recipeSelected]["version"]
-        recipeFileName = os.path.join(self.recipeFolder, recipeFileBaseName)
-
-        print "info: starting recipe %s, version %s" % (recipeSelected, recipeVersion)
+        logChannel.info("starting recipe %s, version %s", recipeSelected,
+                        self.recipeCatalog.entry(recipeFileName)["version"])
         self._sendExecuteMessage(recipeFileName)
 
-    def _sendExecuteMessage(self, recipeFileName):
+    def _prepareRecipe(self, recipeFileName):
 
+        # Ask the user for the unknowns in the output directory. Returns the recipe and the answers, or None, None
         recipe = MeasurixRecipe(recipeFileName, self.systemState)
 
         if recipe.init != "OK":
-            print recipe.init
-            return
+            logChannel.error(recipe.init)
+            return None, None
 
         if not "outputDir" in recipe.recipeInfo.keys():
-            print "error: no output directory given in recipe information file!"
-            return
+            logChannel.error("no output directory given in recipe information file!")
+            return None, None
 
         outputDir = recipe.recipeInfo["outputDir"]
         answers = self._getUnknowns(outputDir)
 
         if not answers:
-            print "error: did not get any answers. Can't run recipe"
-            return
+            logChannel.error("did not get any answers. Can't run recipe")
+            return None, None
+
+        answers = answers if answers != "no unknowns" else dict()
+        result = recipe.prepareForExecution(answers)
 
-        if answers != "no unknowns":
-            outputDir = self._fillInAnswers(outputDir, answers)
-            recipe.setOutputDirectory(outputDir)
-            recipe.addInfoToRecipe(answers)
+        if result != "OK":
+            logChannel.error(result)
+            return None, None
 
-        recipe.addInfoToRecipe({"recipeFileName": recipeFileName})
+        return recipe, answers
 
-        if "time stamp" not in recipe.recipeInfo.keys():
-            recipe.addInfoToRecipe({"time stamp": time.strftime("%Y%m%d-%H%M%S")})
+    def _sendExecuteMessage(self, recipeFileName):
 
-        msg = {"type": "execute", "recipe": recipe}
+        recipe, answers = self._prepareRecipe(recipeFileName)
+
+        if recipe is None:
+            return
+
+        # Only the file name goes to the program, which reads the recipe again. The inputs of the recipe are not
+        # loaded here at all
+        msg = {"type": "execute", "recipeFileName": recipeFileName, "answers": answers}
 
         self._sendSignal(msg)
 
+    def _onAddToQueueButtonClick(self, widget):
+
+        recipeSelected, recipeFileName = self._getSelectedRecipe()
+
+        if not recipeFileName:
+            return
+
+        recipe, answers = self._prepareRecipe(recipeFileName)
+
+        if recipe is None:
+            return
+
+        # The recipe itself is read again when the job starts, so the time stamp is that of the run
+        self._sendSignal({"type": "queueAdd", "recipeFileName": recipeFileName, "answers": answers})
+
+    def _onRunQueueButtonClick(self, widget):
+        self._sendSignal({"type": "queueRun"})
+
+    def _onPauseQueueButtonClick(self, widget):
+        self._sendSignal({"type": "queuePause"})
+
     def _onQuitButtonClick(self, widget):
         self._onDeleteEvent(widget)
 
@@ -582,21 +744,63 @@ class MeasurixGUI(object):
             return
 
         if not os.path.exists(recipeFileName):
-            print "error: file does not exist"
+            logChannel.error("file does not exist")
             return
 
         if os.path.isdir(recipeFileName):
             return
 
-        recipe = MeasurixRecipe(recipeFileName, self.systemState)
-        print "info: checking recipe %s" % recipeFileName
+        logChannel.info("checking recipe %s", recipeFileName)
 
-        self._sendSignal({"type": "check", "recipe": recipe})
+        self._sendSignal({"type": "check", "recipeFileName": recipeFileName})
 
         return
 
+    def _onCheckAllButtonClick(self, widget):
+
+        # Check every recipe in the recipe folder without the hardware, in the background
+        if self.checkAllProcess is not None:
+            logChannel.error("already checking all recipes")
+            return
+
+        recipeFileNames = self.recipeCatalog.fileNames()
+        logChannel.info("checking %i recipes", len(recipeFileNames))
+
+        receiveConnection, sendConnection = multiprocessing.Pipe(duplex=False)
+        self.checkAllProcess = multiprocessing.Process(target=recipeValidator.checkAll,
+                                                       args=(recipeFileNames, dict(self.systemState),
+                                                             sendConnection))
+        self.checkAllProcess.start()
+        sendConnection.close()
+
+        self.GObject.io_add_watch(receiveConnection, self.GObject.IO_IN | self.GObject.IO_HUP, self._onCheckAllDone)
+
+    def _onCheckAllDone(self, stream, condition):
+
+        try:
+            msg = stream.recv()
+        except EOFError:
+            msg = {"results": [], "timeInS": None}
+
+        stream.close()
+        self.checkAllProcess.join()
+        self.checkAllProcess = None
+
+        for result in msg["results"]:
+
+            self.recipeCatalog.setValidation(result["recipe"], result["result"], save=False)
+
+            if result["result"] != "OK":
+                logChannel.error("%s: %s", os.path.basename(result["recipe"]), result["result"])
+
+        self.recipeCatalog.save()
+        logChannel.info(recipeValidator.summarise(msg["results"], msg["timeInS"]))
+
+        return False  # the connection is closed, remove this call back
+
     def _onRefreshRecipeListButtonClick(self, widget):
-        self._getRecipeListFromLocalFolder()
+        self.recipeCatalog.refresh()
+        self._fillRecipeList()
 
     def _onRegenerateReportButtonClick(self, widget):
 
@@ -638,14 +842,14 @@ class MeasurixGUI(object):
             return
 
         if not os.path.exists(recipeFileName):
-            print "error: file does not exist"
+            logChannel.error("file does not exist")
             return
 
         recipe = MeasurixRecipe(recipeFileName, self.systemState, ignoreTimeStampInRecipeInfo=True)
         outputDirInRecipe = recipe.recipeInfo["outputDir"]
 
         if recipe.init != "OK":
-            print "error: %s" % recipe.init
+            logChannel.error(recipe.init)
             return
 
         outputDir = os.path.dirname(recipeFileName)
@@ -653,15 +857,11 @@ class MeasurixGUI(object):
         if outputDirInRecipe.endswith("/"):
             outputDir += "/"
 
-        unknowns = extractUnknowns(outputDir, outputDirInRecipe)
-
-        if unknowns:
-            recipe.addInfoToRecipe(unknowns)
-
-        recipe.setOutputDirectory(outputDir)
-        recipe.addInfoToRecipe({"recipeFileName": os.path.basename(recipeFileName)})
+        info = extractUnknowns(outputDir, outputDirInRecipe) or dict()
+        info["recipeFileName"] = os.path.basename(recipeFileName)
 
-        self._sendSignal({"type": "regenerateFinalReport", "recipe": recipe})
+        self._sendSignal({"type": "regenerateFinalReport", "recipeFileName": recipeFileName, "outputDir": outputDir,
+                          "info": info})
 
     def _onDeleteEvent(self, widget, event=None):
         self._sendSignal({"type": "quit"})
@@ -671,6 +871,7 @@ class MeasurixGUI(object):
         # for details.
 
     def _quit(self):
+        closeLogFiles()
         self.Gtk.main_quit()
 
     def log(self, logText, errorLevel):
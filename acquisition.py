@@ -0,0 +1,241 @@
+import os
+import time
+import json
+import ctypes
+import ctypes.util
+import numpy
+
+import logChannel
+
+# Every device of a recipe is read in a process of its own, each with a free running loop. To compare their data,
+# samples are time stamped on the monotonic clock of the system (CLOCK_MONOTONIC), which all processes share and
+# which does not jump when the wall clock is set. The time stamp of a read is the middle of the read (request to
+# response) minus the known delay of the device, clockOffsetInS; the latency of the reads is kept per device and
+# saved with the log of the device. After the run, the logs of the devices are merged into one table on a common
+# time grid, acquisition.h5.
+timeStampKey = "monotonic time [s]"
+mergedLogName = "acquisition.h5"
+CLOCK_MONOTONIC = 1
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+try:
+    clock_gettime = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True).clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+except (OSError, AttributeError):  # AttributeError: no clock_gettime in this libc
+    clock_gettime = None
+
+
+def monotonicTime():
+
+    if clock_gettime is None:
+        return time.time()  # not monotonic, but the best we have
+
+    t = timespec()
+
+    if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+        raise OSError(ctypes.get_errno(), "clock_gettime failed")
+
+    return t.tv_sec + t.tv_nsec * 1e-9
+
+
+def monotonicToWallOffset(numberOfSamples=5):
+
+    # wall clock time = monotonic time + offset. The pair of readings closest together is used
+    best = None
+
+    for _ in range(numberOfSamples):
+
+        t0 = monotonicTime()
+        wall = time.time()
+        t1 = monotonicTime()
+
+        if best is None or t1 - t0 < best[0]:
+            best = (t1 - t0, wall - (t0 + t1) / 2.0)
+
+    return best[1]
+
+
+class deviceTiming(object):
+    def __init__(self, device, clockOffsetInS=0.0, interpolation="linear"):
+
+        self.device = device
+        self.clockOffsetInS = clockOffsetInS
+        self.interpolation = interpolation  # how the data is put on the grid when merged: "linear" or "previous"
+
+        self.numberOfReads = 0
+        self.totalLatencyInS = 0.0
+        self.maxLatencyInS = 0.0
+
+    def timeStamp(self, tRequest, tResponse):
+
+        # tRequest and tResponse are monotonicTime() before and after reading the device
+        latency = tResponse - tRequest
+
+        self.numberOfReads += 1
+        self.totalLatencyInS += latency
+        self.maxLatencyInS = max(self.maxLatencyInS, latency)
+
+        return tRequest + latency / 2.0 - self.clockOffsetInS
+
+    def attributes(self):
+
+        meanLatency = self.totalLatencyInS / self.numberOfReads if self.numberOfReads else 0.0
+
+        return {"device": self.device, "clockOffsetInS": self.clockOffsetInS, "interpolation": self.interpolation,
+                "numberOfReads": self.numberOfReads, "meanLatencyInS": meanLatency,
+                "maxLatencyInS": self.maxLatencyInS, "monotonicToWallOffsetInS": monotonicToWallOffset()}
+
+    def saveTo(self, logger):
+
+        # Saves the timing as attributes of the log file of a writeLog.dataLogger
+        for k, v in self.attributes().items():
+            logger.setAttrs(k, v)
+
+
+def mergeStreams(streams, sampleRateInHz=None):
+
+    # streams maps the name of a device to (times, {key: values}, interpolation). Returns the common time grid and
+    # {"<device>: <key>": values} over the time all devices have data for, at the rate of the fastest device unless
+    # sampleRateInHz is given
+    streams = dict((name, stream) for name, stream in streams.items() if len(stream[0]) > 1)
+
+    if not streams:
+        return numpy.zeros(0), dict()
+
+    tStart = max(times[0] for times, values, interpolation in streams.values())
+    tStop = min(times[-1] for times, values, interpolation in streams.values())
+
+    if tStop <= tStart:
+        return numpy.zeros(0), dict()
+
+    if sampleRateInHz is None:
+        intervals = [numpy.diff(times) for times, values, interpolation in streams.values()]
+        sampleRateInHz = max(1.0 / numpy.median(d[d > 0]) for d in intervals if numpy.any(d > 0))
+
+    grid = numpy.arange(tStart, tStop, 1.0 / sampleRateInHz)
+    merged = dict()
+
+    for name, (times, values, interpolation) in streams.items():
+
+        if numpy.any(numpy.diff(times) < 0):
+            order = numpy.argsort(times, kind="mergesort")
+            times = times[order]
+            values = dict((k, v[order]) for k, v in values.items())
+
+        if interpolation == "previous":
+            indexes = numpy.searchsorted(times, grid, side="right") - 1
+
+        for k, v in values.items():
+            if interpolation == "previous":
+                merged[name + ": " + k] = v[indexes]
+            else:
+                merged[name + ": " + k] = numpy.interp(grid, times, v)
+
+    return grid, merged
+
+
+def readStream(logFileName):
+
+    # Returns the name of the device and (times, {key: values}, interpolation) from a log file with time stamps
+    import writeLog
+
+    with writeLog.dataLogReader(logFileName) as reader:
+
+        attrs = dict(reader.logFile.attrs.items())
+        columns = dict()
+
+        for setName, chunk in reader.iterateChunks():
+            for k, values in chunk.items():
+                columns.setdefault(k, []).append(values.copy())
+
+    columns = dict((k, numpy.concatenate(chunks)) for k, chunks in columns.items())
+    times = columns.pop(timeStampKey)
+    device = attrs.get("device", os.path.splitext(os.path.basename(logFileName))[0])
+
+    return device, (times, columns, attrs.get("interpolation", "linear"))
+
+
+def timeStampedLogs(outputDir):
+
+    # The log files in outputDir with monotonic time stamps
+    import h5py
+    import writeLog
+
+    logFileNames = []
+
+    for name in sorted(os.listdir(outputDir)):
+
+        if not name.endswith(".h5") or name == mergedLogName:
+            continue
+
+        try:
+            with h5py.File(os.path.join(outputDir, name), "r") as logFile:
+                setNames = writeLog.logDataSetNames(logFile)
+                if setNames and timeStampKey in logFile[setNames[-1]]:
+                    logFileNames.append(os.path.join(outputDir, name))
+        except IOError:
+            continue
+
+    return logFileNames
+
+
+def mergeLogs(logFileNames, mergedFileName, sampleRateInHz=None):
+
+    # Writes the merged table to mergedFileName in the layout of the data logger. Returns the number of lines
+    import writeLog
+
+    streams = dict()
+    timing = dict()
+
+    for logFileName in logFileNames:
+
+        device, stream = readStream(logFileName)
+        streams[device] = stream
+
+        with writeLog.dataLogReader(logFileName) as reader:
+            timing[device] = dict((k, v if not isinstance(v, numpy.generic) else v.item())
+                                  for k, v in reader.logFile.attrs.items())
+
+    grid, merged = mergeStreams(streams, sampleRateInHz)
+
+    temporaryFileName = mergedFileName + ".part"
+
+    if os.path.exists(temporaryFileName):
+        os.remove(temporaryFileName)
+
+    policy = writeLog.flushPolicy(maxDataLossInS=float("inf"), newDataSetAfterS=0, newDataSetAfterMB=0)
+    logger = writeLog.dataLogger(temporaryFileName, None, dict((k, k) for k in merged), timeStampKey=timeStampKey,
+                                 flushPolicy=policy, journal=False)
+    logger.logBlock(merged, grid)
+    logger.close()
+    logger.setAttrs("devices", json.dumps(timing, default=str))
+
+    os.rename(temporaryFileName, mergedFileName)
+
+    return len(grid)
+
+
+def mergeOutput(outputDir, sampleRateInHz=None):
+
+    # Merges the time stamped logs of the devices in outputDir into acquisition.h5, if there are two or more
+    logFileNames = timeStampedLogs(outputDir)
+
+    if len(logFileNames) < 2:
+        return 0
+
+    t0 = time.time()
+
+    try:
+        numberOfLines = mergeLogs(logFileNames, os.path.join(outputDir, mergedLogName), sampleRateInHz)
+    except (IOError, OSError, KeyError, ValueError), e:
+        logChannel.error("could not merge the device logs in %s: %s", outputDir, e)
+        return 0
+
+    logChannel.info("merged %i device logs into %s (%i lines) in %.1f s", len(logFileNames), mergedLogName,
+                    numberOfLines, time.time() - t0)
+
+    return numberOfLines
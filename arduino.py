@@ -1,66 +1,25 @@
-import serial
-import os
-import time
+from serialInstrument import serialInstrument, serialCommand, requestTimeout, parseText
 
 
-class Arduino(object):
-    def __init__(self, deviceString="", baud=9600):
+def parseNumbers(frame):
+    return [int(i) for i in frame.split(b",") if i != b""]
 
-        self.initError = False
 
-        if deviceString == "":
-            self.device = self._findDevice(baud)
-        else:
-            self.device = serial.Serial(deviceString, baud, timeout=1)
+class Arduino(serialInstrument):
+    # Speaks the protocol of arduino_sketches/read_buffer.ino
 
-        if self.device is None:
-            self.initError = True
-
-    def _findDevice(self, baud):
-
-        port_list = [i for i in os.listdir("/dev/") if "ttyACM" in i]
-
-        device = None
-        found = False
-        for port in port_list:
-
-            port = os.path.join("/dev/", port)
-
-            device = serial.Serial(port, baud, timeout=1)
-            response = ""
-
-            for _ in range(10):
-
-                device.write("n")
-                response = device.readline().strip()
-
-                if response != "":
-                    break
-
-            if "Arduino Uno" in response:
-                found = True
-                break
-
-        if device is None:
-            return None
-
-        if not found:
-            device.close()
-            return None
-        else:
-            return device
+    commands = {"name": serialCommand(b"n", 1, parseText),
+                "read": serialCommand(b"r", 2, parseNumbers)}  # one line of samples per channel
+    identifyCommand = "name"
+    identifyResponse = "Arduino Uno"
+    portPattern = "/dev/ttyACM*"
 
     def read(self):
 
-        self.device.write("r")
-
-        d1 = self.device.readline().strip().split(",")
-        numbers1 = [int(i) for i in d1 if i != '']
-
-        d2 = self.device.readline().strip().split(",")
-        numbers2 = [int(i) for i in d2 if i != '']
+        # Like the blocking reads this replaces, a read without a response returns no samples
+        try:
+            numbers1, numbers2 = self.request("read")
+        except requestTimeout:
+            return [], []
 
         return numbers1, numbers2
-
-    def close(self):
-        self.device.close()
@@ -0,0 +1,251 @@
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+import numpy
+
+benchmarkDir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(benchmarkDir))
+
+import devicePool
+import logChannel
+import metrics
+from headless import NullGUI
+from readRecipe import MeasurixRecipe
+from simulatedDevices import simulatedArduino, installSyntheticCamera
+
+# Every scenario is a recipe sequence, {duration} is replaced by the benchmark duration
+scenarios = {"arduino": ["startProcess_arduino()",
+                         "execute_sleep({duration})",
+                         "stopProcess_arduino()"],
+             "webcam": ["startProcess_webcam({width}, {height})",
+                        "execute_sleep({duration})",
+                        "stopProcess_webcam()"],
+             "arduino_and_webcam": ["startProcess_webcam({width}, {height})",
+                                    "startProcess_arduino()",
+                                    "execute_sleep({duration})",
+                                    "stopProcess_arduino()",
+                                    "stopProcess_webcam()"]}
+
+
+class benchmarkProgram(object):
+    def __init__(self, systemState):
+
+        self.systemState = systemState
+        self.GUI = NullGUI()
+        self.devicePool = devicePool.devicePool()
+
+
+def makeRecipe(recipeFileName, sequence, outputDir):
+
+    with zipfile.ZipFile(recipeFileName, "w") as zf:
+        zf.writestr("recipeInfo.txt", "outputDir=%s\n" % outputDir)
+        zf.writestr("sequence.txt", "\n".join(sequence) + "\n")
+
+
+def gitCommit():
+
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=benchmarkDir).strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"],
+                                        cwd=benchmarkDir).strip() != ""
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+    return commit + ("-dirty" if dirty else "")
+
+
+def summarise(values):
+
+    if not len(values):
+        return None
+
+    values = numpy.array(values)
+
+    return {"mean": values.mean(), "p50": numpy.percentile(values, 50), "p99": numpy.percentile(values, 99),
+            "max": values.max()}
+
+
+def runScenario(name, parameters, workDir):
+
+    outputDir = os.path.join(workDir, name)
+    os.mkdir(outputDir)
+
+    sequence = [line.format(**parameters) for line in scenarios[name]]
+    recipeFileName = os.path.join(workDir, "measurixRecipe_benchmark_%s-v01-00.zip" % name)
+    makeRecipe(recipeFileName, sequence, outputDir)
+
+    device = simulatedArduino(sampleRate=parameters["sampleRate"])
+    deviceString = device.start()
+
+    mgr = multiprocessing.Manager()
+    systemState = mgr.dict()
+    systemState["crashLog"] = os.path.join(workDir, "{timeStamp}-crashLog.txt")
+    systemState["arduino"] = {"baud": 115200, "device": deviceString}
+
+    program = benchmarkProgram(systemState)
+    recipe = MeasurixRecipe(recipeFileName, systemState)
+
+    metrics.reset()
+    usageBefore = resource.getrusage(resource.RUSAGE_SELF)
+    tStart = time.time()
+
+    result = recipe.start(program)
+
+    if result != "OK":
+        program.devicePool.closeAll()
+        device.stop()
+        mgr.shutdown()
+        return {"error": result}
+
+    # The simulated arduino fills every sample of response i with the value i. Seeing a new value in the system
+    # state tells us how long it took from the device answering to the value being available to other processes
+    latencies = []
+    lastResponseSeen = -1
+
+    while not recipe.done:
+
+        recipe.process()
+
+        if "arduino" in name:
+
+            measurement = systemState["arduino"].get("measurement", None)
+
+            if measurement is not None:
+
+                responseNumber = measurement["pot_meter"]["currentValue"]
+
+                if responseNumber == responseNumber and int(responseNumber) > lastResponseSeen:  # skip NaN
+                    lastResponseSeen = int(responseNumber)
+                    latencies.append(time.time() - device.responseTimes[lastResponseSeen])
+
+        time.sleep(parameters["pollIntervalInS"])
+
+    duration = time.time() - tStart
+    usageAfter = resource.getrusage(resource.RUSAGE_SELF)
+
+    program.devicePool.closeAll()
+    device.stop()
+    mgr.shutdown()
+
+    snapshot = metrics.snapshot()
+    profile = recipe.profiler.toDict()
+
+    def metricSum(metricName):
+        return snapshot[metricName]["sum"] if metricName in snapshot else 0.0
+
+    cpuPercent = {"program": 100.0 * ((usageAfter.ru_utime - usageBefore.ru_utime) +
+                                      (usageAfter.ru_stime - usageBefore.ru_stime)) / duration}
+
+    for step in profile["steps"]:
+
+        usage = step["resourceUsage"]
+        runTime = step["durationsInS"].get("run", None)
+
+        if usage and runTime:
+            cpuPercent[step["name"]] = 100.0 * (usage["userTimeInS"] + usage["systemTimeInS"]) / runTime
+
+    hdf5FileName = os.path.join(outputDir, "arduino_log.h5")
+
+    return {"durationInS": duration,
+            "samplesPerS": metricSum("arduino.samples") / duration,
+            "framesPerS": metricSum("webcam.frames") / duration,
+            "endToEndLatencyInS": summarise(latencies),
+            "cpuPercent": cpuPercent,
+            "hdf5BytesPerS": metricSum("arduino_log.bytesWritten") / duration,
+            "hdf5FileSizeInBytes": os.path.getsize(hdf5FileName) if os.path.exists(hdf5FileName) else 0}
+
+
+def compareResults(fileNames):
+
+    results = []
+
+    for fileName in fileNames:
+        with open(fileName, "r") as fh:
+            results.append(json.load(fh))
+
+    keys = ["samplesPerS", "framesPerS", "hdf5BytesPerS"]
+    print "%-20s %-16s" % ("scenario", "metric") + "".join("%16s" % r["commit"] for r in results)
+
+    for scenario in sorted(results[0]["scenarios"].keys()):
+        for key in keys:
+
+            values = [r["scenarios"].get(scenario, {}).get(key, None) for r in results]
+            line = "%-20s %-16s" % (scenario, key)
+
+            for value in values:
+                line += "%16s" % ("-" if value is None else "%.4g" % value)
+
+            if values[0] and values[-1] is not None:
+                line += "  (%+.1f%%)" % (100.0 * (values[-1] - values[0]) / values[0])
+
+            print line
+
+
+def main(argv=None):
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the acquisition to disk pipeline with simulated devices")
+    parser.add_argument("--scenario", action="append", choices=sorted(scenarios.keys()), default=None,
+                        help="scenario to run, can be given more than once (default: all)")
+    parser.add_argument("--duration", type=float, default=10.0, help="duration of every scenario [s]")
+    parser.add_argument("--sample-rate", type=float, default=1000.0,
+                        help="samples per second per channel of the simulated arduino")
+    parser.add_argument("--resolution", type=int, nargs=2, default=[640, 480], help="camera resolution")
+    parser.add_argument("--output", default=os.path.join(benchmarkDir, "results"),
+                        help="directory to save the results in")
+    parser.add_argument("--compare", nargs="+", default=None, metavar="RESULT",
+                        help="compare saved results instead of running the benchmarks")
+
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compareResults(args.compare)
+        return
+
+    logChannel.setLevel("warning")
+    metrics.initialise(enabled=True)
+
+    parameters = {"duration": args.duration, "sampleRate": args.sample_rate, "width": args.resolution[0],
+                  "height": args.resolution[1], "pollIntervalInS": 0.005}
+
+    scenarioNames = args.scenario or sorted(scenarios.keys())
+
+    if [s for s in scenarioNames if "webcam" in s]:
+        installSyntheticCamera()
+
+    results = {"commit": gitCommit(), "time": time.strftime("%Y%m%d-%H%M%S"), "python": platform.python_version(),
+               "platform": platform.platform(), "cpuCount": multiprocessing.cpu_count(),
+               "parameters": parameters, "scenarios": dict()}
+
+    workDir = tempfile.mkdtemp(prefix="measurixBenchmark")
+
+    try:
+        for name in scenarioNames:
+            print "running %s for %.1f s" % (name, args.duration)
+            results["scenarios"][name] = runScenario(name, parameters, workDir)
+            print json.dumps(results["scenarios"][name], indent=1)
+    finally:
+        shutil.rmtree(workDir)
+
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+
+    resultFileName = os.path.join(args.output, "%s-%s.json" % (results["time"], results["commit"]))
+
+    with open(resultFileName, "w") as fh:
+        json.dump(results, fh, indent=1)
+
+    print "results saved to %s" % resultFileName
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,141 @@
+import os
+import tty
+import time
+import select
+import threading
+import numpy
+
+
+class simulatedArduino(object):
+    # Speaks the protocol of arduino_sketches/read_buffer.ino through a pseudo terminal:
+    #   "n" -> "Arduino Uno\r\n"
+    #   "r" -> one line of comma separated samples per channel, most recent sample first
+    # Samples are generated at sampleRate per channel and at most maxArrayLength samples are kept, just like
+    # the input buffers of the sketch. Every sample of a response holds the response number, so a reader can
+    # tell which response a value in the system state came from (see responseTimes).
+
+    def __init__(self, sampleRate=1000.0, numberOfChannels=2, maxArrayLength=100):
+
+        self.sampleRate = sampleRate
+        self.numberOfChannels = numberOfChannels
+        self.maxArrayLength = maxArrayLength
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.deviceString = os.ttyname(self.slave)
+
+        self.responseTimes = []  # time at which response i was written
+        self.samplesSent = 0
+
+        self.running = False
+        self.thread = None
+        self.tLastRead = None
+
+    def start(self):
+
+        self.running = True
+        self.tLastRead = time.time()
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+        return self.deviceString
+
+    def stop(self):
+
+        self.running = False
+
+        if self.thread is not None:
+            self.thread.join()
+
+        os.close(self.master)
+        os.close(self.slave)
+
+    def _respond(self, command):
+
+        if command == "n":
+            os.write(self.master, "Arduino Uno\r\n")
+
+        elif command == "r":
+
+            tNow = time.time()
+            numberOfSamples = min(int((tNow - self.tLastRead) * self.sampleRate), self.maxArrayLength)
+            self.tLastRead = tNow
+
+            responseNumber = len(self.responseTimes)
+            line = "".join("%i," % responseNumber for _ in range(numberOfSamples)) + "\r\n"
+
+            os.write(self.master, line * self.numberOfChannels)
+            self.responseTimes.append(time.time())
+            self.samplesSent += numberOfSamples * self.numberOfChannels
+
+    def _serve(self):
+
+        while self.running:
+
+            readable, _, _ = select.select([self.master], [], [], 0.1)
+
+            if not readable:
+                continue
+
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                break
+
+            for command in data:
+                self._respond(command)
+
+
+class syntheticCamera(object):
+    # Stands in for pygame.camera.Camera: produces frames with a moving gradient at the requested resolution.
+    # get_image accepts an optional surface to render into, like the pygame camera does.
+
+    def __init__(self, device, resolution, mode="RGB"):
+
+        import pygame
+
+        self.pygame = pygame
+        self.resolution = tuple(resolution)
+        self.frameNumber = 0
+
+        width, height = self.resolution
+        self.gradient = (numpy.arange(width)[:, None] + numpy.arange(height)[None, :]).astype(numpy.uint8)
+        self.frame = numpy.zeros((width, height, 3), dtype=numpy.uint8)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def get_size(self):
+        return self.resolution
+
+    def query_image(self):
+        return True
+
+    def get_image(self, surface=None):
+
+        if surface is None:
+            surface = self.pygame.Surface(self.resolution, depth=24)
+
+        numpy.add(self.gradient, self.frameNumber % 256, out=self.frame[..., 0], casting="unsafe")
+        self.frame[..., 1] = self.frame[..., 0]
+        self.frame[..., 2] = 255 - self.frame[..., 0]
+        self.frameNumber += 1
+
+        self.pygame.surfarray.blit_array(surface, self.frame)
+
+        return surface
+
+
+def installSyntheticCamera():
+
+    # Make the webcam command find and use the synthetic camera. Processes started after this call inherit it.
+    import pygame
+    import pygame.camera
+
+    pygame.camera.init = lambda *args, **kwargs: None
+    pygame.camera.list_cameras = lambda: ["synthetic"]
+    pygame.camera.Camera = syntheticCamera
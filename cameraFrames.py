@@ -0,0 +1,114 @@
+import numpy
+
+# The capture loop of the web cam works on arrays that are allocated once: the camera writes into the same
+# surface (or V4L2 buffer) for every frame, the frame is copied into one array in the layout of pygame.surfarray
+# (width x height) and the preview for the GUI is made from it with numpy into one more array. The frame array has
+# a fourth, unused byte per pixel: PIL can only work on memory it does not own for modes like RGBX, so that is
+# what lets the JPEG encoder read the frame in place (see rgbxImage).
+
+
+def rgbxImage(frames):
+
+    # A PIL image of the frames, which shows the current frame every time. Like Image.fromarray of the width x
+    # height x 3 arrays this replaces, the image is height pixels wide
+    import Image
+
+    width, height = frames.size
+
+    return Image.frombuffer("RGBX", (height, width), frames.rgbx, "raw", "RGBX", 0, 1)
+
+
+class grayPreview(object):
+    # Grayscale (ITU-R 601 weights in integers: 77 R + 150 G + 29 B, over 256) of every step-th pixel, in the
+    # orientation the image plots of the GUI expect (height x width, upside down)
+
+    def __init__(self, size, step=1):
+
+        width, height = size
+        self.step = step
+
+        previewWidth = (width + step - 1) // step
+        previewHeight = (height + step - 1) // step
+
+        self.preview = numpy.empty((previewHeight, previewWidth), dtype=numpy.uint8)
+        self.target = self.preview.T[:, ::-1]  # the preview seen as width x height
+        self.weighted = numpy.empty((previewWidth, previewHeight), dtype=numpy.uint16)
+        self.channel = numpy.empty((previewWidth, previewHeight), dtype=numpy.uint16)
+
+    def update(self, rgb):
+
+        # rgb: width x height x 3 uint8
+        s = self.step
+
+        numpy.multiply(rgb[::s, ::s, 0], 77, out=self.weighted, dtype=numpy.uint16)
+        numpy.multiply(rgb[::s, ::s, 1], 150, out=self.channel, dtype=numpy.uint16)
+        numpy.add(self.weighted, self.channel, out=self.weighted)
+        numpy.multiply(rgb[::s, ::s, 2], 29, out=self.channel, dtype=numpy.uint16)
+        numpy.add(self.weighted, self.channel, out=self.weighted)
+        numpy.right_shift(self.weighted, 8, out=self.target, casting="unsafe")
+
+        return self.preview
+
+
+class pygameFrames(object):
+    # Frames of a pygame camera, which renders into the same surface every time
+
+    def __init__(self, camera):
+
+        import pygame
+        import pygame.surfarray
+
+        self.camera = camera
+        self.surfarray = pygame.surfarray
+        self.size = tuple(camera.get_size())
+        self.surface = pygame.Surface(self.size, depth=24)
+        self.rgbx = numpy.zeros(self.size + (4,), dtype=numpy.uint8)
+        self.rgb = self.rgbx[..., :3]
+
+    def grab(self):
+
+        self.camera.get_image(self.surface)
+
+        # pixels3d is a view of the surface, which stays locked until the view is gone
+        pixels = self.surfarray.pixels3d(self.surface)
+        numpy.copyto(self.rgb, pixels)
+        del pixels
+
+        return self.rgb
+
+    def stop(self):
+        self.camera.stop()
+
+
+class v4l2Frames(object):
+    # Frames read straight from V4L2, see v4l2Capture.py
+
+    def __init__(self, device, resolution, timeoutInS=1.0):
+
+        import v4l2Capture
+
+        self.capture = v4l2Capture.v4l2Capture(device, resolution)
+        self.timeoutInS = timeoutInS
+
+        self.size = self.capture.resolution  # the resolution the driver chose
+        self.converter = v4l2Capture.yuyvConverter(*self.size)
+        self.rgbx = numpy.zeros(self.size + (4,), dtype=numpy.uint8)
+        self.rgb = self.rgbx[..., :3]
+        self.rgbByLine = self.rgb.transpose(1, 0, 2)  # height x width x 3, like the frames of the camera
+
+        self.capture.start()
+
+    def grab(self):
+
+        # Returns None if the camera did not deliver a frame in time
+        frame = self.capture.read(self.timeoutInS)
+
+        if frame is None:
+            return None
+
+        self.converter.toRGB(frame, self.rgbByLine)
+
+        return self.rgb
+
+    def stop(self):
+        self.capture.close()
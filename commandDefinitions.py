@@ -1,6 +1,11 @@
 import time
 import os
 import traceback
+import devicePool
+import eventLog
+import logChannel
+import metrics
+import recipeProfiler
 
 
 class MeasurixCommand(object):
@@ -20,28 +25,39 @@ class MeasurixCommand(object):
         self.proc = multiprocessing.Process(target=self.protectedWorker)
         self.sendMessageQueue = messageQueue
 
+        # Without a program (e.g. when recipes are validated in bulk) only the inputs of a command can be checked
         self.measurixProgram = measurixProgram
-        self.systemState = measurixProgram.systemState
-        self.GUI = measurixProgram.GUI
+        self.systemState = measurixProgram.systemState if measurixProgram else None
+        self.GUI = measurixProgram.GUI if measurixProgram else None
 
         if "outputDir" in recipeInfo.keys():
             self.outputDirectory = recipeInfo["outputDir"]
 
         self.recipeInfo = recipeInfo
         self.stopMessageReceived = False
+        self.timeWorkerStarted = None
+        self.devicesLeased = False
 
     def protectedWorker(self):
 
+        self.timeWorkerStarted = time.time()
+
+        recipeFileName = self.recipeInfo.get("recipeFileName", None)
+        eventLog.setContext(command=self.name,
+                            recipe=os.path.basename(recipeFileName) if recipeFileName else None)
+
         try:
 
             if self.name.startswith("startProcess"):
                 self.sendMessage({"type": "continue", "PID": os.getpid()})
 
             self.worker()
-            self.sendMessage({"type": "done", "PID": os.getpid()})
+            self.sendMessage({"type": "done", "PID": os.getpid(),
+                              "resourceUsage": recipeProfiler.resourceUsage()})
 
         except Exception, e:
-            self.sendMessage({"type": "exception", "PID": os.getpid(), "exception": e})
+            self.sendMessage({"type": "exception", "PID": os.getpid(), "exception": e,
+                              "resourceUsage": recipeProfiler.resourceUsage()})
 
             timeStamp = time.strftime("%Y%m%d-%H%M%S")
             crashLog = self.systemState["crashLog"].format(timeStamp=timeStamp)
@@ -68,8 +84,28 @@ class MeasurixCommand(object):
         return "OK"
 
     def sendMessage(self, message):
+        # used by the recipe profiler to measure the process start up time and the queue latency
+        message["timeWorkerStarted"] = self.timeWorkerStarted
+        message["timeSent"] = time.time()
         self.sendMessageQueue.put(message)
 
+    def leaseDevice(self, kind, **parameters):
+
+        # Get an open device from the device pool of the program. Only call this from the hardware checker, the
+        # command process inherits the device. Returns "OK" and the device, or an error message and None
+        result, device = self.measurixProgram.devicePool.lease(kind, self, **parameters)
+
+        if result == "OK":
+            self.devicesLeased = True
+
+        return result, device
+
+    def releaseDevices(self):
+
+        if self.devicesLeased:
+            self.measurixProgram.devicePool.release(self)
+            self.devicesLeased = False
+
     def sendRecipeAbortMessage(self):
         self.sendMessage({"type": "abort", "PID": os.getpid()})
 
@@ -97,19 +133,27 @@ class MeasurixCommand(object):
     def start(self):
 
         if not self.measurixProgram:
-            print "cannot start if not connected to a program"
+            logChannel.error("cannot start if not connected to a program")
 
         self.proc.start()
         return self.proc.pid
 
     def cleanUp(self):
         self.proc.join()
+        self.releaseDevices()
 
     def abort(self):
         self.proc.terminate()
         self.proc.join()
 
-    def reportGenerator(self):  # This will be optionally implemented in inheriting classes
+        # We do not know in which state the device was left, open it again when it is needed
+        if self.devicesLeased:
+            self.measurixProgram.devicePool.discard(self)
+            self.devicesLeased = False
+
+    def reportGenerator(self, report=None):  # This will be optionally implemented in inheriting classes
+        # Returns a section of the final report {"title": ..., "html": ..., "summary": ...} or None. report is a
+        # reportPipeline.reportContext. Implement reportInputs() as well to have the section cached
         return None
 
 
@@ -124,14 +168,30 @@ class stopProcessStub(object):
     def inputChecker(self):
         return "OK"
 
-    def reportGenerator(self):
-        return
+    def reportGenerator(self, report=None):
+        return None
+
+
+##################################################################################################################
+class generateFinalReport(MeasurixCommand):
+    # Added to the end of every recipe: args = [software version, execution sequence]
+
+    def worker(self):
+
+        import reportPipeline
+
+        softwareVersion, sequence = self.args
+
+        reportFileName = reportPipeline.generateReport(self.outputDirectory, sequence, self.recipeInfo, softwareVersion,
+                                                       numberOfProcesses=self.systemState.get("reportProcesses", None))
+
+        logChannel.info("report saved to %s", reportFileName)
 
 
 ##################################################################################################################
 class execute_sleep(MeasurixCommand):
     def worker(self):
-        print "info: sleeping for %.1f seconds" % self.args[0]
+        logChannel.info("sleeping for %.1f seconds", self.args[0])
 
         if self.receiveStopMessage(self.args[0]):
             return
@@ -146,11 +206,26 @@ class execute_sleep(MeasurixCommand):
 
 ################################################################################################################
 
+def openArduino(device, baud):
+
+    from arduino import Arduino
+
+    # If no device is given, we look for an arduino on the /dev/ttyACM* ports
+    arduino = Arduino(deviceString=device, baud=baud)
+
+    return None if arduino.initError else arduino
+
+
+devicePool.registerDeviceType("arduino", openArduino, lambda arduino: arduino.isAlive(),
+                              lambda arduino: arduino.close())
+
+
 class startProcess_arduino(MeasurixCommand):
     def worker(self):
 
         import numpy as np
         import writeLog
+        import acquisition
 
         showArduino = {"pot_meter": {"plotType": [],
                                      "yDataSource": "self.systemState[\"arduino\"][\"measurement\"][\"pot_meter\"]",
@@ -165,43 +240,120 @@ class startProcess_arduino(MeasurixCommand):
                    "LSR [Ohm]": "arduino/measurement/light_resistor/currentValue"}
 
         logFile = os.path.join(self.outputDirectory, "arduino_log.h5")
-        print("info: saving to log file {}".format(logFile))
-        logger = writeLog.dataLogger(logFile, self.systemState, logKeys)
-
+        logChannel.info("saving to log file %s", logFile)
+        logger = writeLog.dataLogger(logFile, self.systemState, logKeys,
+                                     swmr=bool(self.systemState.get("logSWMR", 0)),
+                                     timeStampKey=acquisition.timeStampKey)
+
+        # The logger logs the mean of every read. With rawCapture in the [arduino] section of the INI file, every
+        # sample is kept as well, in a raw capture that is converted to arduino_raw.h5 after the run. The samples are
+        # time stamped on the same clock as the means, so arduino_raw.h5 is merged with the other logs too. The
+        # arduino keeps the newest bufferLength samples per channel, taken at sampleRateInHz
+        arduinoSettings = dict(self.systemState["arduino"])
+        sampleRateInHz = float(arduinoSettings.get("sampleRateInHz", 0)) or None
+        bufferLength = int(arduinoSettings.get("bufferLength", 100))
+        capture = None
+
+        # Every read is time stamped on the monotonic clock, so it can be merged with the other devices of the recipe
+        timing = acquisition.deviceTiming("arduino", arduinoSettings.get("clockOffsetInS", 0.0))
+
+        if arduinoSettings.get("rawCapture", 0):
+            import rawCapture
+            capture = rawCapture.rawCaptureWriter(os.path.join(self.outputDirectory, "arduino_raw.mxraw"),
+                                                  [acquisition.timeStampKey, "pot_meter [Ohm]", "LSR [Ohm]"],
+                                                  sampleRateInHz=sampleRateInHz)
+
+        samplesMetric = metrics.counter("arduino.samples")
+        loopTimeMetric = metrics.histogram("arduino.loopTimeInS")
+        loopOverrunMetric = metrics.gauge("arduino.loopOverrunInS")
+
+        loopPeriod = 0.5
         plotsShown = False
+        tLoop = time.time()
+        previousTimeStamp = None
 
-        while not self.receiveStopMessage(0.5):
+        while not self.receiveStopMessage(loopPeriod):
 
+            tRead = time.time()
+            tRequest = acquisition.monotonicTime()
             numbers1, numbers2 = self.device.read()
+            tResponse = acquisition.monotonicTime()
+            timeStamp = timing.timeStamp(tRequest, tResponse)
 
             measurement = {"pot_meter": {"currentValue": np.mean(numbers1), "UNIT": "Ohm"},
                            "light_resistor": {"currentValue": np.mean(numbers2), "UNIT": "Ohm"}}
 
-            self.systemState["arduino"] = {"baud": self.baud,
-                                           "measurement": measurement}
+            self.systemState["arduino"] = dict(arduinoSettings, baud=self.baud, device=self.deviceString,
+                                               measurement=measurement)
 
-            logger.doLog()
+            logger.doLog(timeStamp=timeStamp)
+
+            if capture is not None:
+                # The arduino sends the samples taken since the previous read, newest first, but no more than fit
+                # in its buffer. They are put in the order they were taken. The newest is taken at the read and the
+                # ones before it one sample period apart; if the buffer was not full (or the sample rate is not
+                # known) the samples are spread evenly over the time since the previous read instead
+                numberOfSamples = min(len(numbers1), len(numbers2))
+
+                if sampleRateInHz is not None and (numberOfSamples >= bufferLength or previousTimeStamp is None):
+                    sampleTimes = timeStamp - np.arange(numberOfSamples - 1, -1, -1) / sampleRateInHz
+                else:
+                    tStart = timeStamp - loopPeriod if previousTimeStamp is None else previousTimeStamp
+                    sampleTimes = np.linspace(tStart, timeStamp, numberOfSamples + 1)[1:]
+
+                capture.append(np.column_stack([sampleTimes, numbers1[:numberOfSamples][::-1],
+                                                numbers2[:numberOfSamples][::-1]]))
+
+            previousTimeStamp = timeStamp
 
             if not plotsShown:
                 self.GUI.addRealTimePlot(showArduino)
                 plotsShown = True
 
-        self.device.close()
+            # The loop is meant to take loopPeriod seconds; anything above that is spent reading and logging
+            tNow = time.time()
+            samplesMetric.inc(len(numbers1) + len(numbers2))
+            loopTimeMetric.observe(tNow - tRead)
+            loopOverrunMetric.set(max(0.0, tNow - tLoop - loopPeriod))
+            tLoop = tNow
 
-    def hardwareChecker(self):
+        logger.close()  # writes what is left in the buffer
+        timing.saveTo(logger)
+
+        if capture is not None:
+            capture.close()
+        # the device is not closed, it stays open in the device pool of the program for the next recipe
+
+    def reportInputs(self):
+        return ["arduino_log.h5"]
+
+    def reportGenerator(self, report=None):
 
-        from arduino import Arduino
+        if report is None or not os.path.exists(report.path("arduino_log.h5")):
+            return None
+
+        statistics = report.logStatistics("arduino_log.h5", ["pot_meter [Ohm]", "LSR [Ohm]"])
+        rows = [[key, s["count"], s.get("mean", ""), s.get("std", ""), s.get("min", ""), s.get("max", "")]
+                for key, s in sorted(statistics.items())]
+
+        return {"title": "arduino",
+                "html": report.table(["quantity", "samples", "mean", "std", "min", "max"], rows),
+                "summary": statistics}
+
+    def hardwareChecker(self):
 
         baud = int(self.systemState["arduino"]["baud"])
+        deviceString = self.systemState["arduino"].get("device", "")
 
-        self.device = Arduino(baud=baud)
+        result, self.device = self.leaseDevice("arduino", device=deviceString, baud=baud)
 
-        if self.device.initError:
-            return "Error: No arduino device found"
+        if result != "OK":
+            return "Error: No arduino device found (%s)" % result
 
         self.baud = baud
+        self.deviceString = deviceString
 
-        print("info: Communicating with arduino")
+        logChannel.info("Communicating with arduino")
         return "OK"
 
     def inputChecker(self):
@@ -209,22 +361,59 @@ class startProcess_arduino(MeasurixCommand):
 
 ################################################################################################################
 
+def openCamera():
+
+    # The pooled handle is the path of the camera, see devicePool.py
+    import pygame
+    import pygame.camera
+
+    pygame.init()
+    pygame.camera.init()
+
+    clist = pygame.camera.list_cameras()
+
+    return clist[0] if clist else None
+
+
+def cameraIsAvailable(cameraDevice):
+
+    import pygame.camera
+
+    return cameraDevice in pygame.camera.list_cameras()
+
+
+devicePool.registerDeviceType("camera", openCamera, cameraIsAvailable)
+
+
 class startProcess_webcam(MeasurixCommand):
 
     def worker(self):
 
         import pygame
         import pygame.camera
-        import Image
         import os
+        import writeLog
+        import acquisition
+        import cameraFrames
 
         showCamera = {"camera": {"plotType": ["image"],
                                  "imageDataSource": "self.systemState[\"camera\"][\"data\"]",
                                  "plotTitle": "web cam"}}
 
+        # With v4l2 in the [webcam] section of the INI file the camera is read straight from V4L2 instead of through
+        # pygame. previewStep shrinks the preview sent to the GUI, the frames are saved at full resolution
+        webcamSettings = dict(self.systemState.get("webcam", {}))
         resolution = self.args
-        camera = pygame.camera.Camera(self.camera_device, resolution)
-        camera.start()
+
+        if webcamSettings.get("v4l2", 0):
+            frames = cameraFrames.v4l2Frames(self.camera_device, resolution)
+        else:
+            camera = pygame.camera.Camera(self.camera_device, resolution)
+            camera.start()
+            frames = cameraFrames.pygameFrames(camera)
+
+        preview = cameraFrames.grayPreview(frames.size, int(webcamSettings.get("previewStep", 1)))
+        pil_image = cameraFrames.rgbxImage(frames)
 
         plotsShown = False
         frame_count = 0
@@ -234,40 +423,86 @@ class startProcess_webcam(MeasurixCommand):
         if not os.path.exists(outputDirectory):
             os.mkdir(outputDirectory)
 
-        print("info: saving frames to {}".format(outputDirectory))
+        logChannel.info("saving frames to %s", outputDirectory)
+
+        # The time stamp of every frame is logged, so the frames can be lined up with the data of the other devices
+        logger = writeLog.dataLogger(os.path.join(self.outputDirectory, "webcam_log.h5"), self.systemState,
+                                     {"frame": "camera/frame"}, swmr=bool(self.systemState.get("logSWMR", 0)),
+                                     timeStampKey=acquisition.timeStampKey)
+        timing = acquisition.deviceTiming("webcam", interpolation="previous")
+
+        framesMetric = metrics.counter("webcam.frames")
+        encodeTimeMetric = metrics.histogram("webcam.frameEncodeTimeInS")
 
         while not self.receiveStopMessage(0.5):
 
-            image = camera.get_image()
-            image_data = pygame.surfarray.array3d(image)
-            frame = image_data[..., 0][:, ::-1].T
-            self.systemState["camera"] = {"data": frame}
+            tRequest = acquisition.monotonicTime()
+            image_data = frames.grab()
+
+            if image_data is None:
+                continue
+
+            logger.doLog({"frame": frame_count}, timing.timeStamp(tRequest, acquisition.monotonicTime()))
+
+            self.systemState["camera"] = {"data": preview.update(image_data)}
 
             image_file = os.path.join(outputDirectory, "frame-{}.jpeg".format(str(frame_count)))
 
-            pil_image = Image.fromarray(image_data)
+            tEncode = time.time()
             pil_image.save(image_file)
+            encodeTimeMetric.observe(time.time() - tEncode)
+            framesMetric.inc()
             frame_count += 1
 
             if not plotsShown:
                 self.GUI.addRealTimePlot(showCamera)
                 plotsShown = True
 
-        camera.stop()
+        frames.stop()
+        logger.close()
+        timing.saveTo(logger)
 
-    def hardwareChecker(self):
+    def reportInputs(self):
+        return ["frames", "frames.zip"]
 
-        import pygame
-        import pygame.camera
+    def reportGenerator(self, report=None):
+
+        import outputArchiver
 
-        pygame.init()
-        pygame.camera.init()
+        if report is None:
+            return None
 
-        clist = pygame.camera.list_cameras()
-        if not clist:
-            return "Error: No camera's detected"
+        # The frames are either still loose files or have been archived into frames.zip
+        frameSizes = dict()
 
-        self.camera_device = clist[0]
+        if os.path.isdir(report.path("frames")):
+            for name in os.listdir(report.path("frames")):
+                m = outputArchiver.frameRegex.match(name)
+                if m:
+                    frameSizes[int(m.group(1))] = os.path.getsize(os.path.join(report.path("frames"), name))
+
+        if os.path.exists(report.path(outputArchiver.frameArchiveName)):
+            for frameNumber, (offset, size) in outputArchiver.readFrameIndex(
+                    report.path(outputArchiver.frameArchiveName)).items():
+                frameSizes[frameNumber] = size
+
+        if not frameSizes:
+            return None
+
+        summary = {"frames": len(frameSizes), "totalSizeInBytes": sum(frameSizes.values()),
+                   "firstFrame": min(frameSizes.keys()), "lastFrame": max(frameSizes.keys()),
+                   "resolution": list(self.args)}
+
+        return {"title": "web cam",
+                "html": report.table(["", ""], sorted(summary.items())),
+                "summary": summary}
+
+    def hardwareChecker(self):
+
+        result, self.camera_device = self.leaseDevice("camera")
+
+        if result != "OK":
+            return "Error: No camera's detected (%s)" % result
 
         return "OK"
 
@@ -281,4 +516,183 @@ class startProcess_webcam(MeasurixCommand):
         if [type(i) for i in self.args] != [int, int]:
             return "Error: Two arguments specifying resolution is required"
 
-        return "OK"
\ No newline at end of file
+        return "OK"
+
+################################################################################################################
+
+class replayCommand(MeasurixCommand):
+    # Plays a recording back as if the device were there, see replay.py. args: the recording and optionally the
+    # speed, e.g. 10 for ten times faster than it was recorded
+    replaysFrames = False
+
+    def speed(self):
+        return float(self.args[1]) if len(self.args) > 1 else 1.0
+
+    def paced(self, items):
+
+        # Yields the items, which start with their recorded time, when they are due. Stops early on a stop message
+        import acquisition
+        import replay
+
+        schedule = replay.replaySchedule(self.speed())
+        lagMetric = metrics.gauge("replay.lagInS")
+        tLastCheck = acquisition.monotonicTime()
+
+        for item in items:
+
+            tNow = acquisition.monotonicTime()
+            wait = schedule.dueAt(item[0], tNow) - tNow
+
+            if wait > 0:
+                if self.receiveStopMessage(wait):
+                    return
+                tLastCheck = acquisition.monotonicTime()
+
+            elif tNow - tLastCheck > 0.1:  # behind schedule, look for the stop message now and then
+
+                if self.receiveMessage() == "stop":
+                    self.stopMessageReceived = True
+                    return
+
+                tLastCheck = tNow
+
+            lagMetric.set(max(0.0, -wait))
+
+            yield item
+
+    def waitForStopMessage(self):
+
+        # When the recording runs out, the command keeps running until it is stopped, like a device would
+        while not self.stopMessageReceived:
+            self.receiveStopMessage(0.5)
+
+    def inputChecker(self):
+
+        # Only the arguments: the results are cached on the content of the recipe, see recipeValidator.py
+        if len(self.args) not in [1, 2]:
+            return "Error: the recording to replay and optionally the speed are required"
+
+        if not isinstance(self.args[0], basestring):
+            return "Error: the first argument is the log file or run directory to replay"
+
+        if len(self.args) == 2 and (type(self.args[1]) not in [int, float] or self.args[1] <= 0):
+            return "Error: the speed must be a positive number"
+
+        return "OK"
+
+    def hardwareChecker(self):
+
+        # The recording takes the place of the hardware, it is looked at just before the recipe runs
+        import replay
+
+        return replay.checkReplaySource(self.args[0], getattr(self, "outputDirectory", None), self.replaysFrames)
+
+
+class startProcess_replay(replayCommand):
+    # e.g. startProcess_replay("/data/run1/arduino_log.h5", 10.0). The lines of the log are put back into the system
+    # state and logged again to a log of the same name in the output directory
+
+    def worker(self):
+
+        import writeLog
+        import acquisition
+        import replay
+
+        logFileName = self.args[0]
+        outputLogFile = os.path.join(self.outputDirectory, os.path.basename(logFileName))
+        logChannel.info("replaying %s at %g times the recorded speed to %s", logFileName, self.speed(), outputLogFile)
+
+        linesMetric = metrics.counter("replay.lines")
+        logger = None
+        logKeys = None
+        numberOfLines = 0
+
+        for tRecorded, values, dataSet in self.paced(replay.iterateLogLines(logFileName)):
+
+            if dataSet.logKeys != logKeys:  # the first line, or a data set with other keys
+
+                if logger is not None:
+                    logger.close()
+
+                logKeys = dataSet.logKeys
+                logger = writeLog.dataLogger(outputLogFile, self.systemState, logKeys,
+                                             swmr=bool(self.systemState.get("logSWMR", 0)),
+                                             timeStampKey=acquisition.timeStampKey)
+
+            replay.publish(self.systemState, dataSet.keyPaths, values)
+            logger.doLog(timeStamp=acquisition.monotonicTime())
+
+            linesMetric.inc()
+            numberOfLines += 1
+
+        if logger is not None:
+            logger.close()
+
+        logChannel.info("replayed %i lines of %s", numberOfLines, logFileName)
+
+        self.waitForStopMessage()
+
+    def reportInputs(self):
+        return [os.path.basename(self.args[0])]
+
+    def reportGenerator(self, report=None):
+
+        import acquisition
+
+        logFileName = os.path.basename(self.args[0])
+
+        if report is None or not os.path.exists(report.path(logFileName)):
+            return None
+
+        statistics = report.logStatistics(logFileName)
+        statistics.pop(acquisition.timeStampKey, None)
+
+        rows = [[key, s["count"], s.get("mean", ""), s.get("std", ""), s.get("min", ""), s.get("max", "")]
+                for key, s in sorted(statistics.items())]
+
+        return {"title": "replay of %s" % self.args[0],
+                "html": report.table(["quantity", "samples", "mean", "std", "min", "max"], rows),
+                "summary": statistics}
+
+
+class startProcess_replayFrames(replayCommand):
+    # e.g. startProcess_replayFrames("/data/run1", 10.0). Shows the web cam frames of a run (loose or in frames.zip)
+    # again and logs their frame numbers to webcam_log.h5 in the output directory
+    replaysFrames = True
+
+    def worker(self):
+
+        import writeLog
+        import acquisition
+        import replay
+
+        showCamera = {"camera": {"plotType": ["image"],
+                                 "imageDataSource": "self.systemState[\"camera\"][\"data\"]",
+                                 "plotTitle": "web cam (replay)"}}
+
+        runDir = self.args[0]
+        frames = replay.recordedFrames(runDir)
+        source = replay.frameSource(runDir)
+        logChannel.info("replaying %i frames of %s at %g times the recorded speed", len(frames), runDir,
+                        self.speed())
+
+        logger = writeLog.dataLogger(os.path.join(self.outputDirectory, "webcam_log.h5"), self.systemState,
+                                     {"frame": "camera/frame"}, swmr=bool(self.systemState.get("logSWMR", 0)),
+                                     timeStampKey=acquisition.timeStampKey)
+
+        framesMetric = metrics.counter("replay.frames")
+        plotsShown = False
+
+        for tRecorded, frameNumber in self.paced(frames):
+
+            self.systemState["camera"] = {"data": source.read(frameNumber)}
+            logger.doLog({"frame": frameNumber}, acquisition.monotonicTime())
+            framesMetric.inc()
+
+            if not plotsShown:
+                self.GUI.addRealTimePlot(showCamera)
+                plotsShown = True
+
+        logger.close()
+
+        self.waitForStopMessage()
@@ -0,0 +1,149 @@
+import time
+
+import logChannel
+import metrics
+
+# Opening a device can be expensive: opening the serial port of an arduino resets the board and waits for the
+# boot loader, the camera needs pygame to be initialised and the cameras to be listed. The device pool lives in
+# the program process and keeps devices open across the steps of a recipe and across recipes. Commands lease a
+# device in their hardware checker, which runs in the program process, and the command process inherits the open
+# device when it is started. The lease is returned when the command is cleaned up.
+#
+# Not every device can be handed over this way. A pygame camera can't be shared across a fork: its stream and the
+# buffers it is read through are owned by the process that started it, which would keep them after the command
+# process is gone. For the camera the pool only keeps pygame initialised and the path of the camera it found; every
+# web cam command process still makes and starts its own pygame.camera.Camera and stops it at the end.
+#
+# Before a device is leased again it is health checked; a device which does not respond is closed and opened
+# again. Devices are identified by their kind and the parameters they were opened with, so a recipe asking for a
+# different baud rate gets a new connection.
+
+# kind -> deviceType
+deviceTypes = dict()
+
+
+class deviceType(object):
+    def __init__(self, kind, opener, healthChecker=None, closer=None):
+
+        self.kind = kind
+        self.opener = opener  # opener(**parameters) returns a handle or None if the device can't be opened
+        self.healthChecker = healthChecker  # healthChecker(handle) returns True if the device responds
+        self.closer = closer  # closer(handle)
+
+
+class deviceSession(object):
+    def __init__(self, kind, parameters, handle):
+
+        self.kind = kind
+        self.parameters = parameters
+        self.handle = handle
+        self.holder = None
+        self.timeOpened = time.time()
+        self.numberOfLeases = 0
+
+
+def registerDeviceType(kind, opener, healthChecker=None, closer=None):
+    deviceTypes[kind] = deviceType(kind, opener, healthChecker, closer)
+
+
+class devicePool(object):
+    def __init__(self):
+
+        self.sessions = dict()  # (kind, parameters) -> deviceSession
+
+        self.openedMetric = metrics.counter("devicePool.opened")
+        self.reusedMetric = metrics.counter("devicePool.reused")
+        self.reconnectedMetric = metrics.counter("devicePool.reconnected")
+
+    def _key(self, kind, parameters):
+        return kind, tuple(sorted(parameters.items()))
+
+    def _isHealthy(self, session):
+
+        healthChecker = deviceTypes[session.kind].healthChecker
+
+        if healthChecker is None:
+            return True
+
+        try:
+            return healthChecker(session.handle)
+        except Exception, e:
+            logChannel.debug("health check of %s failed: %s", session.kind, e)
+            return False
+
+    def _close(self, session):
+
+        closer = deviceTypes[session.kind].closer
+
+        if closer is None:
+            return
+
+        try:
+            closer(session.handle)
+        except Exception, e:
+            logChannel.warning("could not close %s: %s", session.kind, e)
+
+    def lease(self, kind, holder, **parameters):
+
+        # Returns "OK" and the device handle, or an error message and None
+        if kind not in deviceTypes:
+            return "error: unknown device %s" % kind, None
+
+        key = self._key(kind, parameters)
+        session = self.sessions.get(key, None)
+
+        if session is not None:
+
+            if session.holder is not None and session.holder is not holder:
+                return "error: %s is in use by %s" % (kind, session.holder.name), None
+
+            if session.holder is None and not self._isHealthy(session):
+                logChannel.warning("%s does not respond, reconnecting", kind)
+                self._close(session)
+                del self.sessions[key]
+                session = None
+                self.reconnectedMetric.inc()
+            else:
+                self.reusedMetric.inc()
+
+        if session is None:
+
+            try:
+                handle = deviceTypes[kind].opener(**parameters)
+            except Exception, e:
+                return "error: could not open %s: %s" % (kind, e), None
+
+            if handle is None:
+                return "error: could not open %s" % kind, None
+
+            session = deviceSession(kind, parameters, handle)
+            self.sessions[key] = session
+            self.openedMetric.inc()
+
+        session.holder = holder
+        session.numberOfLeases += 1
+
+        return "OK", session.handle
+
+    def release(self, holder):
+
+        # Return all devices leased by holder
+        for session in self.sessions.values():
+            if session.holder is holder:
+                session.holder = None
+
+    def discard(self, holder):
+
+        # Close the devices leased by holder instead of returning them, e.g. after the command was killed while
+        # talking to the device
+        for key, session in self.sessions.items():
+            if session.holder is holder:
+                self._close(session)
+                del self.sessions[key]
+
+    def closeAll(self):
+
+        for session in self.sessions.values():
+            self._close(session)
+
+        self.sessions = dict()
@@ -0,0 +1,284 @@
+import os
+import re
+import sys
+import time
+import json
+import struct
+
+errorLevels = ["debug", "info", "warning", "error"]
+
+# Every record in the event log is a single JSON line. Next to each day segment (events-YYYYMMDD.jsonl) we keep
+#  - an index file (events-YYYYMMDD.idx) with one fixed size entry per block of records:
+#    (minimum time stamp, maximum time stamp, byte offset in the segment, number of records)
+#  - a summary file (events-YYYYMMDD.summary) with the time span, levels and recipes found in the segment
+# A query first throws away segments based on the summaries and then only reads the blocks of a segment of which
+# the time span overlaps with the requested time range.
+indexEntry = struct.Struct("<ddQI")
+maxRecordsPerBlock = 256
+
+# The context is set by the process emitting the records, e.g. a command sets the command name and the recipe
+eventContext = {"command": None, "recipe": None}
+
+
+def setContext(**kwargs):
+    eventContext.update(kwargs)
+
+
+def splitLevelFromMessage(messageText):
+
+    # e.g. "error: file does not exist" gives ("error", "file does not exist")
+    m = re.match("\s*(\w+)\s*:\s*(.*)", messageText, re.DOTALL)
+
+    if m and m.groups()[0].lower() in errorLevels:
+        return m.groups()[0].lower(), m.groups()[1]
+
+    return "info", messageText
+
+
+def makeRecord(messageText, level=None, timeStamp=None, pid=None, context=None):
+
+    if context is None:
+        context = eventContext
+
+    if level is None:
+        level, messageText = splitLevelFromMessage(messageText)
+
+    return {"time": timeStamp if timeStamp is not None else time.time(),
+            "level": level,
+            "PID": pid if pid is not None else os.getpid(),
+            "command": context["command"],
+            "recipe": context["recipe"],
+            "message": messageText}
+
+
+class eventLogWriter(object):
+    def __init__(self, eventLogDir):
+
+        self.eventLogDir = eventLogDir
+
+        if not os.path.exists(self.eventLogDir):
+            os.makedirs(self.eventLogDir)
+
+        self.segmentDate = None
+        self.segmentFile = None
+        self.indexFile = None
+        self.summary = None
+
+    def _segmentBaseName(self, segmentDate):
+        return os.path.join(self.eventLogDir, "events-%s" % segmentDate)
+
+    def _openSegment(self, segmentDate):
+
+        self.close()
+
+        baseName = self._segmentBaseName(segmentDate)
+
+        self.segmentDate = segmentDate
+        self.segmentFile = open(baseName + ".jsonl", "ab")
+        self.segmentFile.seek(0, os.SEEK_END)  # on some platforms tell() returns 0 for a fresh append handle
+        self.indexFile = open(baseName + ".idx", "ab")
+
+        if os.path.exists(baseName + ".summary"):
+            with open(baseName + ".summary", "r") as fh:
+                self.summary = json.load(fh)
+        else:
+            self.summary = {"firstTime": None, "lastTime": None, "levels": dict(), "recipes": [], "records": 0}
+
+    def _writeSummary(self):
+
+        summaryFileName = self._segmentBaseName(self.segmentDate) + ".summary"
+
+        with open(summaryFileName + ".tmp", "w") as fh:
+            json.dump(self.summary, fh)
+
+        os.rename(summaryFileName + ".tmp", summaryFileName)
+
+    def _updateSummary(self, records):
+
+        times = [r["time"] for r in records]
+
+        if self.summary["firstTime"] is None or min(times) < self.summary["firstTime"]:
+            self.summary["firstTime"] = min(times)
+
+        if self.summary["lastTime"] is None or max(times) > self.summary["lastTime"]:
+            self.summary["lastTime"] = max(times)
+
+        for r in records:
+
+            self.summary["levels"][r["level"]] = self.summary["levels"].get(r["level"], 0) + 1
+
+            if r["recipe"] is not None and r["recipe"] not in self.summary["recipes"]:
+                self.summary["recipes"].append(r["recipe"])
+
+        self.summary["records"] += len(records)
+
+    def write(self, records):
+
+        if not records:
+            return
+
+        segmentDate = time.strftime("%Y%m%d")
+
+        if segmentDate != self.segmentDate:
+            self._openSegment(segmentDate)
+
+        offset = self.segmentFile.tell()
+        lines = []
+        index = []
+
+        for start in range(0, len(records), maxRecordsPerBlock):
+
+            block = records[start:start + maxRecordsPerBlock]
+            blockLines = [json.dumps(r) + "\n" for r in block]
+            times = [r["time"] for r in block]
+
+            index.append(indexEntry.pack(min(times), max(times), offset, len(block)))
+            offset += sum(len(line) for line in blockLines)
+            lines.extend(blockLines)
+
+        # The data is written before the index, so an index entry never points to data which is not there
+        self.segmentFile.write("".join(lines))
+        self.segmentFile.flush()
+        self.indexFile.write("".join(index))
+        self.indexFile.flush()
+
+        self._updateSummary(records)
+        self._writeSummary()
+
+    def close(self):
+
+        for fh in [self.segmentFile, self.indexFile]:
+            if fh is not None:
+                fh.close()
+
+        self.segmentFile = None
+        self.indexFile = None
+
+
+# The event log writers are kept open for the lifetime of the process writing the event log
+eventLogWriters = dict()
+
+
+def logEvents(records, eventLogDir):
+
+    if eventLogDir not in eventLogWriters:
+        eventLogWriters[eventLogDir] = eventLogWriter(eventLogDir)
+
+    eventLogWriters[eventLogDir].write(records)
+
+
+def closeEventLogs():
+
+    for eventLogDir in eventLogWriters.keys():
+        eventLogWriters.pop(eventLogDir).close()
+
+
+def queryEvents(eventLogDir, startTime=None, endTime=None, levels=None, recipe=None, command=None):
+
+    startTime = startTime if startTime is not None else float("-inf")
+    endTime = endTime if endTime is not None else float("inf")
+
+    def recordMatches(r):
+
+        if not startTime <= r["time"] <= endTime:
+            return False
+
+        if levels and r["level"] not in levels:
+            return False
+
+        if recipe is not None and (r["recipe"] is None or recipe not in r["recipe"]):
+            return False
+
+        if command is not None and r["command"] != command:
+            return False
+
+        return True
+
+    summaryFileNames = sorted(f for f in os.listdir(eventLogDir) if re.match("events-\d{8}\.summary$", f))
+
+    for summaryFileName in summaryFileNames:
+
+        baseName = os.path.join(eventLogDir, summaryFileName[:-len(".summary")])
+
+        with open(baseName + ".summary", "r") as fh:
+            summary = json.load(fh)
+
+        if summary["firstTime"] is None or summary["lastTime"] < startTime or summary["firstTime"] > endTime:
+            continue
+
+        if levels and not set(levels) & set(summary["levels"].keys()):
+            continue
+
+        if recipe is not None and not [r for r in summary["recipes"] if recipe in r]:
+            continue
+
+        with open(baseName + ".idx", "rb") as fh:
+            indexData = fh.read()
+
+        numberOfEntries = len(indexData) // indexEntry.size
+        entries = [indexEntry.unpack_from(indexData, i * indexEntry.size) for i in range(numberOfEntries)]
+
+        with open(baseName + ".jsonl", "rb") as fh:
+
+            for minTime, maxTime, offset, numberOfRecords in entries:
+
+                if maxTime < startTime or minTime > endTime:
+                    continue
+
+                fh.seek(offset)
+
+                for _ in range(numberOfRecords):
+
+                    r = json.loads(fh.readline())
+
+                    if recordMatches(r):
+                        yield r
+
+
+def parseTime(timeString):
+
+    for timeFormat in ["%Y%m%d-%H%M%S", "%Y%m%d"]:
+        try:
+            return time.mktime(time.strptime(timeString, timeFormat))
+        except ValueError:
+            continue
+
+    return float(timeString)
+
+
+def formatRecord(r):
+
+    return "{timeStamp} {level:7} PID {PID:<6} {recipe} {command}: {message}".format(
+        timeStamp=time.strftime("%Y%m%d-%H%M%S", time.localtime(r["time"])),
+        level=r["level"], PID=r["PID"], recipe=r["recipe"] or "-", command=r["command"] or "-",
+        message=r["message"])
+
+
+def main(argv=None):
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Query the Measurix event log")
+    parser.add_argument("eventLogDir", help="directory holding the event log segments")
+    parser.add_argument("--from", dest="startTime", type=parseTime, default=None,
+                        help="start of time range (YYYYmmdd, YYYYmmdd-HHMMSS or unix time)")
+    parser.add_argument("--to", dest="endTime", type=parseTime, default=None,
+                        help="end of time range (YYYYmmdd, YYYYmmdd-HHMMSS or unix time)")
+    parser.add_argument("--level", action="append", choices=errorLevels, default=None,
+                        help="only show records with this level, can be given more than once")
+    parser.add_argument("--recipe", default=None, help="only show records of recipes containing this text")
+    parser.add_argument("--command", default=None, help="only show records emitted by this command")
+    parser.add_argument("--json", action="store_true", help="print the records as JSON lines")
+
+    args = parser.parse_args(argv)
+
+    for r in queryEvents(args.eventLogDir, args.startTime, args.endTime, args.level, args.recipe, args.command):
+
+        if args.json:
+            print json.dumps(r)
+        else:
+            print formatRecord(r)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,89 @@
+import os
+import sys
+import json
+import time
+import multiprocessing
+
+import logChannel
+from writeLog import logPrintMessages, closeLogFiles
+
+
+class NullGUI(object):
+    # Stands in for MeasurixGUI when running without a display. It has the same public interface, but does not
+    # start a process: plot requests are dropped, or appended to plotRequests.jsonl in the output directory of
+    # the running recipe when recordPlots is set, and log records are printed to the terminal and written to the
+    # log file.
+
+    def __init__(self, measurixProgram=None, recordPlots=False):
+
+        self.systemState = measurixProgram.systemState if measurixProgram else None
+        self.recordPlots = recordPlots
+        self.recordDirectory = None
+
+        self.logFile = self.systemState["logFile"] if self.systemState else None
+        self.eventLogDir = self.systemState.get("eventLogDir", None) if self.systemState else None
+
+        self.parentConnection, self.childConnection = multiprocessing.Pipe()
+
+        # Records logged by the program process itself do not need to go through the log channel queue
+        if logChannel.channel is not None:
+            logChannel.channel.setLocalHandler(self._handleLogRecords)
+
+    ######################################## Public interface ########################################
+
+    def start(self):
+        pass
+
+    def quit(self):
+
+        self.printLogRecords()
+        closeLogFiles()
+
+    def sendSignal(self, message):
+        pass  # there is nobody to show plots to
+
+    def receiveSignal(self):
+
+        msg = None
+        if self.parentConnection.poll():
+            msg = self.parentConnection.recv()
+
+        return msg
+
+    def postSignal(self, message):
+        # Queue a message for the program as if it came from the GUI, e.g. {"type": "quit"}
+        self.childConnection.send(message)
+
+    def setRecordDirectory(self, directory):
+        # Command processes started after this call inherit the directory
+        self.recordDirectory = directory
+
+    def addRealTimePlot(self, dataSource):
+
+        if not self.recordPlots or not self.recordDirectory:
+            return
+
+        record = {"time": time.time(), "requesterPid": os.getpid(), "data": dataSource}
+
+        with open(os.path.join(self.recordDirectory, "plotRequests.jsonl"), "a") as fh:
+            fh.write(json.dumps(record) + "\n")
+
+    def printLogRecords(self):
+
+        self._handleLogRecords(logChannel.drain())
+
+    def _handleLogRecords(self, records):
+
+        records = [record for record in records if record["message"].strip() != ""]
+
+        if not records:
+            return
+
+        for record in records:
+            sys.stdout.write("%s: %s: %s\n" % (time.strftime("%Y%m%d-%H%M%S", time.localtime(record["time"])),
+                                               record["level"], record["message"].strip()))
+
+        sys.stdout.flush()
+
+        if self.logFile:
+            logPrintMessages(records, self.logFile, self.eventLogDir)
@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import fcntl
+import tempfile
+import contextlib
+
+# A job is a recipe file together with the answers to the unknowns in its output directory. The queue is kept in
+# a JSON file, so jobs survive a restart of the software and can be added by the GUI and the command line at the
+# same time. Every access takes an exclusive lock on <queueFile>.lock and the file is replaced atomically.
+#
+# Status of a job:
+#   queued -> running -> done | failed | aborted
+#   queued -> cancelled
+#   running -> interrupted (the program running it died)
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+ABORTED = "aborted"
+CANCELLED = "cancelled"
+INTERRUPTED = "interrupted"
+
+finishedStatuses = [DONE, FAILED, ABORTED, CANCELLED, INTERRUPTED]
+
+
+def processIsAlive(pid):
+
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+
+    return True
+
+
+class jobQueue(object):
+    def __init__(self, queueFile):
+
+        self.queueFile = queueFile
+        self.lockFile = queueFile + ".lock"
+
+        queueDir = os.path.dirname(os.path.realpath(queueFile))
+
+        if not os.path.exists(queueDir):
+            os.makedirs(queueDir)
+
+    @contextlib.contextmanager
+    def _locked(self):
+
+        with open(self.lockFile, "a") as fh:
+
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+
+            try:
+                yield
+            finally:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+
+    def _load(self):
+
+        if not os.path.exists(self.queueFile):
+            return {"nextId": 1, "jobs": []}
+
+        with open(self.queueFile, "r") as fh:
+            return json.load(fh)
+
+    def _save(self, queue):
+
+        # Write next to the queue file and rename, a crash never leaves a half written queue behind
+        fd, tempFileName = tempfile.mkstemp(dir=os.path.dirname(os.path.realpath(self.queueFile)),
+                                            prefix=".jobQueue")
+
+        with os.fdopen(fd, "w") as fh:
+            json.dump(queue, fh, indent=1)
+
+        os.rename(tempFileName, self.queueFile)
+
+    def _findJob(self, queue, jobId):
+
+        for job in queue["jobs"]:
+            if job["id"] == jobId:
+                return job
+
+        return None
+
+    def add(self, recipeFileName, answers=None):
+
+        with self._locked():
+
+            queue = self._load()
+
+            job = {"id": queue["nextId"],
+                   "recipe": os.path.realpath(recipeFileName),
+                   "answers": answers if answers else dict(),
+                   "status": QUEUED,
+                   "timeQueued": time.time(),
+                   "timeStarted": None,
+                   "timeFinished": None,
+                   "durationInS": None,
+                   "outputDir": None,
+                   "result": None,
+                   "PID": None}
+
+            queue["nextId"] += 1
+            queue["jobs"].append(job)
+            self._save(queue)
+
+        return job
+
+    def jobs(self, status=None):
+
+        with self._locked():
+            queue = self._load()
+
+        return [job for job in queue["jobs"] if status is None or job["status"] == status]
+
+    def claimNext(self):
+
+        # Mark the first queued job as running and return it. Returns None if nothing is queued
+        with self._locked():
+
+            queue = self._load()
+
+            for job in queue["jobs"]:
+
+                if job["status"] != QUEUED:
+                    continue
+
+                job["status"] = RUNNING
+                job["timeStarted"] = time.time()
+                job["PID"] = os.getpid()
+                self._save(queue)
+
+                return job
+
+        return None
+
+    def update(self, jobId, **fields):
+
+        with self._locked():
+
+            queue = self._load()
+            job = self._findJob(queue, jobId)
+
+            if job is None:
+                return None
+
+            job.update(fields)
+            self._save(queue)
+
+        return job
+
+    def finish(self, jobId, status, result=None):
+
+        tNow = time.time()
+
+        with self._locked():
+
+            queue = self._load()
+            job = self._findJob(queue, jobId)
+
+            if job is None:
+                return None
+
+            job["status"] = status
+            job["result"] = result
+            job["timeFinished"] = tNow
+
+            if job["timeStarted"]:
+                job["durationInS"] = tNow - job["timeStarted"]
+
+            self._save(queue)
+
+        return job
+
+    def cancel(self, jobId):
+
+        with self._locked():
+
+            queue = self._load()
+            job = self._findJob(queue, jobId)
+
+            if job is None:
+                return "error: no job %s in the queue" % jobId
+
+            if job["status"] != QUEUED:
+                return "error: job %s is %s and can not be cancelled" % (jobId, job["status"])
+
+            job["status"] = CANCELLED
+            job["timeFinished"] = time.time()
+            self._save(queue)
+
+        return "OK"
+
+    def clearFinished(self):
+
+        with self._locked():
+
+            queue = self._load()
+            numberOfJobs = len(queue["jobs"])
+            queue["jobs"] = [job for job in queue["jobs"] if job["status"] not in finishedStatuses]
+            self._save(queue)
+
+        return numberOfJobs - len(queue["jobs"])
+
+    def recoverInterrupted(self):
+
+        # Jobs left running by a program that is no longer alive will never finish
+        recovered = []
+
+        with self._locked():
+
+            queue = self._load()
+
+            for job in queue["jobs"]:
+
+                if job["status"] == RUNNING and not (job["PID"] and processIsAlive(job["PID"])):
+                    job["status"] = INTERRUPTED
+                    job["result"] = "the program running the job stopped"
+                    recovered.append(job)
+
+            if recovered:
+                self._save(queue)
+
+        return recovered
+
+
+def formatJob(job):
+
+    def formatTime(t):
+        return time.strftime("%Y%m%d-%H%M%S", time.localtime(t)) if t else "-"
+
+    answers = ", ".join("%s=%s" % (k, v) for k, v in sorted(job["answers"].items()))
+    duration = "%.1f s" % job["durationInS"] if job["durationInS"] is not None else "-"
+
+    line = "%4i %-11s %s  queued %s  started %s  took %s" % (job["id"], job["status"],
+                                                           os.path.basename(job["recipe"]),
+                                                           formatTime(job["timeQueued"]),
+                                                           formatTime(job["timeStarted"]), duration)
+
+    if answers:
+        line += "  [%s]" % answers
+
+    if job["result"] and job["result"] != "OK":
+        line += "  %s" % job["result"]
+
+    return line
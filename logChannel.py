@@ -0,0 +1,197 @@
+import os
+import time
+import threading
+import multiprocessing
+import multiprocessing.util
+from Queue import Empty
+
+import eventLog
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+levelNames = {DEBUG: "debug", INFO: "info", WARNING: "warning", ERROR: "error"}
+levelNumbers = dict((name, number) for number, name in levelNames.items())
+
+
+class logChannel(object):
+    def __init__(self, maxBatchSize=100, flushIntervalInS=0.2):
+
+        # Records are not put on the queue one by one. Every process collects its records in a buffer which is
+        # put on the queue as a single batch when it holds maxBatchSize records, when the oldest record in the
+        # buffer is older than flushIntervalInS or when a record of level warning or higher is logged.
+        self.queue = multiprocessing.Queue()
+        self.maxBatchSize = maxBatchSize
+        self.flushIntervalInS = flushIntervalInS
+
+        # Records emitted by the process reading the queue can be handed to a local handler directly
+        self.localHandler = None
+        self.localHandlerPid = None
+
+        self._reset()
+        multiprocessing.util.register_after_fork(self, logChannel._reset)
+
+    def setLocalHandler(self, handler):
+
+        # handler is called with a list of records for every record emitted by the calling process
+        self.localHandler = handler
+        self.localHandlerPid = os.getpid()
+
+    def _reset(self):
+
+        # Called on creation and in every child process created by multiprocessing. Threads and locks are not
+        # carried over by a fork, so every process gets a buffer, lock and flush thread of its own
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.flushThread = None
+
+        # Records still in the buffer need to be put on the queue before the process exits. The queue finalizers
+        # closing the queue and joining its feeder thread have a lower exit priority (10 and -5), so they run
+        # after this one.
+        multiprocessing.util.Finalize(self, logChannel.flush, args=(self,), exitpriority=20)
+
+    def _startFlushThread(self):
+
+        self.flushThread = threading.Thread(target=self._flushPeriodically)
+        self.flushThread.daemon = True
+        self.flushThread.start()
+
+    def _flushPeriodically(self):
+
+        while True:
+            time.sleep(self.flushIntervalInS)
+            self.flush()
+
+    def emit(self, record):
+
+        if self.localHandler is not None and self.localHandlerPid == os.getpid():
+            self.localHandler([record])
+            return
+
+        with self.lock:
+            self.buffer.append(record)
+            bufferFull = len(self.buffer) >= self.maxBatchSize
+
+        if bufferFull or record["levelNumber"] >= WARNING:
+            self.flush()
+        elif self.flushThread is None:
+            self._startFlushThread()
+
+    def flush(self):
+
+        with self.lock:
+            batch = self.buffer
+            self.buffer = []
+
+        if batch:
+            self.queue.put(batch)
+
+    def fileno(self):
+        return self.queue._reader.fileno()
+
+    def drain(self):
+
+        records = []
+
+        while True:
+            try:
+                records.extend(self.queue.get(False))
+            except Empty:
+                break
+
+        return records
+
+
+channel = None
+minimumLevel = INFO
+
+
+def initialise(level="info", **kwargs):
+
+    global channel
+
+    channel = logChannel(**kwargs)
+    setLevel(level)
+
+    return channel
+
+
+def _emit(levelNumber, msg, args):
+
+    if args:
+        msg = msg % args
+
+    # Many functions return messages like "error: ...", don't repeat the level if such a message is logged as is
+    level, text = eventLog.splitLevelFromMessage(msg)
+
+    if level == levelNames[levelNumber]:
+        msg = text
+
+    record = eventLog.makeRecord(msg, level=levelNames[levelNumber])
+    record["levelNumber"] = levelNumber
+
+    if channel is None:  # nobody is listening, e.g. in command line tools
+        print "%s: %s" % (record["level"], record["message"])
+        return
+
+    channel.emit(record)
+
+
+def _discard(msg, *args):
+    pass
+
+
+def log(levelNumber, msg, *args):
+
+    if levelNumber < minimumLevel:
+        return
+
+    _emit(levelNumber, msg, args)
+
+
+def _makeLogFunction(levelNumber):
+
+    def logFunction(msg, *args):
+        _emit(levelNumber, msg, args)
+
+    logFunction.__name__ = levelNames[levelNumber]
+
+    return logFunction
+
+
+_logFunctions = dict((levelNumber, _makeLogFunction(levelNumber)) for levelNumber in levelNames)
+
+
+def setLevel(level):
+
+    # Log functions of disabled levels are replaced by a function doing nothing, so e.g. a debug call costs no
+    # more than a function call when debug output is disabled. Formatting is only done for enabled levels.
+    # The level is inherited by processes started after calling this function.
+    global minimumLevel, debug, info, warning, error
+
+    if isinstance(level, basestring):
+        level = levelNumbers[level.lower()]
+
+    minimumLevel = level
+
+    debug, info, warning, error = [_logFunctions[n] if n >= minimumLevel else _discard
+                                   for n in [DEBUG, INFO, WARNING, ERROR]]
+
+
+def isEnabledFor(level):
+    return level >= minimumLevel
+
+
+def flush():
+
+    if channel is not None:
+        channel.flush()
+
+
+def drain():
+    return channel.drain() if channel is not None else []
+
+
+setLevel(minimumLevel)
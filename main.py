@@ -1,18 +1,25 @@
 import multiprocessing
 import time
+import devicePool
 import iniReader
-from MeasurixGUI import MeasurixGUI
+import jobQueue
+import logChannel
+import metrics
+import outputArchiver
 import os
+import writeLog
+from readRecipe import MeasurixRecipe
 
 softwareVersion = "V01-00"
 
 
 class MeasurixProgram():
-    def __init__(self, iniFile):
+    def __init__(self, iniFile, headless=False, recordPlots=False):
 
         self.softwareVersion = softwareVersion
 
         self.initError = False
+        self.headless = headless
 
         mgr = multiprocessing.Manager()
         self.systemState = mgr.dict()
@@ -20,21 +27,59 @@ class MeasurixProgram():
         readIniResult = iniReader.loadInitialSystemState(iniFile, self.systemState)
 
         if readIniResult.startswith("NOK"):
-            print "Error: INI file not OK: %s" % readIniResult
+            logChannel.error("INI file not OK: %s", readIniResult)
             self.initError = True
             return
 
+        # The log channel needs to exist before the GUI and command processes are started, so they inherit it
+        logChannel.initialise(self.systemState.get("logLevel", "info"))
+
+        # The same goes for the shared memory holding the metrics. When disabled, reporting a metric does nothing
+        metrics.initialise(enabled=self.systemState.get("metricsEnabled", 0))
+
+        # Devices stay open between the steps of a recipe and between recipes
+        self.devicePool = devicePool.devicePool()
+
         self.logFile = self.systemState["logFile"]
         self.recipeFolder = self.systemState["recipeFolder"]
         self.outputDirRoot = self.systemState["outputDir"]
 
-        self.GUI = MeasurixGUI(self)
+        # Copies of the recipes are shared between the output directories. After a run, the frames are optionally
+        # archived, raw captures are converted to HDF5 and the logs of the devices are merged in the background
+        recipeStoreDir = self.systemState.get("recipeStoreDir", os.path.join(self.outputDirRoot, ".recipeStore"))
+        self.archiver = outputArchiver.outputArchiver(recipeStoreDir,
+                                                      consolidateFrames=self.systemState.get("consolidateFrames", 0),
+                                                      convertRawCaptures=self.systemState.get("convertRawCaptures", 1),
+                                                      mergeAcquisition=self.systemState.get("mergeAcquisition", 1))
+
+        # Recipes queued from the GUI or the command line, run back to back while runQueue is set
+        queueFile = self.systemState.get("jobQueueFile", os.path.join(os.path.dirname(self.logFile), "jobQueue.json"))
+        self.jobQueue = jobQueue.jobQueue(queueFile)
+        self.runQueue = False
+        self.currentJob = None
+
+        for job in self.jobQueue.recoverInterrupted():
+            logChannel.warning("job %i (%s) was interrupted", job["id"], os.path.basename(job["recipe"]))
+
+            # Data the job logged but did not write to its log files yet
+            if job["outputDir"]:
+                writeLog.replayJournals(job["outputDir"])
+
+        if headless:
+            from headless import NullGUI
+            self.GUI = NullGUI(self, recordPlots=recordPlots)
+        else:
+            from MeasurixGUI import MeasurixGUI
+            self.GUI = MeasurixGUI(self)
+
         self.GUI.start()
 
         self.quit = False
+        self.quitWhenIdle = False  # used when running recipes from the command line
         self.recipe = None
+        self.lastRecipeResult = None
 
-        print "info: Started Measurix software"
+        logChannel.info("Started Measurix software")
 
     def mainLoop(self):
 
@@ -42,17 +87,41 @@ class MeasurixProgram():
 
         while not self.quit:
 
-            select.select([self.GUI.parentConnection], [], [], 1.0)
+            # Wake up as soon as the GUI or one of the commands of the running recipe has something to say
+            readables = [self.GUI.parentConnection]
+
+            if self.recipe and self.recipe.messageQueue:
+                readables.append(self.recipe.messageQueue._reader)
+
+            if self.headless:
+                readables.append(logChannel.channel.fileno())
+
+            select.select(readables, [], [], 1.0)
+
+            if self.headless:
+                self.GUI.printLogRecords()
 
             self.handleUserInput()
+            self.archiver.poll()
 
             if self.recipe:
                 self.recipe.process()
 
                 if self.recipe.done:
-                    print "info: Recipe successfully executed"
-                    self.recipe = None
 
+                    if not self.recipe.aborted:
+                        logChannel.info("Recipe successfully executed")
+
+                    self._recipeFinished(jobQueue.FAILED if self.recipe.aborted else jobQueue.DONE)
+
+            if self.runQueue and not self.recipe:
+                self.startNextJob()
+
+            if self.quitWhenIdle and not self.recipe and not self.runQueue:
+                self.quit = True
+
+        self.devicePool.closeAll()
+        self.archiver.join()
         self.GUI.quit()
 
         return
@@ -64,82 +133,193 @@ class MeasurixProgram():
         if not msg:
             return
 
+        # The GUI only sends the file name of a recipe, the recipe is read here
         if msg["type"] == "execute":
 
-            if self.recipe:
-                print "error: can't start recipe when one is already running"
-                return
-
-            self.recipe = msg["recipe"]
-
-            if "outputDir" in self.recipe.recipeInfo.keys():
-                outputDir = self.recipe.recipeInfo["outputDir"]
-            else:
-                outputDir = ""
-
-            if not os.path.exists(outputDir) and outputDir != "":
+            result, recipe = self.loadRecipe(msg["recipeFileName"], msg["answers"])
 
-                try:
-                    os.mkdir(outputDir)
-                    recipeFileName = self.recipe.recipeInfo["recipeFileName"]
-                    recipeBaseName = os.path.basename(recipeFileName)
-                    copyOfRecipe = os.path.join(outputDir, recipeBaseName)
-
-                    os.system("cp \"{recipeFileName}\" \"{copyOfRecipe}\"".format(recipeFileName=recipeFileName,
-                                                                                  copyOfRecipe=copyOfRecipe))
-
-                except OSError:
-                    print("error: Do not have permissions to create %s" % outputDir)
-                    self.recipe = None
-                    return
-
-            msg = self.recipe.start(self)
+            if result != "OK":
+                logChannel.error(result)
+                return
 
-            if msg != "OK":
-                print "error: Recipe error: %s" % msg
-                self.recipe = None
+            self.startRecipe(recipe)
 
         elif msg["type"] == "check":
 
-            checkResult = msg["recipe"].check(self)
+            recipe = MeasurixRecipe(msg["recipeFileName"], self.systemState)
+            checkResult = recipe.init
+
+            if checkResult == "OK":
+                checkResult = recipe.check(self)
 
             if checkResult == "OK":
-                print"info: Recipe is ok"
+                logChannel.info("Recipe is ok")
             else:
-                print "error: %s" % checkResult
+                logChannel.error(checkResult)
 
         elif msg["type"] == "regenerateFinalReport":
 
             if self.recipe:
-                print "error: can't regenerate a report while a recipe is running"
+                logChannel.error("can't regenerate a report while a recipe is running")
                 return
 
-            self.recipe = msg["recipe"]
+            recipe = MeasurixRecipe(msg["recipeFileName"], self.systemState, ignoreTimeStampInRecipeInfo=True)
+
+            if recipe.init != "OK":
+                logChannel.error(recipe.init)
+                return
+
+            recipe.addInfoToRecipe(msg["info"])
+            recipe.setOutputDirectory(msg["outputDir"])
+
+            self.recipe = recipe
             result = self.recipe.regenerateFinalReport(self)
 
             if result != "OK":
-                print "error: %s" % result
+                logChannel.error(result)
                 self.recipe = None
 
         elif msg["type"] == "abort":
 
             if not self.recipe:
-                print "error: can't abort recipe when none is running"
+                logChannel.error("can't abort recipe when none is running")
             else:
-                print "info: Aborting recipe"
+                logChannel.info("Aborting recipe")
                 self.recipe.abort(exception=False)
-                self.recipe = None
+                self._recipeFinished(jobQueue.ABORTED)
+
+                # Do not start the next job behind the back of the operator who just aborted this one
+                if self.runQueue:
+                    logChannel.info("job queue paused")
+                    self.runQueue = False
+
+        elif msg["type"] == "queueAdd":
+
+            job = self.jobQueue.add(msg["recipeFileName"], msg["answers"])
+            logChannel.info("job %i added to the queue: %s", job["id"], os.path.basename(job["recipe"]))
+
+        elif msg["type"] == "queueRun":
+
+            logChannel.info("running the job queue")
+            self.runQueue = True
+
+        elif msg["type"] == "queuePause":
+
+            if self.runQueue:
+                logChannel.info("job queue paused, the running recipe will finish")
+
+            self.runQueue = False
 
         elif msg["type"] == "quit":
 
             if not self.recipe:
-                print "info: quitting Measurix software"
+                logChannel.info("quitting Measurix software")
                 self.quit = True
             else:
-                print "error: can't quit while recipe is running"
+                logChannel.error("can't quit while recipe is running")
 
         return
 
+    def startRecipe(self, recipe):
+
+        if self.recipe:
+            logChannel.error("can't start recipe when one is already running")
+            return "error: a recipe is already running"
+
+        self.recipe = recipe
+
+        if "outputDir" in self.recipe.recipeInfo.keys():
+            outputDir = self.recipe.recipeInfo["outputDir"]
+        else:
+            outputDir = ""
+
+        if not os.path.exists(outputDir) and outputDir != "":
+
+            try:
+                os.makedirs(outputDir)
+            except OSError:
+                logChannel.error("Do not have permissions to create %s", outputDir)
+                self.recipe = None
+                return "error: no permission to create %s" % outputDir
+
+            try:
+                self.archiver.storeRecipe(self.recipe.recipeInfo["recipeFileName"], outputDir)
+            except (IOError, OSError), e:
+                logChannel.warning("could not copy the recipe to %s: %s", outputDir, e)
+
+        if self.headless:
+            self.GUI.setRecordDirectory(outputDir)
+
+        msg = self.recipe.start(self)
+
+        if msg != "OK":
+            logChannel.error("Recipe error: %s", msg)
+            self.recipe = None
+            self.lastRecipeResult = msg
+
+        return msg
+
+    def loadRecipe(self, recipeFileName, answers):
+
+        # Returns "OK" and the recipe ready to be started, or an error message and None
+        recipe = MeasurixRecipe(recipeFileName, self.systemState)
+
+        if recipe.init != "OK":
+            return recipe.init, None
+
+        result = recipe.prepareForExecution(answers)
+
+        if result != "OK":
+            return result, None
+
+        return "OK", recipe
+
+    def startNextJob(self):
+
+        job = self.jobQueue.claimNext()
+
+        if job is None:
+            logChannel.info("job queue is empty")
+            self.runQueue = False
+            return None
+
+        logChannel.info("starting job %i: %s", job["id"], os.path.basename(job["recipe"]))
+
+        result, recipe = self.loadRecipe(job["recipe"], job["answers"])
+
+        if result != "OK":
+            logChannel.error("job %i: %s", job["id"], result)
+            self.jobQueue.finish(job["id"], jobQueue.FAILED, result)
+            return None
+
+        self.currentJob = job
+        result = self.startRecipe(recipe)  # logs the reason if the recipe does not start
+
+        if result != "OK":
+            self.jobQueue.finish(job["id"], jobQueue.FAILED, result)
+            self.currentJob = None
+            return None
+
+        self.jobQueue.update(job["id"], outputDir=recipe.recipeInfo["outputDir"])
+
+        return job
+
+    def _recipeFinished(self, jobStatus):
+
+        self.lastRecipeResult = "aborted" if self.recipe.aborted else "OK"
+
+        # A command that was killed leaves the journal of its data logger behind
+        writeLog.replayJournals(self.recipe.recipeInfo.get("outputDir", ""))
+
+        self.archiver.submit(self.recipe.recipeInfo.get("outputDir", ""))
+
+        if self.currentJob:
+            job = self.jobQueue.finish(self.currentJob["id"], jobStatus, self.lastRecipeResult)
+            logChannel.info("job %i %s after %.1f s", job["id"], jobStatus, job["durationInS"])
+            self.currentJob = None
+
+        self.recipe = None
+
 
 def main():
     thisFileName = os.path.realpath(__file__)
@@ -147,11 +327,11 @@ def main():
     iniFile = os.path.join(os.path.dirname(thisFileName), "measurix.ini")
 
     if not os.path.exists(iniFile):
-        print "No INI file found!"
+        logChannel.error("No INI file found!")
         time.sleep(10.0)
         return
 
-    print "using INI file ", iniFile
+    logChannel.info("using INI file %s", iniFile)
 
     program = MeasurixProgram(iniFile)
 
@@ -0,0 +1,418 @@
+import os
+import sys
+import argparse
+
+import logChannel
+
+thisDir = os.path.dirname(os.path.realpath(__file__))
+defaultIniFile = os.path.join(thisDir, "measurix.ini")
+
+
+def parseAnswer(answerString):
+
+    # e.g. "serial number=1234" -> ("serial number", "1234")
+    if "=" not in answerString:
+        raise argparse.ArgumentTypeError("answer %s not in the format 'name=value'" % answerString)
+
+    name, value = answerString.split("=", 1)
+
+    return name.strip(), value.strip()
+
+
+def makeProgram(iniFile, recordPlots=False):
+
+    from main import MeasurixProgram
+
+    if not os.path.exists(iniFile):
+        logChannel.error("No INI file found at %s", iniFile)
+        return None
+
+    program = MeasurixProgram(iniFile, headless=True, recordPlots=recordPlots)
+
+    if program.initError:
+        return None
+
+    return program
+
+
+def loadSettings(iniFile):
+
+    import iniReader
+
+    settings = dict()
+    result = iniReader.loadInitialSystemState(iniFile, settings)
+
+    if result != "OK":
+        logChannel.error("INI file not OK: %s", result)
+        return None
+
+    return settings
+
+
+def openJobQueue(settings):
+
+    import jobQueue
+
+    queueFile = settings.get("jobQueueFile", os.path.join(os.path.dirname(settings["logFile"]), "jobQueue.json"))
+
+    return jobQueue.jobQueue(queueFile)
+
+
+def runRecipe(args):
+
+    program = makeProgram(args.ini, recordPlots=args.record_plots)
+
+    if program is None:
+        return 2
+
+    import recipeCatalog
+
+    recipeFileName = recipeCatalog.resolveRecipe(args.recipe, program.systemState)
+
+    if recipeFileName is None:
+        logChannel.error("no recipe %s", args.recipe)
+        program.GUI.quit()
+        return 2
+
+    result, recipe = program.loadRecipe(recipeFileName, dict(args.answer or []))
+
+    if result != "OK":
+        logChannel.error(result)
+        program.GUI.quit()
+        return 2
+
+    if program.startRecipe(recipe) != "OK":  # the reason has been logged already
+        program.GUI.quit()
+        return 2
+
+    program.quitWhenIdle = True
+
+    try:
+        program.mainLoop()
+    except KeyboardInterrupt:
+        logChannel.info("Aborting recipe")
+        if program.recipe:
+            program.recipe.abort(exception=False)
+        program.GUI.quit()
+        return 1
+
+    return 0 if program.lastRecipeResult == "OK" else 1
+
+
+def queueAdd(args):
+
+    import recipeCatalog
+    from readRecipe import MeasurixRecipe
+
+    settings = loadSettings(args.ini)
+
+    if settings is None:
+        return 2
+
+    recipeFileName = recipeCatalog.resolveRecipe(args.recipe, settings)
+
+    if recipeFileName is None:
+        logChannel.error("no recipe %s", args.recipe)
+        return 2
+
+    # Check the recipe and the answers now, rather than finding out when the job is started
+    recipe = MeasurixRecipe(recipeFileName, settings)
+    result = recipe.init
+
+    if result == "OK":
+        result = recipe.prepareForExecution(dict(args.answer or []))
+
+    if result != "OK":
+        logChannel.error(result)
+        return 2
+
+    job = openJobQueue(settings).add(recipeFileName, dict(args.answer or []))
+    print "added job %i" % job["id"]
+
+    return 0
+
+
+def queueList(args):
+
+    import json
+    import jobQueue
+
+    settings = loadSettings(args.ini)
+
+    if settings is None:
+        return 2
+
+    jobs = openJobQueue(settings).jobs()
+
+    if args.json:
+        print json.dumps(jobs, indent=1)
+    else:
+        for job in jobs:
+            print jobQueue.formatJob(job)
+
+    return 0
+
+
+def queueCancel(args):
+
+    settings = loadSettings(args.ini)
+
+    if settings is None:
+        return 2
+
+    result = openJobQueue(settings).cancel(args.job)
+
+    if result != "OK":
+        logChannel.error(result)
+        return 1
+
+    return 0
+
+
+def queueClear(args):
+
+    settings = loadSettings(args.ini)
+
+    if settings is None:
+        return 2
+
+    print "removed %i finished jobs" % openJobQueue(settings).clearFinished()
+
+    return 0
+
+
+def queueRun(args):
+
+    import jobQueue
+
+    program = makeProgram(args.ini, recordPlots=args.record_plots)
+
+    if program is None:
+        return 2
+
+    program.runQueue = True
+    program.quitWhenIdle = True
+
+    try:
+        program.mainLoop()
+    except KeyboardInterrupt:
+        logChannel.info("Aborting recipe")
+        if program.recipe:
+            program.recipe.abort(exception=False)
+            program._recipeFinished(jobQueue.ABORTED)
+        program.GUI.quit()
+        return 1
+
+    # Jobs claimed by this process which did not finish successfully
+    failed = [job for job in program.jobQueue.jobs() if job["PID"] == os.getpid() and job["status"] != jobQueue.DONE]
+
+    return 1 if failed else 0
+
+
+def validateRecipes(args):
+
+    import time
+    import json
+    import recipeCatalog
+    import recipeValidator
+
+    settings = loadSettings(args.ini)
+
+    if settings is None:
+        return 2
+
+    catalog = recipeCatalog.recipeCatalog(settings["recipeFolder"], recipeCatalog.catalogIndexFile(settings))
+    catalog.close()
+
+    if args.recipe:
+        recipeFileNames = [recipeCatalog.resolveRecipe(spec, settings) for spec in args.recipe]
+        unknown = [spec for spec, fileName in zip(args.recipe, recipeFileNames) if fileName is None]
+
+        if unknown:
+            logChannel.error("no recipe %s", ", ".join(unknown))
+            return 2
+    else:
+        recipeFileNames = catalog.fileNames()
+
+    t0 = time.time()
+    results = recipeValidator.validateRecipes(recipeFileNames, settings, args.jobs, useCache=not args.no_cache)
+    timeInS = time.time() - t0
+
+    for result in results:
+        catalog.setValidation(result["recipe"], result["result"], save=False)
+
+    catalog.save()
+
+    print recipeValidator.formatReport(results, timeInS)
+
+    if args.report:
+        with open(args.report, "w") as fh:
+            json.dump({"time": time.time(), "timeInS": timeInS, "results": results}, fh, indent=1)
+
+    return 0 if all(result["result"] == "OK" for result in results) else 1
+
+
+def tailLog(args):
+
+    import json
+    import writeLog
+
+    tail = writeLog.dataLogTail(args.logFile, args.key, fromStart=args.from_start)
+    header = None
+
+    try:
+        for setName, lines in tail.follow(args.interval, args.timeout):
+
+            keys = sorted(lines.keys())
+
+            for i in range(len(lines[keys[0]])):
+
+                if args.json:
+                    print json.dumps(dict([("set", setName)] + [(k, float(lines[k][i])) for k in keys]))
+                    continue
+
+                if keys != header:
+                    header = keys
+                    print "\t".join(["set"] + keys)
+
+                print "\t".join([setName] + ["%g" % lines[k][i] for k in keys])
+
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+def convertCaptures(args):
+
+    import rawCapture
+
+    if os.path.isdir(args.path):
+        numberConverted = rawCapture.convertRawCaptures(args.path, removeRawCaptures=args.remove)
+        print "%i raw captures converted" % numberConverted
+        return 0
+
+    try:
+        numberOfRecords = rawCapture.convertRawCapture(args.path, removeRawCapture=args.remove)
+    except (IOError, OSError, ValueError), e:
+        logChannel.error("could not convert %s: %s", args.path, e)
+        return 1
+
+    print "%i records converted to %s" % (numberOfRecords, os.path.splitext(args.path)[0] + ".h5")
+
+    return 0
+
+
+def mergeAcquisition(args):
+
+    import acquisition
+
+    logFileNames = acquisition.timeStampedLogs(args.outputDir)
+
+    if len(logFileNames) < 2:
+        logChannel.error("%s has %i logs with time stamps, at least two are needed", args.outputDir,
+                         len(logFileNames))
+        return 1
+
+    mergedFileName = os.path.join(args.outputDir, acquisition.mergedLogName)
+
+    try:
+        numberOfLines = acquisition.mergeLogs(logFileNames, mergedFileName, args.rate)
+    except (IOError, OSError, KeyError, ValueError), e:
+        logChannel.error("could not merge the logs in %s: %s", args.outputDir, e)
+        return 1
+
+    print "%i logs merged into %s (%i lines)" % (len(logFileNames), mergedFileName, numberOfLines)
+
+    return 0
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(prog="python -m measurix", description="Measurix command line interface")
+    parser.add_argument("--ini", default=defaultIniFile, help="INI file (default: %(default)s)")
+
+    subParsers = parser.add_subparsers(dest="command")
+
+    runParser = subParsers.add_parser("run", help="run a recipe without the GUI")
+    runParser.add_argument("recipe", help="recipe zip file, or <name>[@<version>] from the recipe folder")
+    runParser.add_argument("--answer", action="append", type=parseAnswer, default=None, metavar="NAME=VALUE",
+                           help="answer to an unknown in the output directory, e.g. --answer \"serial number=12\"")
+    runParser.add_argument("--record-plots", action="store_true",
+                           help="save the plot requests of the commands to plotRequests.jsonl in the output directory")
+    runParser.set_defaults(function=runRecipe)
+
+    queueParser = subParsers.add_parser("queue", help="manage and run the job queue")
+    queueSubParsers = queueParser.add_subparsers(dest="queueCommand")
+
+    addParser = queueSubParsers.add_parser("add", help="add a recipe to the queue")
+    addParser.add_argument("recipe", help="recipe zip file, or <name>[@<version>] from the recipe folder")
+    addParser.add_argument("--answer", action="append", type=parseAnswer, default=None, metavar="NAME=VALUE",
+                           help="answer to an unknown in the output directory")
+    addParser.set_defaults(function=queueAdd)
+
+    listParser = queueSubParsers.add_parser("list", help="show the jobs in the queue")
+    listParser.add_argument("--json", action="store_true", help="print the jobs as JSON")
+    listParser.set_defaults(function=queueList)
+
+    cancelParser = queueSubParsers.add_parser("cancel", help="cancel a queued job")
+    cancelParser.add_argument("job", type=int, help="job id")
+    cancelParser.set_defaults(function=queueCancel)
+
+    clearParser = queueSubParsers.add_parser("clear", help="remove finished jobs from the queue")
+    clearParser.set_defaults(function=queueClear)
+
+    queueRunParser = queueSubParsers.add_parser("run", help="run all queued jobs without the GUI")
+    queueRunParser.add_argument("--record-plots", action="store_true",
+                                help="save the plot requests of the commands to plotRequests.jsonl")
+    queueRunParser.set_defaults(function=queueRun)
+
+    validateParser = subParsers.add_parser("validate", help="check recipes without touching the hardware")
+    validateParser.add_argument("recipe", nargs="*",
+                                help="recipe zip files or <name>[@<version>] (default: all recipes in the recipe folder)")
+    validateParser.add_argument("--jobs", type=int, default=None, help="number of processes (default: one per CPU)")
+    validateParser.add_argument("--no-cache", action="store_true", help="check every recipe again")
+    validateParser.add_argument("--report", default=None, help="save the results as JSON to this file")
+    validateParser.set_defaults(function=validateRecipes)
+
+    tailParser = subParsers.add_parser("tail", help="print the lines added to an HDF5 data log while it is written")
+    tailParser.add_argument("logFile", help="HDF5 log file, e.g. arduino_log.h5 in the output directory")
+    tailParser.add_argument("--key", action="append", default=None, help="only show this key (can be repeated)")
+    tailParser.add_argument("--from-start", action="store_true", help="print the lines in the file already as well")
+    tailParser.add_argument("--interval", type=float, default=0.2, help="poll interval in s (default: %(default)s)")
+    tailParser.add_argument("--timeout", type=float, default=None,
+                            help="stop when no lines were added for this many seconds (default: follow forever)")
+    tailParser.add_argument("--json", action="store_true", help="print every line as JSON")
+    tailParser.set_defaults(function=tailLog)
+
+    convertParser = subParsers.add_parser("convert", help="convert raw captures to HDF5 log files")
+    convertParser.add_argument("path", help="raw capture (.mxraw) or an output directory with raw captures")
+    convertParser.add_argument("--remove", action="store_true", help="remove the raw captures once converted")
+    convertParser.set_defaults(function=convertCaptures)
+
+    mergeParser = subParsers.add_parser("merge", help="merge the time stamped device logs of a run into one table")
+    mergeParser.add_argument("outputDir", help="output directory of the run")
+    mergeParser.add_argument("--rate", type=float, default=None,
+                             help="sample rate of the merged table in Hz (default: the rate of the fastest device)")
+    mergeParser.set_defaults(function=mergeAcquisition)
+
+    eventsParser = subParsers.add_parser("events", help="query the event log, see eventLog.py --help",
+                                         add_help=False)
+    eventsParser.set_defaults(function=None)
+
+    args, remaining = parser.parse_known_args(argv)
+
+    if args.command == "events":
+        import eventLog
+        eventLog.main(remaining)
+        return 0
+
+    if remaining:
+        parser.error("unrecognized arguments: %s" % " ".join(remaining))
+
+    return args.function(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
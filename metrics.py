@@ -0,0 +1,238 @@
+import os
+import math
+import json
+import time
+import multiprocessing
+import numpy
+
+# Every metric occupies a slot of slotSize doubles in a shared memory array which is created by the program
+# process before any other process is started. All processes inherit the array, so the values reported by
+# the command processes can be read by the GUI and the program without any message passing.
+#
+# Layout of a slot:
+#   kind, count, sum, min, max, last value, histogram buckets
+# Bucket 0 holds values <= bucketBase, bucket i holds values in (bucketBase * 2^(i-1), bucketBase * 2^i]
+COUNTER = 1
+GAUGE = 2
+HISTOGRAM = 3
+
+kindNames = {COUNTER: "counter", GAUGE: "gauge", HISTOGRAM: "histogram"}
+
+KIND, COUNT, SUM, MIN, MAX, LAST = range(6)
+numberOfBuckets = 48
+bucketBase = 1E-6
+slotSize = 6 + numberOfBuckets
+maxNameLength = 64
+
+
+class nullMetric(object):
+    # Handed out when metrics are disabled, so reporting a value costs no more than a method call
+
+    def inc(self, n=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+class metric(object):
+    def __init__(self, store, slot):
+
+        self.values = store.values
+        self.lock = store.lock
+        self.base = slot * slotSize
+
+    def inc(self, n=1):
+
+        b = self.base
+
+        with self.lock:
+            self.values[b + COUNT] += 1
+            self.values[b + SUM] += n
+            self.values[b + LAST] = n
+
+    def set(self, value):
+
+        b = self.base
+
+        with self.lock:
+            self.values[b + COUNT] += 1
+            self.values[b + SUM] += value
+            self.values[b + LAST] = value
+
+            if value < self.values[b + MIN]:
+                self.values[b + MIN] = value
+
+            if value > self.values[b + MAX]:
+                self.values[b + MAX] = value
+
+    def observe(self, value):
+
+        b = self.base
+
+        if value <= bucketBase:
+            bucket = 0
+        else:
+            bucket = min(int(math.ceil(math.log(value / bucketBase, 2))), numberOfBuckets - 1)
+
+        with self.lock:
+            self.values[b + COUNT] += 1
+            self.values[b + SUM] += value
+            self.values[b + LAST] = value
+            self.values[b + 6 + bucket] += 1
+
+            if value < self.values[b + MIN]:
+                self.values[b + MIN] = value
+
+            if value > self.values[b + MAX]:
+                self.values[b + MAX] = value
+
+
+class metricsStore(object):
+    def __init__(self, maxMetrics=256):
+
+        self.maxMetrics = maxMetrics
+
+        self.values = multiprocessing.RawArray("d", maxMetrics * slotSize)
+        self.names = multiprocessing.RawArray("c", maxMetrics * maxNameLength)
+        self.numberOfMetrics = multiprocessing.RawValue("i", 0)
+        self.lock = multiprocessing.Lock()
+
+        # name -> metric object, every process fills its own copy. Slots never move, so entries made before a
+        # fork are still valid in the child process
+        self.metrics = dict()
+
+    def _name(self, slot):
+        return self.names[slot * maxNameLength:(slot + 1) * maxNameLength].rstrip("\0")
+
+    def _findOrAllocate(self, name, kind):
+
+        with self.lock:
+
+            for slot in range(self.numberOfMetrics.value):
+                if self._name(slot) == name:
+                    return slot
+
+            slot = self.numberOfMetrics.value
+
+            if slot >= self.maxMetrics:
+                return None
+
+            self.names[slot * maxNameLength:slot * maxNameLength + len(name)] = name
+            self._clearSlot(slot)
+            self.values[slot * slotSize + KIND] = kind
+            self.numberOfMetrics.value += 1
+
+        return slot
+
+    def _clearSlot(self, slot):
+
+        b = slot * slotSize
+
+        for i in range(COUNT, slotSize):
+            self.values[b + i] = 0.0
+
+        self.values[b + MIN] = float("inf")
+        self.values[b + MAX] = float("-inf")
+
+    def get(self, name, kind):
+
+        if name in self.metrics:
+            return self.metrics[name]
+
+        name = name[:maxNameLength]
+        slot = self._findOrAllocate(name, kind)
+
+        self.metrics[name] = metric(self, slot) if slot is not None else nullMetric()
+
+        return self.metrics[name]
+
+    def reset(self):
+
+        with self.lock:
+            for slot in range(self.numberOfMetrics.value):
+                self._clearSlot(slot)
+
+    def snapshot(self):
+
+        with self.lock:
+            n = self.numberOfMetrics.value
+            values = numpy.frombuffer(self.values, dtype=numpy.float64)[:n * slotSize].reshape(n, slotSize).copy()
+            names = [self._name(slot) for slot in range(n)]
+
+        result = dict()
+        bucketUpperBounds = bucketBase * 2.0 ** numpy.arange(numberOfBuckets)
+
+        for name, row in zip(names, values):
+
+            count = row[COUNT]
+            entry = {"kind": kindNames[int(row[KIND])], "count": count, "sum": row[SUM], "last": row[LAST]}
+
+            if count and row[KIND] != COUNTER:
+                entry.update({"min": row[MIN], "max": row[MAX], "mean": row[SUM] / count})
+
+            if count and row[KIND] == HISTOGRAM:
+
+                cumulative = numpy.cumsum(row[6:])
+
+                for q in [50, 90, 99]:
+                    bucket = numpy.searchsorted(cumulative, count * q / 100.0)
+                    entry["p%i" % q] = min(bucketUpperBounds[bucket], row[MAX])
+
+            result[name] = entry
+
+        return result
+
+
+store = None
+
+
+def initialise(enabled=True, maxMetrics=256):
+
+    global store
+
+    store = metricsStore(maxMetrics) if enabled else None
+
+    return store
+
+
+def counter(name):
+    return store.get(name, COUNTER) if store is not None else nullMetric()
+
+
+def gauge(name):
+    return store.get(name, GAUGE) if store is not None else nullMetric()
+
+
+def histogram(name):
+    return store.get(name, HISTOGRAM) if store is not None else nullMetric()
+
+
+def isEnabled():
+    return store is not None
+
+
+def snapshot():
+    return store.snapshot() if store is not None else dict()
+
+
+def reset():
+
+    if store is not None:
+        store.reset()
+
+
+def dump(outputDir, fileName="metrics.json"):
+
+    if store is None:
+        return None
+
+    metricsFileName = os.path.join(outputDir, fileName)
+
+    with open(metricsFileName, "w") as fh:
+        json.dump({"time": time.time(), "metrics": snapshot()}, fh, indent=1)
+
+    return metricsFileName
@@ -0,0 +1,257 @@
+import os
+import re
+import json
+import time
+import errno
+import shutil
+import struct
+import hashlib
+import zipfile
+import multiprocessing
+
+import logChannel
+import metrics
+
+# Packaging of the output of a recipe:
+#   - the recipe is copied into the output directory when the recipe starts. Recipes are kept once in a store
+#     under the hash of their content and hard linked into the output directories, so running the same recipe
+#     many times stores it once.
+#   - after the run, the loose frame-N.jpeg files written by the webcam can be consolidated into frames.zip in a
+#     background process. The frames are stored uncompressed (they are JPEGs already) and index.json in the
+#     archive gives the offset and size of every frame, so a single frame can be read with one seek.
+#   - raw captures (see rawCapture.py) are converted to HDF5 log files in the same background process.
+frameRegex = re.compile(r"^frame-(\d+)\.jpeg$")
+frameArchiveName = "frames.zip"
+frameIndexName = "index.json"
+progressSteps = 10  # progress is reported every 10 %
+
+
+def fileHash(fileName, blockSize=1 << 20):
+
+    digest = hashlib.sha256()
+
+    with open(fileName, "rb") as fh:
+        for block in iter(lambda: fh.read(blockSize), ""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def linkOrCopy(source, destination):
+
+    try:
+        os.link(source, destination)
+    except OSError, e:
+
+        # e.g. the store is on another file system
+        if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+            raise
+
+        shutil.copyfile(source, destination)
+
+
+def storeRecipe(recipeFileName, outputDir, storeDir):
+
+    storedFileName = os.path.join(storeDir, fileHash(recipeFileName) + ".zip")
+
+    if not os.path.exists(storedFileName):
+
+        if not os.path.exists(storeDir):
+            os.makedirs(storeDir)
+
+        temporaryFileName = "%s.%i.part" % (storedFileName, os.getpid())
+        shutil.copyfile(recipeFileName, temporaryFileName)
+        os.chmod(temporaryFileName, 0444)  # all output directories share this file, nobody should change it
+        os.rename(temporaryFileName, storedFileName)
+
+    copyOfRecipe = os.path.join(outputDir, os.path.basename(recipeFileName))
+
+    if not os.path.exists(copyOfRecipe):
+        linkOrCopy(storedFileName, copyOfRecipe)
+
+    return copyOfRecipe
+
+
+def _dataOffset(fh, info):
+
+    # The data of a member follows its local header, of which the extra field can differ from the central directory
+    fh.seek(info.header_offset)
+    nameLength, extraLength = struct.unpack("<HH", fh.read(30)[26:30])
+
+    return info.header_offset + 30 + nameLength + extraLength
+
+
+def consolidateFrames(framesDir, archiveFileName, progress=None):
+
+    # Returns the number of frames archived. The loose frames are only removed once the archive is complete
+    frameNumbers = dict()
+
+    for name in os.listdir(framesDir):
+
+        m = frameRegex.match(name)
+
+        if m:
+            frameNumbers[name] = int(m.group(1))
+
+    names = sorted(frameNumbers.keys(), key=lambda name: frameNumbers[name])
+
+    if not names:
+        return 0
+
+    temporaryFileName = archiveFileName + ".part"
+
+    with zipfile.ZipFile(temporaryFileName, "w", zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for count, name in enumerate(names):
+
+            zf.write(os.path.join(framesDir, name), name)
+
+            if progress:
+                progress(count + 1, len(names))
+
+    # The index is added at the end, which does not move the frames that are in the archive already
+    index = dict()
+
+    with zipfile.ZipFile(temporaryFileName, "a", zipfile.ZIP_STORED, allowZip64=True) as zf:
+
+        with open(temporaryFileName, "rb") as fh:
+            for name in names:
+                info = zf.getinfo(name)
+                index[frameNumbers[name]] = [_dataOffset(fh, info), info.file_size]
+
+        zf.writestr(frameIndexName, json.dumps({"frames": index}))
+
+    os.rename(temporaryFileName, archiveFileName)
+
+    for name in names:
+        os.remove(os.path.join(framesDir, name))
+
+    if not os.listdir(framesDir):
+        os.rmdir(framesDir)
+
+    return len(names)
+
+
+def readFrameIndex(archiveFileName):
+
+    with zipfile.ZipFile(archiveFileName, "r") as zf:
+        frames = json.loads(zf.read(frameIndexName))["frames"]
+
+    return dict((int(frameNumber), entry) for frameNumber, entry in frames.items())
+
+
+def readFrame(archiveFileName, frameNumber, index=None):
+
+    # Returns the JPEG data of a frame. Pass the index when reading many frames
+    if index is None:
+        index = readFrameIndex(archiveFileName)
+
+    offset, size = index[frameNumber]
+
+    with open(archiveFileName, "rb") as fh:
+        fh.seek(offset)
+        return fh.read(size)
+
+
+def hasRawCaptures(outputDir):
+
+    import rawCapture
+
+    return any(name.endswith(rawCapture.rawCaptureExtension) for name in os.listdir(outputDir))
+
+
+def archiveOutput(outputDir, consolidate=True, convertRawCaptures=False, mergeAcquisition=False):
+
+    # Runs in a process of its own
+    if convertRawCaptures:
+        import rawCapture
+        rawCapture.convertRawCaptures(outputDir, removeRawCaptures=True)
+
+    if mergeAcquisition:
+        import acquisition
+        acquisition.mergeOutput(outputDir)
+
+    framesDir = os.path.join(outputDir, "frames")
+
+    if not consolidate or not os.path.isdir(framesDir):
+        return
+
+    progressMetric = metrics.gauge("archiver.progressInPercent")
+    lastReported = [-1]
+
+    def progress(done, total):
+
+        percentage = 100 * done // total
+
+        if percentage // progressSteps > lastReported[0]:
+            lastReported[0] = percentage // progressSteps
+            progressMetric.set(percentage)
+            logChannel.info("archiving frames of %s: %i %%", outputDir, percentage)
+
+    t0 = time.time()
+
+    try:
+        numberOfFrames = consolidateFrames(framesDir, os.path.join(outputDir, frameArchiveName), progress)
+    except (IOError, OSError, zipfile.LargeZipFile), e:
+        logChannel.error("could not archive the frames of %s: %s", outputDir, e)
+        return
+
+    metrics.counter("archiver.frames").inc(numberOfFrames)
+    logChannel.info("archived %i frames of %s in %.1f s", numberOfFrames, outputDir, time.time() - t0)
+
+
+class outputArchiver(object):
+    def __init__(self, storeDir, consolidateFrames=False, convertRawCaptures=True, mergeAcquisition=True):
+
+        self.storeDir = storeDir
+        self.consolidateFrames = consolidateFrames
+        self.convertRawCaptures = convertRawCaptures
+        self.mergeAcquisition = mergeAcquisition
+        self.processes = []
+
+    def storeRecipe(self, recipeFileName, outputDir):
+        return storeRecipe(recipeFileName, outputDir, self.storeDir)
+
+    def submit(self, outputDir):
+
+        import acquisition
+
+        if not os.path.isdir(outputDir):
+            return
+
+        consolidate = self.consolidateFrames and os.path.isdir(os.path.join(outputDir, "frames"))
+        convert = self.convertRawCaptures and hasRawCaptures(outputDir)
+        # The raw captures are converted to logs before the merge, so with captures to convert the merge decides
+        # for itself whether there are two logs or more to merge (see acquisition.mergeOutput)
+        merge = self.mergeAcquisition and (convert or len(acquisition.timeStampedLogs(outputDir)) >= 2)
+
+        if not consolidate and not convert and not merge:
+            return
+
+        proc = multiprocessing.Process(target=archiveOutput, args=(outputDir, consolidate, convert, merge))
+        proc.start()
+
+        self.processes.append(proc)
+
+    def poll(self):
+
+        # Clean up the processes that are done
+        for proc in self.processes[:]:
+            if not proc.is_alive():
+                proc.join()
+                self.processes.remove(proc)
+
+    def busy(self):
+
+        self.poll()
+
+        return len(self.processes) > 0
+
+    def join(self):
+
+        if self.busy():
+            logChannel.info("waiting for the output archiving to finish")
+
+        for proc in self.processes:
+            proc.join()
+
+        self.processes = []
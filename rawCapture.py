@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import struct
+import numpy
+
+import logChannel
+
+# For channels at rates where even the HDF5 data logger costs too much, a command can capture fixed width records
+# straight into a memory mapped file. The file starts with a header of headerSize bytes:
+#   magic (8 bytes), number of records (int64), length of the description (uint32), description (JSON with the
+#   channels, dtype, sample rate and start time)
+# followed by the records, one value of the dtype per channel. The file grows in steps while capturing and is cut
+# to its content when closed. The number of records in the header is updated after the records are in place, so a
+# capture of a process that was killed can still be read. convertRawCapture turns a capture into the HDF5 layout
+# of writeLog.dataLogger, which the output archiver does after the run.
+magic = "MXRAW001"
+headerSize = 4096
+headerStruct = struct.Struct("<8sqI")
+rawCaptureExtension = ".mxraw"
+timeStampKey = "time [s]"
+
+
+class rawCaptureWriter(object):
+    def __init__(self, fileName, channels, dtype="<f8", sampleRateInHz=None, initialNumberOfRecords=65536):
+
+        self.fileName = fileName
+        self.channels = list(channels)
+        self.dtype = numpy.dtype(dtype)
+        self.recordSize = self.dtype.itemsize * len(self.channels)
+        self.numberOfRecords = 0
+
+        description = json.dumps({"channels": self.channels, "dtype": self.dtype.str, "sampleRateInHz": sampleRateInHz,
+                                  "timeStarted": time.time()})
+
+        if headerStruct.size + len(description) > headerSize:
+            raise ValueError("the description of the capture does not fit in the header")
+
+        with open(fileName, "wb") as fh:
+            fh.write(headerStruct.pack(magic, 0, len(description)) + description)
+            fh.truncate(headerSize + initialNumberOfRecords * self.recordSize)
+
+        self.recordCount = numpy.memmap(fileName, dtype="<i8", mode="r+", offset=8, shape=(1,))
+        self._map(initialNumberOfRecords)
+
+    def _map(self, capacity):
+
+        self.records = numpy.memmap(self.fileName, dtype=self.dtype, mode="r+", offset=headerSize,
+                                    shape=(capacity, len(self.channels)))
+        self.capacity = capacity
+
+    def append(self, records):
+
+        # records is an array of number of records x number of channels
+        records = numpy.asarray(records)
+        numberOfRecords = len(records)
+
+        if self.numberOfRecords + numberOfRecords > self.capacity:
+
+            capacity = max(self.numberOfRecords + numberOfRecords, 2 * self.capacity)
+
+            self.records.flush()
+            del self.records
+
+            with open(self.fileName, "r+b") as fh:
+                fh.truncate(headerSize + capacity * self.recordSize)
+
+            self._map(capacity)
+
+        self.records[self.numberOfRecords:self.numberOfRecords + numberOfRecords] = records
+        self.numberOfRecords += numberOfRecords
+        self.recordCount[0] = self.numberOfRecords
+
+    def close(self):
+
+        self.records.flush()
+        del self.records
+
+        self.recordCount.flush()
+        del self.recordCount
+
+        with open(self.fileName, "r+b") as fh:
+            fh.truncate(headerSize + self.numberOfRecords * self.recordSize)
+
+
+def readRawCapture(fileName):
+
+    # Returns the description and the records, as a read only memory map
+    with open(fileName, "rb") as fh:
+        header = fh.read(headerSize)
+
+    fileMagic, numberOfRecords, descriptionLength = headerStruct.unpack_from(header)
+
+    if fileMagic != magic:
+        raise ValueError("%s is not a raw capture" % fileName)
+
+    description = json.loads(header[headerStruct.size:headerStruct.size + descriptionLength])
+    numberOfChannels = len(description["channels"])
+
+    if not numberOfRecords:
+        return description, numpy.zeros((0, numberOfChannels), dtype=description["dtype"])
+
+    records = numpy.memmap(fileName, dtype=description["dtype"], mode="r", offset=headerSize,
+                           shape=(numberOfRecords, numberOfChannels))
+
+    return description, records
+
+
+def convertRawCapture(rawFileName, logFileName=None, chunkSize=65536, removeRawCapture=False):
+
+    # Writes the capture to logFileName (by default the capture file name with .h5) in the layout of the data logger,
+    # all records in one data set. If the capture has a sample rate and no time channel (wall clock or monotonic, see
+    # acquisition.py), the time of every record is added. Returns the number of records converted
+    import writeLog
+    import acquisition
+
+    if logFileName is None:
+        logFileName = os.path.splitext(rawFileName)[0] + ".h5"
+
+    description, records = readRawCapture(rawFileName)
+    channels = description["channels"]
+    sampleRateInHz = description.get("sampleRateInHz", None)
+    addTimeStamps = bool(sampleRateInHz) and timeStampKey not in channels and acquisition.timeStampKey not in channels
+
+    # Written next to the log file first, so converting again does not add the records twice
+    temporaryFileName = logFileName + ".part"
+
+    if os.path.exists(temporaryFileName):
+        os.remove(temporaryFileName)
+
+    bytesPerLine = (len(channels) + addTimeStamps) * 8
+    policy = writeLog.flushPolicy(maxDataLossInS=float("inf"), targetWriteSizeInKB=chunkSize * bytesPerLine / 1024.0,
+                                  newDataSetAfterS=0, newDataSetAfterMB=0)
+    logger = writeLog.dataLogger(temporaryFileName, None, dict((channel, channel) for channel in channels),
+                                 timeStampKey=timeStampKey if addTimeStamps else None, flushPolicy=policy,
+                                 journal=False)
+
+    for start in range(0, len(records), chunkSize):
+
+        chunk = records[start:start + chunkSize]
+        timeStamps = None
+
+        if addTimeStamps:
+            timeStamps = description["timeStarted"] + numpy.arange(start, start + len(chunk)) / float(sampleRateInHz)
+
+        logger.logBlock(dict((channel, chunk[:, i]) for i, channel in enumerate(channels)), timeStamps)
+
+    logger.close()
+    os.rename(temporaryFileName, logFileName)
+
+    numberOfRecords = len(records)
+    del records
+
+    if removeRawCapture:
+        os.remove(rawFileName)
+
+    return numberOfRecords
+
+
+def convertRawCaptures(directory, removeRawCaptures=False):
+
+    # Converts the captures in directory, returns the number of captures converted
+    numberConverted = 0
+
+    for name in sorted(os.listdir(directory)):
+
+        if not name.endswith(rawCaptureExtension):
+            continue
+
+        t0 = time.time()
+
+        try:
+            numberOfRecords = convertRawCapture(os.path.join(directory, name), removeRawCapture=removeRawCaptures)
+        except (IOError, OSError, ValueError), e:
+            logChannel.error("could not convert the raw capture %s: %s", os.path.join(directory, name), e)
+            continue
+
+        logChannel.info("converted raw capture %s (%i records) in %.1f s", name, numberOfRecords, time.time() - t0)
+        numberConverted += 1
+
+    return numberConverted
@@ -1,11 +1,145 @@
 import commandDefinitions
+import eventLog
+import logChannel
+import metrics
+import recipeProfiler
+import os
+import io
 import re
+import struct
 import zipfile
 import cPickle
 import time
 import multiprocessing
 import traceback
 
+# for example, if outputDir = /home/{object type}/{serial number}/RGA/ then the parts within the curly brackets
+# are unknown and need to be answered by the user. An unknown can give the possible answers after a semicolon:
+# {object type; PL, PLWPPF}
+unknownsRegex = ur"{(.+?)}+?"
+
+
+def findUnknowns(string):
+    return re.findall(unknownsRegex, string)
+
+
+def unknownName(unknown):
+    return unknown.split(";")[0].strip()
+
+
+def unknownOptions(unknown):
+
+    if ";" not in unknown:
+        return None
+
+    return [option.strip() for option in unknown.split(";")[1].split(",")]
+
+
+def fillInAnswers(string, answers):
+
+    for unknown in findUnknowns(string):
+
+        if ";" in unknown:
+            unknownNew = unknown.split(";")[0]  # e.g. if unknown = "object type; PL, PLWPPF",
+            #  make into "object type"
+            string = string.replace("{" + unknown + "}", "{" + unknownNew + "}")
+
+    return string.format(**answers)
+
+
+class recipeInputs(object):
+    # The inputs of a recipe (the members inputs/<name> of the recipe zip file) are only read when a command in the
+    # sequence refers to them. Pickled objects are unpickled on first use. Numpy arrays saved as inputs/<name>.npy
+    # are memory mapped straight from the zip file if they are stored uncompressed, so large tables are not copied.
+
+    def __init__(self, recipeFileName, memberNames):
+
+        self.recipeFileName = recipeFileName
+        self.members = dict()  # input name -> zip member name
+        self.cache = dict()
+
+        for memberName in memberNames:
+
+            name = memberName[len("inputs/"):]
+
+            if name.endswith(".npy"):
+                name = name[:-len(".npy")]
+
+            self.members[name] = memberName
+
+    def __getstate__(self):
+
+        # Inputs loaded in one process are not sent along to another, the other process loads what it uses
+        state = self.__dict__.copy()
+        state["cache"] = dict()
+
+        return state
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def __len__(self):
+        return len(self.members)
+
+    def keys(self):
+        return self.members.keys()
+
+    def __getitem__(self, name):
+
+        if name not in self.cache:
+
+            if name not in self.members:
+                raise KeyError(name)
+
+            self.cache[name] = self._load(self.members[name])
+
+        return self.cache[name]
+
+    def _load(self, memberName):
+
+        with zipfile.ZipFile(self.recipeFileName, "r") as zf:
+
+            if memberName.endswith(".npy"):
+                return self._loadArray(zf, memberName)
+
+            return cPickle.loads(zf.read(memberName))
+
+    def _loadArray(self, zf, memberName):
+
+        import numpy
+        from numpy.lib import format
+
+        info = zf.getinfo(memberName)
+
+        if info.compress_type != zipfile.ZIP_STORED:
+            return numpy.load(io.BytesIO(zf.read(memberName)))
+
+        # The data of a stored member follows its local header. The length of the extra field in the local header
+        # can differ from the one in the central directory, so we need to read it
+        with open(self.recipeFileName, "rb") as fh:
+
+            fh.seek(info.header_offset)
+            nameLength, extraLength = struct.unpack("<HH", fh.read(30)[26:30])
+            fh.seek(info.header_offset + 30 + nameLength + extraLength)
+
+            version = format.read_magic(fh)
+
+            if version == (1, 0):
+                shape, fortranOrder, dtype = format.read_array_header_1_0(fh)
+            elif version == (2, 0):
+                shape, fortranOrder, dtype = format.read_array_header_2_0(fh)
+            else:
+                return numpy.load(io.BytesIO(zf.read(memberName)))
+
+            dataOffset = fh.tell()
+
+        # Object arrays can't be mapped and numpy refuses to map zero bytes
+        if dtype.hasobject or not numpy.prod(shape, dtype=numpy.int64):
+            return numpy.load(io.BytesIO(zf.read(memberName)))
+
+        return numpy.memmap(self.recipeFileName, dtype=dtype, mode="r", offset=dataOffset, shape=shape,
+                            order="F" if fortranOrder else "C")
+
 
 class MeasurixRecipe():
     def __init__(self, recipeFileName, systemState, ignoreTimeStampInRecipeInfo=False):
@@ -28,7 +162,11 @@ class MeasurixRecipe():
         self.processesStarted = dict()
         self.currentStepInRecipe = 0
         self.done = False
+        self.aborted = False
+        self.regeneratingReport = False
         self.measurixProgram = None
+        self.profiler = recipeProfiler.recipeProfiler()
+        self.commandsCreated = []  # their hardware checkers may hold devices leased from the device pool
 
     def _extractRecipeFile(self, recipeFile):
         try:
@@ -47,7 +185,7 @@ class MeasurixRecipe():
         sequenceText = zf.read("sequence.txt")
         infoText = zf.read("recipeInfo.txt")
 
-        inputsDict = dict()
+        inputMembers = []
 
         for f in listOfFiles:
 
@@ -61,21 +199,17 @@ class MeasurixRecipe():
             if objectName.strip() == "":
                 continue
 
-            objectValuePickled = zf.read(f)
-            objectValue = cPickle.loads(objectValuePickled)
-            inputsDict[objectName] = objectValue
+            inputMembers.append(f)
 
         zf.close()
 
-        return "OK", [sequenceText, infoText, inputsDict]
+        return "OK", [sequenceText, infoText, recipeInputs(recipeFile, inputMembers)]
 
     def _parseSequenceText(self, sequenceText, noHardwareCheck=False):
 
-        for name, value in zip(self.inputs.keys(), self.inputs.values()):
-            exec ("{name}=value".format(name=name))
-
         sequence = []
         startedProcs = dict()
+        self.commandsCreated = []
 
         for lineNo, line in enumerate(sequenceText.split("\n")):
 
@@ -105,6 +239,10 @@ class MeasurixRecipe():
 
                     stub = commandDefinitions.stopProcessStub(objToStop)
                     sequence.append(stub)
+
+                    self.profiler.addStep(stub, commandName, line)
+                    self.profiler.mark(stub, "created")
+                    self.profiler.mark(stub, "checked")
                     startedProcs[procNameToStop] = None
 
                     continue
@@ -123,11 +261,17 @@ class MeasurixRecipe():
                         continue
 
                     try:
-                        argArray.append(eval(argString))
+                        # the inputs are the local name space, so only the inputs that are used get loaded
+                        argArray.append(eval(argString, globals(), self.inputs))
                     except NameError:
                         return "error: Line %i: %s. Input %s not defined" % (lineNo, line, argString), []
 
+                timeCreated = time.time()
                 comObj = commandObj(argArray, self.messageQueue, self.measurixProgram, self.recipeInfo)
+                self.commandsCreated.append(comObj)
+
+                self.profiler.addStep(comObj, commandName, line)
+                self.profiler.mark(comObj, "created", timeCreated)
 
                 try:
                     checkResult = comObj.checker(noHardwareCheck=noHardwareCheck)
@@ -145,6 +289,7 @@ class MeasurixRecipe():
                 if not checkResult.startswith("OK"):
                     return "error: Line %i: %s: %s" % (lineNo, line, checkResult), []
 
+                self.profiler.mark(comObj, "checked")
                 sequence.append(comObj)
 
                 if "startProcess" in commandName:
@@ -228,45 +373,93 @@ class MeasurixRecipe():
         for key in additionalInfo:
             self.recipeInfo[key] = additionalInfo[key]
 
+    def getUnknowns(self):
+        return findUnknowns(self.recipeInfo.get("outputDir", ""))
+
+    def prepareForExecution(self, answers=None):
+
+        # Fill in the answers to the unknowns in the output directory and add the information we want to keep
+        # with the output of the recipe. Returns "OK" or an error message
+        if "outputDir" not in self.recipeInfo.keys():
+            return "error: no output directory given in recipe information file!"
+
+        unknowns = self.getUnknowns()
+
+        if unknowns:
+
+            answers = answers if answers else dict()
+            missing = [unknownName(u) for u in unknowns if unknownName(u) not in answers]
+
+            if missing:
+                return "error: no answer given for %s" % ", ".join(missing)
+
+            for unknown in unknowns:
+
+                options = unknownOptions(unknown)
+
+                if options and answers[unknownName(unknown)] not in options:
+                    return "error: answer for %s should be one of %s" % (unknownName(unknown), ", ".join(options))
+
+            self.setOutputDirectory(fillInAnswers(self.recipeInfo["outputDir"], answers))
+            self.addInfoToRecipe(answers)
+
+        self.addInfoToRecipe({"recipeFileName": self.recipeFileName})
+
+        if "time stamp" not in self.recipeInfo.keys():
+            self.addInfoToRecipe({"time stamp": time.strftime("%Y%m%d-%H%M%S")})
+
+        return "OK"
+
     def check(self, measurixProgram):
         self.measurixProgram = measurixProgram
 
         evaluateResult, sequence = self._evaluateSequence()
+        self._releaseDevices()
 
         return evaluateResult
 
     def start(self, measurixProgram):
 
-        # from commandDefinitions import generateFinalReport
+        from commandDefinitions import generateFinalReport
         from main import softwareVersion
 
         self.messageQueue = multiprocessing.Queue()
         self.measurixProgram = measurixProgram
+        self.profiler = recipeProfiler.recipeProfiler()
 
         evaluateResult, self.executionSequence = self._evaluateSequence()
 
         if not evaluateResult.startswith("OK"):
+            self._releaseDevices()
             return evaluateResult
 
         self.currentStepInRecipe = 0
 
-        args = ([softwareVersion, self.executionSequence],
+        recipeFileName = self.recipeInfo.get("recipeFileName", self.recipeFileName)
+        eventLog.setContext(recipe=os.path.basename(recipeFileName))
+
+        metrics.reset()  # the metrics dumped at the end of the run only cover this run
+
+        args = ([softwareVersion, list(self.executionSequence)],
                 self.messageQueue, self.measurixProgram, self.recipeInfo)
 
-        # reportGeneratingStep = generateFinalReport(*args)
-        # self.executionSequence.append(reportGeneratingStep)
+        reportGeneratingStep = generateFinalReport(*args)
+        self.executionSequence.append(reportGeneratingStep)
+        self.profiler.addStep(reportGeneratingStep, "generateFinalReport", "")
 
         pid = self.executionSequence[0].start()
         self.processesStarted[pid] = self.executionSequence[0]
+        self.profiler.markStarted(self.executionSequence[0], pid)
 
         return "OK"
 
     def regenerateFinalReport(self, measurixProgram):
 
-        # from commandDefinitions import generateFinalReport
+        from commandDefinitions import generateFinalReport
         from main import softwareVersion
 
         self.measurixProgram = measurixProgram
+        self.regeneratingReport = True
 
         self.messageQueue = multiprocessing.Queue()
 
@@ -280,10 +473,11 @@ class MeasurixRecipe():
         args = ([softwareVersion, executionSequence],
                 self.messageQueue, measurixProgram, self.recipeInfo)
 
-        # reportGeneratingStep = generateFinalReport(*args)
-        # self.executionSequence = [reportGeneratingStep]
-        # pid = reportGeneratingStep.start()
-        # self.processesStarted[pid] = reportGeneratingStep
+        # Sections of which the inputs did not change come from the report cache in the output directory
+        reportGeneratingStep = generateFinalReport(*args)
+        self.executionSequence = [reportGeneratingStep]
+        pid = reportGeneratingStep.start()
+        self.processesStarted[pid] = reportGeneratingStep
 
         return "OK"
 
@@ -293,11 +487,13 @@ class MeasurixRecipe():
             return
 
         message = self.messageQueue.get()
+        timeReceived = self.profiler.messageReceived(message)
 
         if message["type"] in ["continue", "done"]:
 
             if message["type"] == "done":
                 self.processesStarted[message["PID"]].cleanUp()
+                self.profiler.mark(self.processesStarted[message["PID"]], "cleanedUp")
 
             self.currentStepInRecipe += 1
             if self.currentStepInRecipe == len(self.executionSequence):
@@ -305,6 +501,7 @@ class MeasurixRecipe():
             else:
                 currentStepObject = self.executionSequence[self.currentStepInRecipe]
                 pid = currentStepObject.start()
+                self.profiler.markStarted(currentStepObject, pid, timeReceived)
                 if pid:
                     self.processesStarted[pid] = currentStepObject
 
@@ -313,9 +510,9 @@ class MeasurixRecipe():
             name = self.processesStarted[message["PID"]].name
 
             if message["type"] == "exception":
-                print "error: Exception occurred in %s: %s" % (name, message["exception"])
+                logChannel.error("Exception occurred in %s: %s", name, message["exception"])
             else:
-                print "info: Abort message received by process %s" % name
+                logChannel.info("Abort message received by process %s", name)
 
             self.processesStarted[message["PID"]].cleanUp()
             self.abort(exception=True)
@@ -348,6 +545,7 @@ class MeasurixRecipe():
                         continue
 
                     message = self.messageQueue.get()
+                    self.profiler.messageReceived(message)
 
                     if message["PID"] == pid:
                         stopAcknowledgmentReceived = True
@@ -357,20 +555,72 @@ class MeasurixRecipe():
                 # If a plugin command is programmed correctly, this can never happen. IF THIS HAPPENS, THE
                 # PROGRAMMER IF THE PLUGIN COMMAND NEEDS TO BE MADE AWARE
                 if not stopAcknowledgmentReceived:
-                    print "error: Killing %s by force. Please submit a TT to the programmer" % self.processesStarted[
-                        pid]
+                    logChannel.error("Killing %s by force. Please submit a TT to the programmer",
+                                     self.processesStarted[pid])
                     self.processesStarted[pid].abort()
 
                 self.processesStarted[pid].cleanUp()
+                self.profiler.mark(self.processesStarted[pid], "cleanedUp")
 
         self.processRecipeDone(exception=exception, abort=True)
 
     def processRecipeDone(self, exception=False, abort=False):
 
         if exception or abort:
-            print "info: Recipe aborted"
+            logChannel.info("Recipe aborted")
 
         self.done = True
+        self.aborted = exception or abort
         self.currentStepInRecipe = -1
 
+        self.profiler.markRecipeEvent("recipeAborted" if exception or abort else "recipeDone")
+
+        # The profile and metrics of the run itself are kept when only the report was generated again
+        if not self.regeneratingReport:
+            self._saveProfile()
+            self._saveMetrics()
+
+        eventLog.setContext(recipe=None)
+
+        self._releaseDevices()
+
         return
+
+    def _releaseDevices(self):
+
+        for command in self.commandsCreated:
+            command.releaseDevices()
+
+    def _saveProfile(self):
+
+        outputDir = self.recipeInfo.get("outputDir", "")
+
+        if outputDir == "" or not os.path.isdir(outputDir):
+            logChannel.debug("no output directory, recipe profile not saved")
+            return
+
+        try:
+            profileFileName = self.profiler.save(outputDir,
+                                                 chromeTrace=self.systemState.get("recipeProfileChromeTrace", 0))
+        except (IOError, OSError), e:
+            logChannel.warning("could not save recipe profile: %s", e)
+            return
+
+        logChannel.info("recipe profile saved to %s", profileFileName)
+
+        return
+
+    def _saveMetrics(self):
+
+        outputDir = self.recipeInfo.get("outputDir", "")
+
+        if not metrics.isEnabled() or outputDir == "" or not os.path.isdir(outputDir):
+            return
+
+        try:
+            metricsFileName = metrics.dump(outputDir)
+        except (IOError, OSError), e:
+            logChannel.warning("could not save metrics: %s", e)
+            return
+
+        logChannel.info("metrics saved to %s", metricsFileName)
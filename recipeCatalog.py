@@ -0,0 +1,311 @@
+import os
+import re
+import json
+import errno
+import struct
+import tempfile
+
+import logChannel
+from outputArchiver import fileHash
+
+# Catalog of the recipes in the recipe folder. Recipe files are named
+#   measurixRecipe_<name>-v<major>-<minor>.zip  (or biotixRecipe_...)
+# The catalog keeps an index on disk with the name, version, size, modification time, hash and validation status
+# of every recipe, so on start up only recipes that changed are hashed again. While running, the recipe folder is
+# watched with inotify (or polled where inotify is not available) and only the files that changed are looked at.
+recipeFileRegex = re.compile(r"^(?P<kind>measurix|biotix)Recipe_(?P<name>.+)-(?P<version>v\d+-\d+)\.zip$")
+
+
+def parseRecipeFileName(fileName):
+
+    # e.g. "measurixRecipe_camera_and_arduino-v01-02.zip" -> ("measurix", "camera_and_arduino", "v01-02")
+    m = recipeFileRegex.match(fileName)
+
+    if not m:
+        return None
+
+    return m.group("kind"), m.group("name"), m.group("version")
+
+
+def versionKey(version):
+    # "v01-10" -> (1, 10), so that v01-10 comes after v01-9
+    return tuple(int(part) for part in version.lstrip("v").split("-"))
+
+
+class inotifyWatcher(object):
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = 0o2000000
+
+    eventHeader = struct.Struct("iIII")  # wd, mask, cookie, length of the name
+
+    def __init__(self, directory):
+
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_DELETE | self.IN_DELETE_SELF
+
+        if libc.inotify_add_watch(self.fd, directory, mask) < 0:
+            errorNumber = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errorNumber, "inotify_add_watch failed for %s" % directory)
+
+    def fileno(self):
+        return self.fd
+
+    def changes(self):
+
+        # Returns the names of the files that changed, or None if everything should be looked at again
+        changed = set()
+
+        while True:
+
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+
+            offset = 0
+
+            while offset < len(data):
+
+                wd, mask, cookie, length = self.eventHeader.unpack_from(data, offset)
+                offset += self.eventHeader.size
+                name = data[offset:offset + length].rstrip("\0")
+                offset += length
+
+                if mask & (self.IN_Q_OVERFLOW | self.IN_DELETE_SELF):
+                    return None
+
+                changed.add(name)
+
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class pollingWatcher(object):
+    # Fallback for systems without inotify: only list the folder when its modification time changed. A recipe
+    # overwritten in place does not change the modification time of the folder, refresh the catalog to see it
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        self.mtime = os.stat(directory).st_mtime
+
+    def fileno(self):
+        return None
+
+    def changes(self):
+
+        mtime = os.stat(self.directory).st_mtime
+
+        if mtime == self.mtime:
+            return set()
+
+        self.mtime = mtime
+
+        return None
+
+    def close(self):
+        pass
+
+
+class recipeCatalog(object):
+    def __init__(self, recipeFolder, indexFile):
+
+        self.recipeFolder = recipeFolder
+        self.indexFile = indexFile
+        self.entries = self._loadIndex()  # file name -> entry
+
+        try:
+            self.watcher = inotifyWatcher(recipeFolder)
+        except (OSError, AttributeError), e:  # AttributeError: libc without inotify
+            logChannel.debug("not watching %s with inotify (%s), polling instead", recipeFolder, e)
+            self.watcher = pollingWatcher(recipeFolder)
+
+        self.refresh()
+
+    def _loadIndex(self):
+
+        try:
+            with open(self.indexFile, "r") as fh:
+                index = json.load(fh)
+        except (IOError, ValueError):
+            return dict()
+
+        if index.get("recipeFolder", None) != os.path.realpath(self.recipeFolder):
+            return dict()
+
+        return index["recipes"]
+
+    def _saveIndex(self):
+
+        indexDir = os.path.dirname(os.path.realpath(self.indexFile))
+
+        try:
+            fd, temporaryFileName = tempfile.mkstemp(dir=indexDir, prefix=".recipeCatalog")
+
+            with os.fdopen(fd, "w") as fh:
+                json.dump({"recipeFolder": os.path.realpath(self.recipeFolder), "recipes": self.entries}, fh,
+                          indent=1)
+
+            os.rename(temporaryFileName, self.indexFile)
+        except (IOError, OSError), e:
+            logChannel.warning("could not save the recipe catalog to %s: %s", self.indexFile, e)
+
+    def _updateFile(self, fileName):
+
+        # Returns True if the entry of the file changed
+        parsed = parseRecipeFileName(fileName)
+        fullFileName = os.path.join(self.recipeFolder, fileName)
+
+        try:
+            stat = os.stat(fullFileName)
+        except OSError:
+            stat = None
+
+        if parsed is None or stat is None:
+            return self.entries.pop(fileName, None) is not None
+
+        entry = self.entries.get(fileName, None)
+
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return False
+
+        try:
+            recipeHash = fileHash(fullFileName)
+        except IOError, e:
+            logChannel.warning("could not read recipe %s: %s", fullFileName, e)
+            return self.entries.pop(fileName, None) is not None
+
+        kind, name, version = parsed
+        validation = entry["validation"] if entry and entry["hash"] == recipeHash else None
+
+        self.entries[fileName] = {"kind": kind, "name": name, "version": version, "size": stat.st_size,
+                                  "mtime": stat.st_mtime, "hash": recipeHash, "validation": validation}
+
+        return True
+
+    def refresh(self):
+
+        # Look at every file in the recipe folder. Only new and changed files are hashed
+        fileNames = set(os.listdir(self.recipeFolder))
+        changed = False
+
+        for fileName in list(self.entries.keys()):
+            if fileName not in fileNames:
+                del self.entries[fileName]
+                changed = True
+
+        for fileName in fileNames:
+            changed = self._updateFile(fileName) or changed
+
+        if changed:
+            self._saveIndex()
+
+        return changed
+
+    def update(self):
+
+        # Look at the files reported by the watcher. Returns True if the catalog changed
+        changes = self.watcher.changes()
+
+        if changes is None:
+            return self.refresh()
+
+        changed = False
+
+        for fileName in changes:
+            changed = self._updateFile(fileName) or changed
+
+        if changed:
+            self._saveIndex()
+
+        return changed
+
+    def fileno(self):
+        # None if the folder is polled
+        return self.watcher.fileno()
+
+    def close(self):
+        self.watcher.close()
+
+    def names(self):
+        return sorted(set(entry["name"] for entry in self.entries.values()))
+
+    def versions(self, name):
+
+        # Returns (version, file name) of a recipe, oldest first
+        versions = [(entry["version"], fileName) for fileName, entry in self.entries.items() if entry["name"] == name]
+
+        return sorted(versions, key=lambda v: versionKey(v[0]))
+
+    def get(self, name, version=None):
+
+        # Returns the full file name of the latest or the given version of a recipe, or None
+        versions = self.versions(name)
+
+        if version is not None:
+            versions = [v for v in versions if v[0] == version]
+
+        if not versions:
+            return None
+
+        return os.path.join(self.recipeFolder, versions[-1][1])
+
+    def entry(self, fileName):
+        return self.entries.get(os.path.basename(fileName), None)
+
+    def fileNames(self):
+        return sorted(os.path.join(self.recipeFolder, fileName) for fileName in self.entries.keys())
+
+    def setValidation(self, fileName, validation, save=True):
+
+        entry = self.entry(fileName)
+
+        if entry is not None:
+            entry["validation"] = validation
+
+        if save:
+            self._saveIndex()
+
+    def save(self):
+        self._saveIndex()
+
+
+def catalogIndexFile(systemState):
+    return systemState.get("recipeCatalogFile",
+                           os.path.join(os.path.dirname(systemState["logFile"]), "recipeCatalog.json"))
+
+
+def resolveRecipe(spec, systemState):
+
+    # A recipe given on the command line is either a file, or <name> or <name>@<version> from the recipe folder
+    if os.path.exists(spec):
+        return os.path.realpath(spec)
+
+    name, _, version = spec.partition("@")
+    catalog = recipeCatalog(systemState["recipeFolder"], catalogIndexFile(systemState))
+    catalog.close()
+
+    return catalog.get(name, version or None)
@@ -0,0 +1,194 @@
+import os
+import sys
+import time
+import json
+import resource
+
+# Events which are recorded for every step in a recipe, in the order in which they normally occur
+stepEvents = ["created", "checked", "started", "workerStarted", "firstMessage", "done", "cleanedUp"]
+
+
+def resourceUsage():
+
+    # Called by a process to report its own CPU time and peak memory use
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    return {"userTimeInS": usage.ru_utime,
+            "systemTimeInS": usage.ru_stime,
+            "maxRSSInKB": usage.ru_maxrss}
+
+
+class recipeProfiler(object):
+    def __init__(self):
+
+        self.timeZero = time.time()
+        self.steps = []
+        self.stepIndex = dict()  # id of the command object -> index in self.steps
+        self.pids = dict()  # PID -> index in self.steps
+        self.events = []  # recipe wide events, e.g. "recipeDone"
+
+    def _step(self, commandObj):
+        return self.steps[self.stepIndex[id(commandObj)]]
+
+    def addStep(self, commandObj, name, line):
+
+        self.stepIndex[id(commandObj)] = len(self.steps)
+        self.steps.append({"name": name, "line": line, "PID": None, "times": dict(), "messages": [],
+                           "resourceUsage": None, "dispatchLatencyInS": None})
+
+    def mark(self, commandObj, event, timeStamp=None):
+
+        if id(commandObj) not in self.stepIndex:
+            return
+
+        self._step(commandObj)["times"][event] = timeStamp if timeStamp is not None else time.time()
+
+    def markStarted(self, commandObj, pid, previousMessageTime=None):
+
+        # previousMessageTime is the time the message was received which made us start this step, the difference
+        # is the time the recipe spent between handling the continue/done message and starting the next step
+        self.mark(commandObj, "started")
+
+        if id(commandObj) not in self.stepIndex:
+            return
+
+        step = self._step(commandObj)
+
+        if pid:
+            step["PID"] = pid
+            self.pids[pid] = self.stepIndex[id(commandObj)]
+
+        if previousMessageTime is not None:
+            step["dispatchLatencyInS"] = step["times"]["started"] - previousMessageTime
+
+    def messageReceived(self, message, timeReceived=None):
+
+        timeReceived = timeReceived if timeReceived is not None else time.time()
+
+        if message.get("PID") not in self.pids:
+            return timeReceived
+
+        step = self.steps[self.pids[message["PID"]]]
+
+        if "firstMessage" not in step["times"]:
+            step["times"]["firstMessage"] = timeReceived
+
+        if "timeWorkerStarted" in message:  # time stamp taken in the command process itself
+            step["times"]["workerStarted"] = message["timeWorkerStarted"]
+
+        latency = timeReceived - message["timeSent"] if "timeSent" in message else None
+        step["messages"].append({"type": message["type"], "timeReceived": timeReceived, "queueLatencyInS": latency})
+
+        if message["type"] == "done":
+            step["times"]["done"] = timeReceived
+
+        if "resourceUsage" in message:
+            step["resourceUsage"] = message["resourceUsage"]
+
+        return timeReceived
+
+    def markRecipeEvent(self, event):
+        self.events.append({"name": event, "time": time.time()})
+
+    def toDict(self):
+
+        profile = {"timeZero": self.timeZero, "steps": self.steps, "events": self.events,
+                   "program": {"PID": os.getpid(), "resourceUsage": resourceUsage()}}
+
+        # Durations of the phases of each step, derived from the time stamps
+        phases = [("hardwareCheck", "created", "checked"),
+                  ("spawn", "started", "workerStarted"),
+                  ("run", "workerStarted", "done"),
+                  ("firstMessageLatency", "workerStarted", "firstMessage"),
+                  ("cleanUp", "done", "cleanedUp")]
+
+        for step in self.steps:
+            step["durationsInS"] = dict((phase, step["times"][end] - step["times"][begin])
+                                        for phase, begin, end in phases
+                                        if begin in step["times"] and end in step["times"])
+
+        return profile
+
+    def save(self, outputDir, chromeTrace=False):
+
+        profile = self.toDict()
+        profileFileName = os.path.join(outputDir, "recipeProfile.json")
+
+        with open(profileFileName, "w") as fh:
+            json.dump(profile, fh, indent=1)
+
+        if chromeTrace:
+            writeChromeTrace(profile, os.path.join(outputDir, "recipeProfile.trace.json"))
+
+        return profileFileName
+
+
+def chromeTraceEvents(profile):
+
+    # See the "Trace Event Format" document of the Chromium project. Load the result in chrome://tracing or
+    # https://ui.perfetto.dev
+    def us(t):
+        return int((t - profile["timeZero"]) * 1E6)
+
+    programPid = profile["program"]["PID"]
+    traceEvents = [{"name": "process_name", "ph": "M", "pid": programPid, "args": {"name": "Measurix program"}}]
+
+    for count, step in enumerate(profile["steps"]):
+
+        times = step["times"]
+        pid = step["PID"] or programPid
+
+        if step["PID"]:
+            traceEvents.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": step["name"]}})
+
+        phases = [("check", "created", "checked", programPid),
+                  ("spawn", "started", "workerStarted", pid),
+                  ("run", "workerStarted", "done", pid),
+                  ("cleanUp", "done", "cleanedUp", programPid)]
+
+        for phase, begin, end, phasePid in phases:
+
+            if begin in times and end in times:
+                traceEvents.append({"name": "%s %s" % (phase, step["name"]), "cat": phase, "ph": "X",
+                                    "ts": us(times[begin]), "dur": us(times[end]) - us(times[begin]),
+                                    "pid": phasePid, "tid": count, "args": {"line": step["line"]}})
+
+        for message in step["messages"]:
+            traceEvents.append({"name": "message %s" % message["type"], "cat": "queue", "ph": "i", "s": "p",
+                                "ts": us(message["timeReceived"]), "pid": programPid, "tid": count,
+                                "args": {"queueLatencyInS": message["queueLatencyInS"]}})
+
+    for event in profile["events"]:
+        traceEvents.append({"name": event["name"], "ph": "i", "s": "g", "ts": us(event["time"]), "pid": programPid,
+                            "tid": 0})
+
+    return traceEvents
+
+
+def writeChromeTrace(profile, traceFileName):
+
+    with open(traceFileName, "w") as fh:
+        json.dump({"traceEvents": chromeTraceEvents(profile), "displayTimeUnit": "ms"}, fh)
+
+
+def main(argv=None):
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert a recipe profile to the Chrome trace event format")
+    parser.add_argument("profile", help="recipeProfile.json in the output directory of a recipe")
+    parser.add_argument("trace", nargs="?", default=None, help="trace file to write (default: next to profile)")
+
+    args = parser.parse_args(argv)
+
+    with open(args.profile, "r") as fh:
+        profile = json.load(fh)
+
+    traceFileName = args.trace or os.path.splitext(args.profile)[0] + ".trace.json"
+    writeChromeTrace(profile, traceFileName)
+
+    print "wrote %s" % traceFileName
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
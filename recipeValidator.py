@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import traceback
+import multiprocessing
+
+import logChannel
+from outputArchiver import fileHash
+
+# Checks many recipes at once without touching any hardware: every recipe is read and its sequence parsed with
+# the hardware checks switched off, in a pool of processes. The result only depends on the content of the recipe,
+# the code that reads and checks it and the INI settings, so results are cached under a hash of those three. That
+# only holds as long as the input checkers of the commands look at nothing but their arguments and the settings:
+# anything that depends on the file system or the devices (e.g. whether a file to replay exists) belongs in the
+# hardware checker, which validation does not run.
+
+# The modules the validation imports, a change to any of them may change the result
+validationModules = ["readRecipe", "commandDefinitions", "devicePool", "eventLog", "logChannel", "metrics",
+                     "recipeProfiler"]
+
+
+def commandsHash():
+
+    from main import softwareVersion
+
+    sourcesHash = hashlib.sha256(softwareVersion)
+
+    for moduleName in validationModules:
+        module = __import__(moduleName)
+        sourcesHash.update(fileHash(os.path.splitext(module.__file__)[0] + ".py"))
+
+    return sourcesHash.hexdigest()
+
+
+def settingsHash(settings):
+
+    # The time stamp loaded with the INI file changes every time
+    return hashlib.sha256(json.dumps(dict((k, v) for k, v in settings.items() if k != "time"),
+                                     sort_keys=True, default=str)).hexdigest()
+
+
+def validateRecipe(recipeFileName, settings):
+
+    from readRecipe import MeasurixRecipe
+
+    t0 = time.time()
+
+    try:
+        recipe = MeasurixRecipe(recipeFileName, settings)
+        result = recipe.init
+
+        if result == "OK":
+            result, sequence = recipe._evaluateSequence(noHardwareCheck=True)
+
+    except Exception, e:
+        result = "error: %s: %s" % (e.__class__.__name__, traceback.format_exc().strip().split("\n")[-1])
+
+    return {"recipe": recipeFileName, "result": result, "timeInS": time.time() - t0, "cached": False}
+
+
+def _validateWorker(arguments):
+
+    recipeFileName, settings, key = arguments
+
+    validation = validateRecipe(recipeFileName, settings)
+    validation["key"] = key
+
+    return validation
+
+
+class validationCache(object):
+    def __init__(self, cacheFile):
+
+        self.cacheFile = cacheFile
+
+        try:
+            with open(cacheFile, "r") as fh:
+                self.results = json.load(fh)
+        except (IOError, ValueError):
+            self.results = dict()
+
+    def get(self, key):
+        return self.results.get(key, None)
+
+    def set(self, key, result):
+        self.results[key] = result
+
+    def save(self):
+
+        try:
+            fd, temporaryFileName = tempfile.mkstemp(dir=os.path.dirname(os.path.realpath(self.cacheFile)),
+                                                     prefix=".validationCache")
+
+            with os.fdopen(fd, "w") as fh:
+                json.dump(self.results, fh)
+
+            os.rename(temporaryFileName, self.cacheFile)
+        except (IOError, OSError), e:
+            logChannel.warning("could not save the validation cache %s: %s", self.cacheFile, e)
+
+
+def validationCacheFile(settings):
+    return settings.get("validationCacheFile",
+                        os.path.join(os.path.dirname(settings["logFile"]), "recipeValidationCache.json"))
+
+
+def validateRecipes(recipeFileNames, settings, numberOfProcesses=None, useCache=True):
+
+    # Returns a list of {"recipe", "result", "timeInS", "cached"}, in the order of recipeFileNames
+    settings = dict(settings)  # a manager dict can't be sent to the pool
+    cache = validationCache(validationCacheFile(settings))
+    baseKey = commandsHash() + settingsHash(settings)
+
+    results = dict()
+    toValidate = []
+
+    for recipeFileName in recipeFileNames:
+
+        try:
+            key = hashlib.sha256(baseKey + fileHash(recipeFileName)).hexdigest()
+        except IOError, e:
+            results[recipeFileName] = {"recipe": recipeFileName, "result": "error: %s" % e, "timeInS": 0.0,
+                                       "cached": False}
+            continue
+
+        cached = cache.get(key) if useCache else None
+
+        if cached is not None:
+            results[recipeFileName] = {"recipe": recipeFileName, "result": cached, "timeInS": 0.0, "cached": True}
+        else:
+            toValidate.append((recipeFileName, settings, key))
+
+    if toValidate:
+
+        pool = multiprocessing.Pool(numberOfProcesses)
+
+        try:
+            for validation in pool.imap_unordered(_validateWorker, toValidate):
+                cache.set(validation.pop("key"), validation["result"])
+                results[validation["recipe"]] = validation
+        finally:
+            pool.close()
+            pool.join()
+
+        cache.save()
+
+    return [results[recipeFileName] for recipeFileName in recipeFileNames]
+
+
+def summarise(results, timeInS=None):
+
+    numberOK = len([r for r in results if r["result"] == "OK"])
+    numberCached = len([r for r in results if r["cached"]])
+
+    summary = "%i recipes checked: %i OK, %i failed, %i results from the cache" % (len(results), numberOK,
+                                                                                  len(results) - numberOK,
+                                                                                  numberCached)
+
+    if timeInS is not None:
+        summary += ", took %.1f s" % timeInS
+
+    return summary
+
+
+def formatReport(results, timeInS=None):
+
+    lines = []
+
+    for r in sorted(results, key=lambda r: (r["result"] == "OK", os.path.basename(r["recipe"]))):
+
+        if r["result"] == "OK":
+            lines.append("OK      %s" % os.path.basename(r["recipe"]))
+        else:
+            lines.append("FAILED  %s: %s" % (os.path.basename(r["recipe"]), r["result"]))
+
+    lines.append(summarise(results, timeInS))
+
+    return "\n".join(lines)
+
+
+def checkAll(recipeFileNames, settings, connection, numberOfProcesses=None):
+
+    # Runs in a process started by the GUI, the results are sent back over connection
+    t0 = time.time()
+
+    try:
+        results = validateRecipes(recipeFileNames, settings, numberOfProcesses)
+    except Exception, e:
+        logChannel.error("checking the recipes failed: %s", e)
+        results = []
+
+    connection.send({"results": results, "timeInS": time.time() - t0})
+    connection.close()
@@ -0,0 +1,210 @@
+import os
+import copy
+import json
+import numpy
+
+# Recorded runs can be played back without the hardware: the lines of a data log (e.g. arduino_log.h5) are put back
+# into the system state at the places they were logged from, and the frames of a web cam run are shown again, at
+# the speed they were recorded at or faster. The data logger keeps where every key came from (the logKeys attribute
+# of a data set); for logs written before that, the values go to systemState[<log name>][<key>].
+defaultIntervalInS = 0.5  # between the lines of a log without time stamps, the period of the acquisition loops
+
+
+def storeKeyPath(state, keyPath, value):
+
+    # The counterpart of writeLog.lookUpKeyPath, state is a plain dict
+    for k in keyPath[:-1]:
+
+        if type(state.get(k, None)) != dict:
+            state[k] = dict()
+
+        state = state[k]
+
+    state[keyPath[-1]] = value
+
+
+def publish(systemState, keyPaths, values):
+
+    # Puts {key: value} into the system state. Every top level entry is copied, changed and set once, so the other
+    # settings in it (e.g. the baud rate of the arduino) stay
+    updates = dict()
+
+    for k, value in values.items():
+
+        keyPath = keyPaths[k]
+
+        if keyPath[0] not in updates:
+            current = systemState.get(keyPath[0], None)
+            updates[keyPath[0]] = {keyPath[0]: copy.deepcopy(current) if current is not None else None}
+
+        storeKeyPath(updates[keyPath[0]], keyPath, value)
+
+    for topLevelKey, update in updates.items():
+        systemState[topLevelKey] = update[topLevelKey]
+
+
+class replaySchedule(object):
+    # Maps the recorded time of a line to the time it is due, speed times faster than it was recorded
+
+    def __init__(self, speed=1.0):
+
+        self.speed = float(speed)
+        self.tRecordedStart = None
+        self.tStart = None
+
+    def dueAt(self, tRecorded, tNow):
+
+        if self.tStart is None:
+            self.tRecordedStart = tRecorded
+            self.tStart = tNow
+
+        return self.tStart + (tRecorded - self.tRecordedStart) / self.speed
+
+
+class replayedDataSet(object):
+    # Where the keys of a data set go in the system state
+
+    def __init__(self, logFileName, setName, group):
+
+        from writeLog import compileKeyPath
+
+        self.name = setName
+
+        if "logKeys" in group.attrs:
+            self.logKeys = json.loads(group.attrs["logKeys"])
+            self.timeStampKey = group.attrs.get("timeStampKey", "") or None
+        else:
+            logName = os.path.splitext(os.path.basename(logFileName))[0]
+            self.logKeys = dict((k, logName + "/" + k) for k in group.keys())
+            self.timeStampKey = None
+
+        self.keyPaths = dict((k, compileKeyPath(self.logKeys[k])) for k in self.logKeys)
+
+
+def iterateLogLines(logFileName, chunkSize=4096):
+
+    # Yields (recorded time, {key: value}, replayedDataSet) for every line of a data log, oldest first. Lines without
+    # a time stamp are defaultIntervalInS apart
+    import writeLog
+
+    tRecorded = 0.0
+
+    with writeLog.dataLogReader(logFileName, chunkSize) as reader:
+
+        for setName in reader.setNames():
+
+            dataSet = replayedDataSet(logFileName, setName, reader.logFile[setName])
+            keys = list(dataSet.logKeys) + ([dataSet.timeStampKey] if dataSet.timeStampKey else [])
+
+            for _, chunk in reader.iterateChunks(keys, [setName]):
+
+                values = dict((k, chunk[k].tolist()) for k in dataSet.logKeys if k in chunk)
+                times = chunk[dataSet.timeStampKey].tolist() if dataSet.timeStampKey in chunk else None
+
+                for i in range(len(chunk.values()[0])):
+
+                    tRecorded = times[i] if times is not None else tRecorded + defaultIntervalInS
+                    yield tRecorded, dict((k, v[i]) for k, v in values.items()), dataSet
+
+
+def recordedFrames(runDir):
+
+    # Returns [(recorded time, frame number)] of a web cam run, from the loose frames or frames.zip. The times come
+    # from webcam_log.h5 if the run has it, frames without a time are defaultIntervalInS after the one before
+    import outputArchiver
+
+    frameNumbers = set()
+    framesDir = os.path.join(runDir, "frames")
+
+    if os.path.isdir(framesDir):
+        for name in os.listdir(framesDir):
+            m = outputArchiver.frameRegex.match(name)
+            if m:
+                frameNumbers.add(int(m.group(1)))
+
+    if os.path.exists(os.path.join(runDir, outputArchiver.frameArchiveName)):
+        frameNumbers.update(outputArchiver.readFrameIndex(os.path.join(runDir, outputArchiver.frameArchiveName)))
+
+    frameTimes = dict()
+    logFileName = os.path.join(runDir, "webcam_log.h5")
+
+    if os.path.exists(logFileName):
+        for tRecorded, values, dataSet in iterateLogLines(logFileName):
+            if "frame" in values and not numpy.isnan(values["frame"]):
+                frameTimes[int(values["frame"])] = tRecorded
+
+    frames = []
+    tRecorded = -defaultIntervalInS
+
+    for frameNumber in sorted(frameNumbers):
+        tRecorded = frameTimes.get(frameNumber, tRecorded + defaultIntervalInS)
+        frames.append((tRecorded, frameNumber))
+
+    return frames
+
+
+class frameSource(object):
+    # Reads the frames of a web cam run as the arrays the web cam command puts in the system state
+
+    def __init__(self, runDir):
+
+        import outputArchiver
+
+        self.framesDir = os.path.join(runDir, "frames")
+        self.archiveFileName = os.path.join(runDir, outputArchiver.frameArchiveName)
+        self.index = None
+        self.preview = None
+
+        if os.path.exists(self.archiveFileName):
+            self.index = outputArchiver.readFrameIndex(self.archiveFileName)
+
+    def read(self, frameNumber):
+
+        import Image
+        import StringIO
+        import outputArchiver
+        import cameraFrames
+
+        fileName = os.path.join(self.framesDir, "frame-%i.jpeg" % frameNumber)
+
+        if os.path.exists(fileName):
+            image = Image.open(fileName)
+        else:
+            image = Image.open(StringIO.StringIO(outputArchiver.readFrame(self.archiveFileName, frameNumber,
+                                                                          self.index)))
+
+        # The frames were saved from the width x height x 3 arrays of the web cam, see startProcess_webcam
+        imageData = numpy.asarray(image)
+
+        if self.preview is None or self.preview.preview.shape != imageData.shape[1::-1]:
+            self.preview = cameraFrames.grayPreview(imageData.shape[:2])
+
+        return self.preview.update(imageData)
+
+
+def checkReplaySource(path, outputDirectory=None, frames=False):
+
+    # Returns "OK" or what is wrong with the log file or run directory to replay
+    if not os.path.exists(path):
+        return "Error: %s does not exist" % path
+
+    if frames:
+
+        if not os.path.isdir(path) or not recordedFrames(path):
+            return "Error: no web cam frames in %s" % path
+
+        return "OK"
+
+    if outputDirectory is not None and \
+            os.path.realpath(os.path.dirname(path)) == os.path.realpath(outputDirectory):
+        return "Error: %s would be replayed into itself" % path
+
+    try:
+        import writeLog
+        with writeLog.dataLogReader(path) as reader:
+            if not reader.setNames():
+                return "Error: %s has no data sets" % path
+    except (IOError, ValueError), e:
+        return "Error: could not read %s: %s" % (path, e)
+
+    return "OK"
@@ -0,0 +1,252 @@
+import os
+import cgi
+import json
+import time
+import inspect
+import hashlib
+import tempfile
+import multiprocessing
+
+import logChannel
+from writeLog import runningStatistics, iterateLogChunks
+
+# The final report of a recipe is put together from sections. Every command in the sequence can contribute a
+# section through its reportGenerator(report) method, which returns a dict {"title", "html", "summary"} or None.
+# The sections are generated in a pool of processes.
+#
+# A command which also implements reportInputs(), returning the files and directories (relative to the output
+# directory) its section is made from, gets its section cached in <outputDir>/.reportCache. The cache key is made
+# from the class and arguments of the command, the source code of the class and the size and modification time of
+# the inputs, so regenerating a report only does the work for sections of which something changed.
+reportCacheDirName = ".reportCache"
+pipelineVersion = 1
+
+# The pool processes are forked after this is set, so the commands do not need to be pickled to reach them
+currentSequence = None
+
+
+class reportContext(object):
+    # Handed to the reportGenerator of the commands
+
+    def __init__(self, outputDir, recipeInfo, chunkSize=65536):
+
+        self.outputDir = outputDir
+        self.recipeInfo = recipeInfo
+        self.chunkSize = chunkSize
+
+    def path(self, relativePath):
+        return os.path.join(self.outputDir, relativePath)
+
+    def iterateLogData(self, logFileName, keys=None):
+        return iterateLogChunks(self.path(logFileName), keys, self.chunkSize)
+
+    def logStatistics(self, logFileName, keys=None):
+
+        statistics = dict()
+
+        for setName, chunk in self.iterateLogData(logFileName, keys):
+            for key, values in chunk.items():
+                statistics.setdefault(key, runningStatistics()).update(values)
+
+        return dict((key, s.toDict()) for key, s in statistics.items())
+
+    def table(self, header, rows):
+
+        html = "<table>\n<tr>%s</tr>\n" % "".join("<th>%s</th>" % cgi.escape(str(h)) for h in header)
+
+        for row in rows:
+            html += "<tr>%s</tr>\n" % "".join("<td>%s</td>" % cgi.escape(formatValue(v)) for v in row)
+
+        return html + "</table>\n"
+
+
+def formatValue(value):
+
+    if isinstance(value, float):
+        return "%.6g" % value
+
+    return str(value)
+
+
+def fingerprint(path):
+
+    # Cheap stand in for the content of a file or directory
+    if not os.path.exists(path):
+        return None
+
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime]
+
+    numberOfFiles = 0
+    totalSize = 0
+    lastModified = os.stat(path).st_mtime
+
+    for name in os.listdir(path):
+        stat = os.stat(os.path.join(path, name))
+        numberOfFiles += 1
+        totalSize += stat.st_size
+        lastModified = max(lastModified, stat.st_mtime)
+
+    return [numberOfFiles, totalSize, lastModified]
+
+
+def hasReportSection(command):
+
+    # Only commands which implement reportGenerator themselves contribute to the report
+    from commandDefinitions import MeasurixCommand
+
+    if not isinstance(command, MeasurixCommand):
+        return False
+
+    return command.__class__.reportGenerator.im_func is not MeasurixCommand.reportGenerator.im_func
+
+
+def sectionCacheKey(command, outputDir):
+
+    reportInputs = getattr(command, "reportInputs", None)
+
+    if reportInputs is None:
+        return None
+
+    try:
+        classSource = inspect.getsource(command.__class__)
+    except (IOError, TypeError):
+        return None  # we can't tell if the code changed
+
+    inputs = [(name, fingerprint(os.path.join(outputDir, name))) for name in reportInputs()]
+    keyData = [pipelineVersion, command.__class__.__name__, repr(getattr(command, "args", None)),
+               hashlib.sha256(classSource).hexdigest(), inputs]
+
+    return hashlib.sha256(json.dumps(keyData)).hexdigest()
+
+
+def _generateSection(arguments):
+
+    # Runs in a pool process
+    index, outputDir, recipeInfo = arguments
+    command = currentSequence[index]
+
+    t0 = time.time()
+
+    try:
+        section = command.reportGenerator(reportContext(outputDir, recipeInfo))
+    except Exception, e:
+        name = getattr(command, "name", command.__class__.__name__)
+        section = {"title": name, "html": "<p class=\"error\">%s</p>" % cgi.escape("could not generate: %s" % e),
+                   "summary": {"error": str(e)}, "failed": True}
+
+    if section is not None:
+        section["timeInS"] = time.time() - t0
+
+    return index, section
+
+
+def _readCache(cacheDir, key):
+
+    try:
+        with open(os.path.join(cacheDir, key + ".json"), "r") as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return None
+
+
+def _writeCache(cacheDir, key, section):
+
+    if not os.path.exists(cacheDir):
+        os.makedirs(cacheDir)
+
+    fd, temporaryFileName = tempfile.mkstemp(dir=cacheDir, prefix=".section")
+
+    with os.fdopen(fd, "w") as fh:
+        json.dump(section, fh, default=str)
+
+    os.rename(temporaryFileName, os.path.join(cacheDir, key + ".json"))
+
+
+def generateSections(outputDir, sequence, recipeInfo, numberOfProcesses=None, useCache=True):
+
+    global currentSequence
+
+    cacheDir = os.path.join(outputDir, reportCacheDirName)
+    sections = dict()
+    keys = dict()
+
+    indexes = [index for index, command in enumerate(sequence) if hasReportSection(command)]
+
+    for index in indexes:
+
+        command = sequence[index]
+        keys[index] = sectionCacheKey(command, outputDir) if useCache else None
+        cached = _readCache(cacheDir, keys[index]) if keys[index] else None
+
+        if cached is not None:
+            cached["cached"] = True
+            sections[index] = cached
+
+    toGenerate = [(index, outputDir, recipeInfo) for index in indexes if index not in sections]
+
+    if toGenerate:
+
+        currentSequence = sequence
+        pool = multiprocessing.Pool(min(numberOfProcesses or multiprocessing.cpu_count(), len(toGenerate)))
+
+        try:
+            for index, section in pool.imap_unordered(_generateSection, toGenerate):
+
+                if section is None:
+                    continue
+
+                if keys[index] and not section.get("failed", False):
+                    _writeCache(cacheDir, keys[index], section)
+
+                section["cached"] = False
+                sections[index] = section
+        finally:
+            pool.close()
+            pool.join()
+            currentSequence = None
+
+    return [sections[index] for index in sorted(sections.keys())]
+
+
+def renderReport(sections, recipeInfo, softwareVersion):
+
+    title = os.path.basename(recipeInfo.get("recipeFileName", "recipe"))
+
+    html = "<!DOCTYPE html>\n<html>\n<head>\n<title>Report %s</title>\n</head>\n<body>\n" % cgi.escape(title)
+    html += "<h1>%s</h1>\n" % cgi.escape(title)
+    html += "<p>Software version %s, report generated %s</p>\n" % (cgi.escape(str(softwareVersion)),
+                                                                   time.strftime("%Y%m%d-%H%M%S"))
+
+    html += reportContext(None, recipeInfo).table(["", ""], sorted(recipeInfo.items()))
+
+    for section in sections:
+        html += "<h2>%s</h2>\n%s\n" % (cgi.escape(section["title"]), section["html"])
+
+    return html + "</body>\n</html>\n"
+
+
+def generateReport(outputDir, sequence, recipeInfo, softwareVersion, numberOfProcesses=None, useCache=True):
+
+    # Writes report.html and report.json to the output directory and returns the name of the HTML report
+    t0 = time.time()
+    sections = generateSections(outputDir, sequence, recipeInfo, numberOfProcesses, useCache)
+
+    reportFileName = os.path.join(outputDir, "report.html")
+
+    with open(reportFileName, "w") as fh:
+        fh.write(renderReport(sections, recipeInfo, softwareVersion))
+
+    summary = {"softwareVersion": softwareVersion, "time": time.time(), "timeInS": time.time() - t0,
+               "recipeInfo": recipeInfo,
+               "sections": [dict((k, section.get(k, None)) for k in ["title", "summary", "cached", "timeInS"])
+                            for section in sections]}
+
+    with open(os.path.join(outputDir, "report.json"), "w") as fh:
+        json.dump(summary, fh, indent=1, default=str)
+
+    logChannel.info("report with %i sections (%i from the cache) generated in %.1f s", len(sections),
+                    len([s for s in sections if s["cached"]]), time.time() - t0)
+
+    return reportFileName
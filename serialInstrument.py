@@ -0,0 +1,339 @@
+import os
+import glob
+import time
+import threading
+import collections
+
+import serial
+
+# Base class for instruments on a serial port that answer requests with lines of text. A subclass declares its
+# protocol: the terminator of the frames it sends, its commands (the bytes of the request, the number of frames in
+# the response and how to parse a frame) and how to recognise it on a port, e.g.
+#
+#   class thermometer(serialInstrument):
+#       commands = {"name": serialCommand(b"*IDN?\n", 1, parseText),
+#                   "temperature": serialCommand(b"T?\n", 1, float)}
+#       identifyCommand = "name"
+#       identifyResponse = "TH-10"
+#
+# and then asks for data with self.request("temperature"). A reader thread reads whatever arrives into a ring buffer,
+# cuts it into frames and parses them, so the acquisition loop only waits for the parsed response of its request.
+# Responses are matched to requests in order. After a request timed out, the next request throws away whatever is
+# still in the input, so a late answer is not taken for the answer to the next request.
+#
+# The device pool opens and health checks the instruments in the program process and the command processes inherit
+# them when they are forked. Threads do not survive a fork, so the reader is started by the first request in every
+# process, and stopped again when the instrument is handed over (after opening it and after a health check).
+
+
+class instrumentError(IOError):
+    pass
+
+
+class requestTimeout(instrumentError):
+    pass
+
+
+def parseText(frame):
+    return frame.decode("ascii", "replace").strip()
+
+
+class serialCommand(object):
+    def __init__(self, request, numberOfFrames=1, parser=None):
+
+        self.request = request  # bytes written to the port, may be a format string for the arguments of request()
+        self.numberOfFrames = numberOfFrames  # frames in the response
+        self.parser = parser  # parser(frame) returns the value of a frame, the raw bytes are returned without it
+
+
+class byteRingBuffer(object):
+    # Fixed size buffer of the bytes which were read but are not a complete frame yet. When more arrives than
+    # fits, the oldest bytes are dropped
+
+    def __init__(self, size=65536):
+
+        self.data = bytearray(size)
+        self.start = 0
+        self.length = 0
+        self.bytesDropped = 0
+
+    def __len__(self):
+        return self.length
+
+    def clear(self):
+
+        self.start = 0
+        self.length = 0
+
+    def write(self, data):
+
+        size = len(self.data)
+
+        if len(data) >= size:
+            self.bytesDropped += self.length + len(data) - size
+            self.data[:] = data[-size:]
+            self.start = 0
+            self.length = size
+            return
+
+        overflow = self.length + len(data) - size
+
+        if overflow > 0:
+            self.bytesDropped += overflow
+            self.start = (self.start + overflow) % size
+            self.length -= overflow
+
+        end = (self.start + self.length) % size
+        first = min(len(data), size - end)
+
+        self.data[end:end + first] = data[:first]
+        self.data[:len(data) - first] = data[first:]
+        self.length += len(data)
+
+    def _contents(self):
+
+        end = self.start + self.length
+
+        if end <= len(self.data):
+            return self.data[self.start:end]
+
+        return self.data[self.start:] + self.data[:end - len(self.data)]
+
+    def readFrames(self, terminator):
+
+        # Removes and returns the complete frames, without their terminator
+        contents = self._contents()
+        end = contents.rfind(terminator)
+
+        if end < 0:
+            return []
+
+        consumed = end + len(terminator)
+        self.start = (self.start + consumed) % len(self.data)
+        self.length -= consumed
+
+        return [bytes(frame) for frame in contents[:end].split(terminator)]
+
+
+class _pendingRequest(object):
+    def __init__(self, command, deadline):
+
+        self.command = command
+        self.deadline = deadline
+        self.frames = []
+        self.done = False
+        self.timedOut = False
+        self.error = None
+
+
+class serialInstrument(object):
+
+    # The protocol, declared by the subclasses
+    terminator = b"\r\n"
+    commands = dict()  # name -> serialCommand
+    identifyCommand = None  # name of the command that identifies the instrument
+    identifyResponse = None  # text in the response to identifyCommand
+    portPattern = "/dev/ttyACM*"  # ports tried if no device is given
+    identifyAttempts = 10  # when looking for the instrument; the port may take a while to come up after opening
+
+    readTimeoutInS = 0.1  # how long the reader waits for data, also the resolution of the request timeouts
+
+    def __init__(self, deviceString="", baud=9600, timeoutInS=1.0, bufferSize=65536):
+
+        self.baud = baud
+        self.timeoutInS = timeoutInS
+        self.bufferSize = bufferSize
+
+        self.readerThread = None
+        self.readerPid = None
+        self.readerRunning = False
+        self.readerError = None
+        self.numberOfTimeouts = 0
+        self.framesDropped = 0  # frames nobody asked for, e.g. the late answer to a request that timed out
+
+        self.initError = False
+
+        if deviceString == "":
+            self.device = self._findDevice()
+        else:
+            try:
+                self.device = self._open(deviceString)
+            except serial.SerialException:
+                self.device = None
+
+        if self.device is None:
+            self.initError = True
+
+    def _open(self, port):
+        return serial.Serial(port, self.baud, timeout=self.readTimeoutInS)
+
+    def _findDevice(self):
+
+        for port in sorted(glob.glob(self.portPattern)):
+
+            try:
+                self.device = self._open(port)
+            except serial.SerialException:
+                continue
+
+            try:
+                found = self.identify(self.identifyAttempts)
+            except (instrumentError, serial.SerialException, OSError):
+                found = False
+            finally:
+                self.stopReader()
+
+            if found:
+                return self.device
+
+            self.device.close()
+
+        return None
+
+    def _startReader(self):
+
+        self.condition = threading.Condition()
+        self.ringBuffer = byteRingBuffer(self.bufferSize)
+        self.pendingRequests = collections.deque()
+        self.readerError = None
+        self.resynchronise = False
+
+        self.device.reset_input_buffer()
+
+        self.readerRunning = True
+        self.readerPid = os.getpid()
+        self.readerThread = threading.Thread(target=self._readLoop, name="reader %s" % self.device.port)
+        self.readerThread.daemon = True
+        self.readerThread.start()
+
+    def stopReader(self):
+
+        if self.readerThread is None or self.readerPid != os.getpid():
+            return
+
+        self.readerRunning = False
+        self.readerThread.join()
+        self.readerThread = None
+
+    def _readLoop(self):
+
+        while self.readerRunning:
+
+            try:
+                data = self.device.read(max(1, self.device.in_waiting))
+            except (serial.SerialException, OSError), e:
+                with self.condition:
+                    self.readerError = e
+                    self.condition.notify_all()
+                return
+
+            with self.condition:
+
+                if data:
+                    self.ringBuffer.write(data)
+
+                    for frame in self.ringBuffer.readFrames(self.terminator):
+                        self._deliver(frame)
+
+                self._expireRequests()
+
+    def _deliver(self, frame):
+
+        # Called by the reader with the condition held
+        if not self.pendingRequests:
+            self.framesDropped += 1
+            return
+
+        pending = self.pendingRequests[0]
+
+        try:
+            pending.frames.append(pending.command.parser(frame) if pending.command.parser else frame)
+        except ValueError, e:
+            pending.error = "could not parse %r: %s" % (frame, e)
+
+        if pending.error is not None or len(pending.frames) == pending.command.numberOfFrames:
+            self.pendingRequests.popleft()
+            pending.done = True
+            self.condition.notify_all()
+
+    def _expireRequests(self):
+
+        # The requests wait on the condition without a timeout, which is much cheaper in Python 2, the reader
+        # wakes them up when their time is up
+        tNow = time.time()
+
+        while self.pendingRequests and self.pendingRequests[0].deadline < tNow:
+            pending = self.pendingRequests.popleft()
+            pending.timedOut = True
+            pending.done = True
+            self.condition.notify_all()
+
+    def request(self, name, arguments=(), timeoutInS=None):
+
+        # Sends a command and returns the parsed frames of the response. Raises requestTimeout if the response is
+        # not complete within timeoutInS, and instrumentError if the port failed or the response can't be parsed
+        command = self.commands[name]
+
+        if self.readerPid != os.getpid() or self.readerThread is None or not self.readerThread.is_alive():
+            self._startReader()
+
+        timeoutInS = self.timeoutInS if timeoutInS is None else timeoutInS
+        pending = _pendingRequest(command, time.time() + timeoutInS)
+
+        with self.condition:
+
+            if self.resynchronise:
+                self.device.reset_input_buffer()
+                self.ringBuffer.clear()
+                self.resynchronise = False
+
+            self.pendingRequests.append(pending)
+            self.device.write(command.request % arguments if arguments else command.request)
+
+            while not pending.done and self.readerError is None:
+                self.condition.wait()
+
+        if self.readerError is not None:
+            raise instrumentError("reading %s failed: %s" % (self.device.port, self.readerError))
+
+        if pending.timedOut:
+            self.numberOfTimeouts += 1
+            self.resynchronise = True
+            raise requestTimeout("no response to %s from %s within %.1f s" % (name, self.device.port, timeoutInS))
+
+        if pending.error is not None:
+            self.resynchronise = True
+            raise instrumentError("bad response to %s from %s: %s" % (name, self.device.port, pending.error))
+
+        return pending.frames
+
+    def identify(self, attempts=1):
+
+        if self.identifyCommand is None:
+            return True
+
+        for _ in range(attempts):
+
+            try:
+                response = self.request(self.identifyCommand)
+            except requestTimeout:
+                continue
+
+            return self.identifyResponse in response[0]
+
+        return False
+
+    def isAlive(self):
+
+        # Health check of the device pool, which runs in the program process
+        try:
+            return self.identify()
+        except (instrumentError, serial.SerialException, OSError):
+            return False
+        finally:
+            self.stopReader()
+
+    def close(self):
+
+        self.stopReader()
+        self.device.close()
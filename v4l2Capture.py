@@ -0,0 +1,261 @@
+import os
+import mmap
+import fcntl
+import ctypes
+import select
+import numpy
+
+# Reads a V4L2 camera (/dev/video*) without pygame: the driver fills a few buffers which are memory mapped into
+# the process, a frame is a numpy view of the buffer it is in and is only valid until the next frame is read. The
+# camera is asked for YUYV (4:2:2, two bytes per pixel), which every UVC web cam supports; yuyvConverter turns a
+# frame into RGB into arrays that are allocated once.
+
+V4L2_BUF_TYPE_VIDEO_CAPTURE = 1
+V4L2_MEMORY_MMAP = 1
+V4L2_FIELD_ANY = 0
+V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+V4L2_CAP_STREAMING = 0x04000000
+
+
+def fourcc(code):
+    return ord(code[0]) | (ord(code[1]) << 8) | (ord(code[2]) << 16) | (ord(code[3]) << 24)
+
+
+V4L2_PIX_FMT_YUYV = fourcc("YUYV")
+
+
+class v4l2_capability(ctypes.Structure):
+    _fields_ = [("driver", ctypes.c_char * 16), ("card", ctypes.c_char * 32), ("bus_info", ctypes.c_char * 32),
+                ("version", ctypes.c_uint32), ("capabilities", ctypes.c_uint32), ("device_caps", ctypes.c_uint32),
+                ("reserved", ctypes.c_uint32 * 3)]
+
+
+class v4l2_pix_format(ctypes.Structure):
+    _fields_ = [("width", ctypes.c_uint32), ("height", ctypes.c_uint32), ("pixelformat", ctypes.c_uint32),
+                ("field", ctypes.c_uint32), ("bytesperline", ctypes.c_uint32), ("sizeimage", ctypes.c_uint32),
+                ("colorspace", ctypes.c_uint32), ("priv", ctypes.c_uint32), ("flags", ctypes.c_uint32),
+                ("ycbcr_enc", ctypes.c_uint32), ("quantization", ctypes.c_uint32), ("xfer_func", ctypes.c_uint32)]
+
+
+class v4l2_format_union(ctypes.Union):
+    # The kernel union holds structures with pointers, which sets its alignment
+    _fields_ = [("pix", v4l2_pix_format), ("raw_data", ctypes.c_uint8 * 200), ("align", ctypes.c_void_p)]
+
+
+class v4l2_format(ctypes.Structure):
+    _fields_ = [("type", ctypes.c_uint32), ("fmt", v4l2_format_union)]
+
+
+class v4l2_requestbuffers(ctypes.Structure):
+    _fields_ = [("count", ctypes.c_uint32), ("type", ctypes.c_uint32), ("memory", ctypes.c_uint32),
+                ("reserved", ctypes.c_uint32 * 2)]
+
+
+class timeval(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_usec", ctypes.c_long)]
+
+
+class v4l2_timecode(ctypes.Structure):
+    _fields_ = [("type", ctypes.c_uint32), ("flags", ctypes.c_uint32), ("frames", ctypes.c_uint8),
+                ("seconds", ctypes.c_uint8), ("minutes", ctypes.c_uint8), ("hours", ctypes.c_uint8),
+                ("userbits", ctypes.c_uint8 * 4)]
+
+
+class v4l2_buffer_m(ctypes.Union):
+    _fields_ = [("offset", ctypes.c_uint32), ("userptr", ctypes.c_ulong), ("planes", ctypes.c_void_p),
+                ("fd", ctypes.c_int32)]
+
+
+class v4l2_buffer(ctypes.Structure):
+    _fields_ = [("index", ctypes.c_uint32), ("type", ctypes.c_uint32), ("bytesused", ctypes.c_uint32),
+                ("flags", ctypes.c_uint32), ("field", ctypes.c_uint32), ("timestamp", timeval),
+                ("timecode", v4l2_timecode), ("sequence", ctypes.c_uint32), ("memory", ctypes.c_uint32),
+                ("m", v4l2_buffer_m), ("length", ctypes.c_uint32), ("reserved2", ctypes.c_uint32),
+                ("request_fd", ctypes.c_int32)]
+
+
+def _IOC(direction, number, size):
+    return (direction << 30) | (size << 16) | (ord("V") << 8) | number
+
+
+def _IOR(number, structure):
+    return _IOC(2, number, ctypes.sizeof(structure))
+
+
+def _IOW(number, structure):
+    return _IOC(1, number, ctypes.sizeof(structure))
+
+
+def _IOWR(number, structure):
+    return _IOC(3, number, ctypes.sizeof(structure))
+
+
+VIDIOC_QUERYCAP = _IOR(0, v4l2_capability)
+VIDIOC_S_FMT = _IOWR(5, v4l2_format)
+VIDIOC_REQBUFS = _IOWR(8, v4l2_requestbuffers)
+VIDIOC_QUERYBUF = _IOWR(9, v4l2_buffer)
+VIDIOC_QBUF = _IOWR(15, v4l2_buffer)
+VIDIOC_DQBUF = _IOWR(17, v4l2_buffer)
+VIDIOC_STREAMON = _IOW(18, ctypes.c_int)
+VIDIOC_STREAMOFF = _IOW(19, ctypes.c_int)
+
+
+class v4l2Capture(object):
+    def __init__(self, device, resolution, numberOfBuffers=4):
+
+        self.device = device
+        self.fd = os.open(device, os.O_RDWR | os.O_NONBLOCK)
+        self.buffers = []
+        self.streaming = False
+        self.queuedIndex = None  # buffer of the frame handed out last, given back to the driver on the next read
+
+        try:
+            self._setUp(resolution, numberOfBuffers)
+        except (IOError, OSError):
+            self.close()
+            raise
+
+    def _setUp(self, resolution, numberOfBuffers):
+
+        capability = v4l2_capability()
+        fcntl.ioctl(self.fd, VIDIOC_QUERYCAP, capability)
+
+        if not capability.capabilities & V4L2_CAP_VIDEO_CAPTURE or \
+                not capability.capabilities & V4L2_CAP_STREAMING:
+            raise IOError("%s (%s) can not stream video" % (self.device, capability.card))
+
+        # The driver picks the nearest resolution it has
+        videoFormat = v4l2_format()
+        videoFormat.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        videoFormat.fmt.pix.width, videoFormat.fmt.pix.height = resolution
+        videoFormat.fmt.pix.pixelformat = V4L2_PIX_FMT_YUYV
+        videoFormat.fmt.pix.field = V4L2_FIELD_ANY
+        fcntl.ioctl(self.fd, VIDIOC_S_FMT, videoFormat)
+
+        if videoFormat.fmt.pix.pixelformat != V4L2_PIX_FMT_YUYV:
+            raise IOError("%s does not deliver YUYV frames" % self.device)
+
+        self.resolution = (videoFormat.fmt.pix.width, videoFormat.fmt.pix.height)
+        self.bytesPerLine = videoFormat.fmt.pix.bytesperline
+
+        request = v4l2_requestbuffers()
+        request.count = numberOfBuffers
+        request.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        request.memory = V4L2_MEMORY_MMAP
+        fcntl.ioctl(self.fd, VIDIOC_REQBUFS, request)
+
+        width, height = self.resolution
+
+        for index in range(request.count):
+
+            buf = self._buffer(index)
+            fcntl.ioctl(self.fd, VIDIOC_QUERYBUF, buf)
+
+            mapped = mmap.mmap(self.fd, buf.length, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE,
+                               offset=buf.m.offset)
+
+            # height x width x 2, skipping the padding at the end of the lines if there is any
+            frame = numpy.ndarray((height, width * 2), dtype=numpy.uint8, buffer=mapped,
+                                  strides=(self.bytesPerLine, 1))
+
+            self.buffers.append((mapped, frame))
+            fcntl.ioctl(self.fd, VIDIOC_QBUF, buf)
+
+        # One v4l2_buffer to dequeue into, so reading a frame does not make new objects
+        self.dequeued = self._buffer(0)
+
+    def _buffer(self, index):
+
+        buf = v4l2_buffer()
+        buf.index = index
+        buf.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        buf.memory = V4L2_MEMORY_MMAP
+
+        return buf
+
+    def start(self):
+
+        fcntl.ioctl(self.fd, VIDIOC_STREAMON, ctypes.c_int(V4L2_BUF_TYPE_VIDEO_CAPTURE))
+        self.streaming = True
+
+    def stop(self):
+
+        if self.streaming:
+            fcntl.ioctl(self.fd, VIDIOC_STREAMOFF, ctypes.c_int(V4L2_BUF_TYPE_VIDEO_CAPTURE))
+            self.streaming = False
+
+    def read(self, timeoutInS=1.0):
+
+        # Returns the next frame (height x 2 * width bytes of YUYV), valid until the next call, or None if no frame
+        # came within timeoutInS
+        if self.queuedIndex is not None:
+            self.dequeued.index = self.queuedIndex
+            fcntl.ioctl(self.fd, VIDIOC_QBUF, self.dequeued)
+            self.queuedIndex = None
+
+        readable, _, _ = select.select([self.fd], [], [], timeoutInS)
+
+        if not readable:
+            return None
+
+        fcntl.ioctl(self.fd, VIDIOC_DQBUF, self.dequeued)
+        self.queuedIndex = self.dequeued.index
+
+        return self.buffers[self.queuedIndex][1]
+
+    def close(self):
+
+        if self.fd is None:
+            return
+
+        self.stop()
+
+        for mapped, frame in self.buffers:  # the frames handed out are not valid any more
+            mapped.close()
+
+        self.buffers = []
+        os.close(self.fd)
+        self.fd = None
+
+
+class yuyvConverter(object):
+    # YUYV to RGB (ITU-R 601) with vectorised numpy into arrays allocated once. Two neighbouring pixels share
+    # their U and V
+
+    def __init__(self, width, height):
+
+        self.chroma = numpy.empty((height, width // 2), dtype=numpy.float32)
+        self.luma = numpy.empty((height, width // 2, 2), dtype=numpy.float32)
+        self.channel = numpy.empty((height, width // 2, 2), dtype=numpy.float32)
+        self.redOffset = numpy.empty((height, width // 2), dtype=numpy.float32)
+        self.greenOffset = numpy.empty((height, width // 2), dtype=numpy.float32)
+        self.blueOffset = numpy.empty((height, width // 2), dtype=numpy.float32)
+
+    def toRGB(self, frame, rgb):
+
+        # frame: height x 2 * width YUYV bytes, rgb: height x width x 3 uint8 (may be a view)
+        height, width = rgb.shape[:2]
+
+        # Setting the shape, unlike reshape, fails instead of copying when the arrays can't be viewed that way
+        pixelPairs = frame.view()
+        pixelPairs.shape = (height, width // 2, 4)  # Y0 U Y1 V
+        rgbPairs = rgb.view()
+        rgbPairs.shape = (height, width // 2, 2, 3)
+
+        numpy.copyto(self.luma, pixelPairs[..., 0::2])
+
+        numpy.subtract(pixelPairs[..., 1], 128, out=self.chroma, dtype=numpy.float32)  # U
+        numpy.multiply(self.chroma, 1.772, out=self.blueOffset)
+        numpy.multiply(self.chroma, -0.344136, out=self.greenOffset)
+
+        numpy.subtract(pixelPairs[..., 3], 128, out=self.chroma, dtype=numpy.float32)  # V
+        numpy.multiply(self.chroma, 1.402, out=self.redOffset)
+        numpy.multiply(self.chroma, -0.714136, out=self.chroma)
+        numpy.add(self.greenOffset, self.chroma, out=self.greenOffset)
+
+        for c, offset in enumerate([self.redOffset, self.greenOffset, self.blueOffset]):
+            numpy.add(self.luma, offset[..., None], out=self.channel)
+            numpy.clip(self.channel, 0, 255, out=self.channel)
+            numpy.copyto(rgbPairs[..., c], self.channel, casting="unsafe")
+
+        return rgb
@@ -1,13 +1,23 @@
 import time
 import os
+import json
+import mmap
+import struct
 import h5py
 import numpy
 import copy
 import os
+import eventLog
+import logChannel
+import metrics
 
-errorLevels = ["info", "warning", "error"]
+errorLevels = ["debug", "info", "warning", "error"]
 
 errStyleSheet = """
+debug {
+    color: gray;
+}
+
 error {
     font-weight:bold;
     color: red;
@@ -35,65 +45,563 @@ htmlHeader = """
 """
 
 
-def logPrintMessages(messageText, logFile):
-    path = os.path.dirname(logFile)
+class htmlLogWriter(object):
+    def __init__(self, logFile, maxBufferedLines=100, flushIntervalInS=1.0, maxFileSizeInMB=10.0, rotateDaily=True):
+
+        self.logFile = logFile
+
+        # Lines are kept in a buffer and written in one go when the buffer holds maxBufferedLines lines or when
+        # the oldest line in the buffer is older than flushIntervalInS seconds
+        self.maxBufferedLines = maxBufferedLines
+        self.flushIntervalInS = flushIntervalInS
+
+        # When the log file grows beyond maxFileSizeInMB or when the date changes (if rotateDaily), the current
+        # log file is renamed to <name>-<time stamp>.html and a fresh log file is started
+        self.maxFileSizeInBytes = int(maxFileSizeInMB * 1024 ** 2)
+        self.rotateDaily = rotateDaily
+
+        self.buffer = []
+        self.timeOfOldestLine = None
+
+        self.fh = None
+        self.fileSize = 0
+        self.fileDate = None
+
+    def _open(self):
+
+        path = os.path.dirname(self.logFile)
+
+        if path != "" and not os.path.exists(path):
+            os.makedirs(path)
+
+        errStyleSheetFileName = os.path.join(path, "error.css")
+
+        if not os.path.exists(errStyleSheetFileName):
+            with open(errStyleSheetFileName, "w") as fh:
+                fh.write(errStyleSheet)
+
+        newFile = not os.path.exists(self.logFile)
+
+        self.fh = open(self.logFile, "a")
+
+        if newFile:
+            self.fh.write(htmlHeader)
+
+        self.fileSize = self.fh.tell()
+        self.fileDate = time.strftime("%Y%m%d", time.localtime(os.path.getmtime(self.logFile)))
+
+    def _rotateIfNeeded(self):
+
+        dateNow = time.strftime("%Y%m%d")
+
+        if self.fileSize < self.maxFileSizeInBytes and (not self.rotateDaily or dateNow == self.fileDate):
+            return
+
+        self.fh.close()
+        self.fh = None
+
+        baseName, extension = os.path.splitext(self.logFile)
+        rotatedFileName = "{baseName}-{timeStamp}{extension}".format(baseName=baseName,
+                                                                    timeStamp=time.strftime("%Y%m%d-%H%M%S"),
+                                                                    extension=extension)
+        os.rename(self.logFile, rotatedFileName)
+
+        self._open()
+
+    def _formatLine(self, messageText, timeStamp):
+
+        for errorLevel in errorLevels:
+            messageText = messageText.replace(errorLevel, "<{errorLevel}>{errorLevel}</{errorLevel}>".format(
+                errorLevel=errorLevel))
+
+        return "{timeStamp}: {messageText}<br> \n".format(timeStamp=timeStamp, messageText=messageText)
+
+    def write(self, messages):
+
+        timeStamp = time.strftime("%Y%m%d-%H%M%S")
+
+        if not self.buffer:
+            self.timeOfOldestLine = time.time()
+
+        self.buffer.extend(self._formatLine(messageText, timeStamp) for messageText in messages)
+
+        if len(self.buffer) >= self.maxBufferedLines:
+            self.flush()
+        else:
+            self.flushIfDue()
+
+    def flushIfDue(self):
+
+        if self.buffer and time.time() - self.timeOfOldestLine >= self.flushIntervalInS:
+            self.flush()
+
+    def flush(self):
+
+        if not self.buffer:
+            return
+
+        if self.fh is None:
+            self._open()
+        else:
+            self._rotateIfNeeded()
+
+        toWrite = "".join(self.buffer)
+        self.buffer = []
+
+        self.fh.write(toWrite)
+        self.fh.flush()
+        self.fileSize += len(toWrite)
+
+    def close(self):
+
+        self.flush()
+
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+
+# The log writers are kept open for the lifetime of the process writing the log file
+logWriters = dict()
+
+
+def openLogFile(logFile, **kwargs):
 
-    if not os.path.exists(path):
-        os.mkdir(path)
+    if logFile not in logWriters:
+        logWriters[logFile] = htmlLogWriter(logFile, **kwargs)
 
-    errStyleSheetFileName = os.path.join(path, "error.css")
+    return logWriters[logFile]
 
-    if not os.path.exists(errStyleSheetFileName):
-        fh = open(errStyleSheetFileName, "w")
-        fh.write(errStyleSheet)
-        fh.close()
 
-    if not os.path.exists(logFile):
-        fh = open(logFile, "w")
-        fh.write(htmlHeader)
-    else:
-        fh = open(logFile, "a")
+def closeLogFiles():
 
-    timeStamp = time.strftime("%Y%m%d-%H%M%S")
+    for logFile in logWriters.keys():
+        logWriters.pop(logFile).close()
 
-    for errorLevel in errorLevels:
-        messageText = messageText.replace(errorLevel, "<{errorLevel}>{errorLevel}</{errorLevel}>".format(
-            errorLevel=errorLevel))
+    eventLog.closeEventLogs()
 
-    toWrite = "{timeStamp}: {messageText}<br> \n".format(timeStamp=timeStamp, messageText=messageText)
 
-    fh.write(toWrite)
-    fh.close()
+def logPrintMessages(messages, logFile, eventLogDir=None):
+
+    # messages can either be a single line or a list of lines we want to write in one go. Each line is either
+    # a string or a structured record as made by eventLog.makeRecord
+    if isinstance(messages, basestring) or isinstance(messages, dict):
+        messages = [messages]
+
+    records = [m if isinstance(m, dict) else eventLog.makeRecord(m) for m in messages]
+
+    openLogFile(logFile).write(["%s: %s" % (r["level"], r["message"]) for r in records])
+
+    # Next to the HTML log file, we keep a structured event log which can be queried with eventLog.py
+    if eventLogDir is None:
+        eventLogDir = os.path.join(os.path.dirname(logFile), "events")
+
+    eventLog.logEvents(records, eventLogDir)
 
     return
 
 
+def compileKeyPath(key):
+    # "arduino/measurement/pot_meter/currentValue" -> ("arduino", "measurement", "pot_meter", "currentValue")
+    return tuple(key.split("/"))
+
+
+def lookUpKeyPath(state, keyPath):
+
+    # Returns None if a key is missing. The look up stops at the first value which is not a dict
+    value = state
+
+    for k in keyPath:
+
+        if type(value) != dict:
+            break
+
+        if k not in value:
+            return None
+
+        value = value[k]
+
+    return value
+
+
+class flushPolicy(object):
+    # Decides when a dataLogger writes its buffer to the file and when it starts a new data set.
+    #
+    # The buffer is written when its oldest line is maxDataLossInS old, which is the most data that can be lost when
+    # the program dies, or when it holds targetWriteSizeInKB, so fast loggers write in blocks of a useful size and
+    # slow loggers do not write every few lines. The rate of lines seen between writes is used to size the buffer
+    # of the logger for the next write. A new data set is started when the current one is newDataSetAfterS old or
+    # newDataSetAfterMB large; 0 switches either off
+
+    def __init__(self, maxDataLossInS=5.0, targetWriteSizeInKB=64.0, newDataSetAfterS=3600.0, newDataSetAfterMB=100.0):
+
+        self.maxDataLossInS = maxDataLossInS
+        self.targetWriteSizeInBytes = int(targetWriteSizeInKB * 1024)
+        self.newDataSetAfterS = newDataSetAfterS
+        self.newDataSetAfterBytes = int(newDataSetAfterMB * 1024 ** 2)
+
+        self.linesPerS = None  # averaged over the writes
+
+    def writeIsDue(self, bytesInBuffer, ageOfOldestLineInS):
+        return bytesInBuffer >= self.targetWriteSizeInBytes or ageOfOldestLineInS >= self.maxDataLossInS
+
+    def observeWrite(self, numberOfLines, timeSinceLastWriteInS):
+
+        if numberOfLines <= 0 or timeSinceLastWriteInS <= 0:
+            return
+
+        linesPerS = numberOfLines / timeSinceLastWriteInS
+
+        if self.linesPerS is None:
+            self.linesPerS = linesPerS
+        else:
+            self.linesPerS = 0.7 * self.linesPerS + 0.3 * linesPerS
+
+    def expectedLinesPerWrite(self, bytesPerLine):
+
+        maximumLines = max(1, self.targetWriteSizeInBytes // max(1, bytesPerLine))
+
+        if self.linesPerS is None:
+            return min(maximumLines, 16)
+
+        return int(max(1, min(maximumLines, self.linesPerS * self.maxDataLossInS + 1)))
+
+    def newDataSetIsDue(self, dataSetAgeInS, dataSetSizeInBytes):
+
+        if self.newDataSetAfterS and dataSetAgeInS >= self.newDataSetAfterS:
+            return True
+
+        return bool(self.newDataSetAfterBytes and dataSetSizeInBytes >= self.newDataSetAfterBytes)
+
+
+flushPolicySettings = ["maxDataLossInS", "targetWriteSizeInKB", "newDataSetAfterS", "newDataSetAfterMB"]
+dataLoggerSettingNames = flushPolicySettings + ["journal"]
+
+
+def dataLoggerSettings(systemState, loggerName):
+
+    # The [dataLogger] section of the INI file holds the settings of all loggers, a [dataLogger.<name>] section
+    # those of one logger, e.g. [dataLogger.arduino_log] for arduino_log.h5
+    settings = dict()
+
+    if systemState is not None:
+        for sectionName in ["dataLogger", "dataLogger." + loggerName]:
+            settings.update(systemState.get(sectionName, None) or {})
+
+    for name in settings.keys():
+        if name not in dataLoggerSettingNames:
+            logChannel.warning("unknown data logger setting %s, expected one of %s", name,
+                               ", ".join(dataLoggerSettingNames))
+            del settings[name]
+
+    return settings
+
+
+def flushPolicyFromSettings(systemState, loggerName):
+
+    settings = dataLoggerSettings(systemState, loggerName)
+
+    return flushPolicy(**dict((name, float(settings[name])) for name in flushPolicySettings if name in settings))
+
+
+class dataJournal(object):
+    # Append only journal of the lines of a dataLogger, kept next to the log file as <log file>.journal. Lines go
+    # into the journal before they are buffered for the HDF5 file. The journal is a memory mapped file, so what is
+    # in it survives the logging process being killed. Once lines are in the HDF5 file they are marked committed
+    # and their space is used again. replayJournal puts the lines that never made it into the HDF5 file there.
+    #
+    # Lines are numbered from the start of the journal. The file holds a header, the names of the columns as JSON
+    # and from dataOffset on the lines from number "first" up to "appended", as float64
+    idLength = 32  # bytes, the journal id is also kept in the data sets of the log file
+    header = struct.Struct("<8sII%isqqq" % idLength)  # magic, version, columns, journal id, first, appended, committed
+    magic = "MXJRNL01"
+    version = 1
+    dataOffset = 4096
+
+    def __init__(self, fileName, columns=None, initialNumberOfLines=4096):
+
+        # Makes a new journal if columns are given, otherwise opens an existing one
+        self.fileName = fileName
+
+        if columns is not None:
+
+            self.columns = list(columns)
+            self.journalId = "%x-%x" % (os.getpid(), int(time.time() * 1e6))
+            self.first = self.appended = self.committed = 0
+
+            names = json.dumps(self.columns)
+
+            if self.header.size + 4 + len(names) > self.dataOffset:
+                raise ValueError("too many or too long column names for a journal")
+
+            with open(fileName, "wb") as fh:
+                fh.truncate(self.dataOffset + initialNumberOfLines * len(self.columns) * 8)
+
+            self.fh = open(fileName, "r+b")
+            self.mm = mmap.mmap(self.fh.fileno(), 0)
+            struct.pack_into("<I", self.mm, self.header.size, len(names))
+            self.mm[self.header.size + 4:self.header.size + 4 + len(names)] = names
+            self._writeHeader()
+
+        else:
+
+            self.fh = open(fileName, "r+b")
+            self.mm = mmap.mmap(self.fh.fileno(), 0)
+
+            magic, version, numberOfColumns, journalId, self.first, self.appended, self.committed = \
+                self.header.unpack_from(self.mm, 0)
+
+            if magic != self.magic or version != self.version:
+                self.close()
+                raise ValueError("%s is not a data journal" % fileName)
+
+            namesLength = struct.unpack_from("<I", self.mm, self.header.size)[0]
+            self.columns = json.loads(self.mm[self.header.size + 4:self.header.size + 4 + namesLength])
+            self.journalId = journalId.rstrip("\0")
+
+        self.bytesPerLine = len(self.columns) * 8
+
+    def _writeHeader(self):
+        self.header.pack_into(self.mm, 0, self.magic, self.version, len(self.columns), self.journalId, self.first,
+                              self.appended, self.committed)
+
+    def _capacity(self):
+        return (len(self.mm) - self.dataOffset) // self.bytesPerLine
+
+    def append(self, lines):
+
+        # lines is an array of numberOfLines x number of columns
+        lines = numpy.ascontiguousarray(lines, dtype=numpy.float64)
+        numberOfLines = lines.shape[0]
+        start = self.appended - self.first
+
+        capacity = self._capacity()
+
+        if start + numberOfLines > capacity:
+            self.mm.close()
+            self.fh.truncate(self.dataOffset + max(start + numberOfLines, 2 * capacity) * self.bytesPerLine)
+            self.mm = mmap.mmap(self.fh.fileno(), 0)
+
+        offset = self.dataOffset + start * self.bytesPerLine
+        self.mm[offset:offset + numberOfLines * self.bytesPerLine] = lines.tostring()
+
+        # The lines are in place before the header says so
+        self.appended += numberOfLines
+        self._writeHeader()
+
+    def commit(self, upTo):
+
+        # Lines before number upTo are in the HDF5 file. When all lines are, the journal starts from the beginning
+        self.committed = upTo
+
+        if self.committed == self.appended:
+            self.first = self.appended
+
+        self._writeHeader()
+
+    def linesFrom(self, lineNumber):
+
+        # The lines from lineNumber on, as far as they are still in the journal
+        start = max(lineNumber, self.first) - self.first
+        stop = self.appended - self.first
+
+        if stop <= start:
+            return numpy.zeros((0, len(self.columns)))
+
+        data = self.mm[self.dataOffset + start * self.bytesPerLine:self.dataOffset + stop * self.bytesPerLine]
+
+        return numpy.frombuffer(data, dtype=numpy.float64).reshape(-1, len(self.columns))
+
+    def close(self, remove=False):
+
+        self.mm.close()
+        self.fh.close()
+
+        if remove:
+            os.remove(self.fileName)
+
+
+def journalFileName(logFileName):
+    return logFileName + ".journal"
+
+
+def replayJournal(logFileName):
+
+    # Puts the lines of a journal left behind by a logger that did not close (e.g. because its process was killed)
+    # into the log file and removes the journal. Returns the number of lines replayed
+    fileName = journalFileName(logFileName)
+
+    if not os.path.exists(fileName):
+        return 0
+
+    try:
+        journal = dataJournal(fileName)
+    except (IOError, ValueError, struct.error, mmap.error), e:
+        logChannel.error("could not read the journal %s: %s", fileName, e)
+        return 0
+
+    # Lines can be in the log file already when the process was killed right after writing them
+    committed = journal.committed
+
+    if os.path.exists(logFileName):
+        try:
+            committed = _linesCommitted(logFileName, journal)
+        except (IOError, RuntimeError, KeyError), e:
+            committed = _recoverLogFile(logFileName, journal, e)
+
+    lines = journal.linesFrom(committed)
+
+    if len(lines):
+        logger = dataLogger(logFileName, None, dict((k, k) for k in journal.columns), journal=False,
+                            flushPolicy=flushPolicy(newDataSetAfterS=0, newDataSetAfterMB=0))
+        logger.logBlock(dict((k, lines[:, i]) for i, k in enumerate(journal.columns)))
+        logger.close()
+
+        logChannel.warning("%i lines which were not in %s yet were replayed from its journal", len(lines),
+                           logFileName)
+
+    journal.close(remove=True)
+
+    return len(lines)
+
+
+def _linesCommitted(logFileName, journal, swmr=False):
+
+    committed = journal.committed
+
+    with h5py.File(logFileName, "r", swmr=swmr) as logFile:
+        for setName in logDataSetNames(logFile):
+            attrs = logFile[setName].attrs
+            if attrs.get("journalId", None) == journal.journalId:
+                committed = max(committed, int(attrs["journalSequence"]))
+
+    return committed
+
+
+def _recoverLogFile(logFileName, journal, error):
+
+    # The log file can't be opened. A logger killed in SWMR mode leaves its file marked as being written, which only
+    # SWMR readers open; the data sets are then copied into a new file. Otherwise the process was killed while
+    # writing and the lines in the journal go to a new file. The original file is kept. Returns the number of the
+    # first line of the journal which is not in the new file
+    damagedFileName = "%s.damaged-%s" % (logFileName, time.strftime("%Y%m%d-%H%M%S"))
+    os.rename(logFileName, damagedFileName)
+
+    try:
+        committed = _linesCommitted(damagedFileName, journal, swmr=True)
+
+        with h5py.File(damagedFileName, "r", swmr=True) as damagedFile:
+            with h5py.File(logFileName, "w", libver="latest") as logFile:
+
+                for name in damagedFile:
+                    damagedFile.copy(damagedFile[name], logFile, name=name)
+
+                for k, v in damagedFile.attrs.items():
+                    logFile.attrs[k] = v
+
+    except (IOError, RuntimeError, KeyError, ValueError), e:
+        logChannel.error("log file %s is damaged (%s), moved to %s", logFileName, e, damagedFileName)
+
+        if os.path.exists(logFileName):
+            os.remove(logFileName)
+
+        return journal.committed
+
+    logChannel.warning("log file %s could not be opened (%s), its data was copied to a new file and the original "
+                       "moved to %s", logFileName, error, damagedFileName)
+
+    return committed
+
+
+def replayJournals(directory):
+
+    # Replays the journals of the log files in directory
+    numberOfLines = 0
+
+    if not os.path.isdir(directory):
+        return numberOfLines
+
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".journal"):
+            numberOfLines += replayJournal(os.path.join(directory, name[:-len(".journal")]))
+
+    return numberOfLines
+
+
 class dataLogger(object):
-    def __init__(self, logFileName, systemState, logKeys, maxLogLinesPerSet=10000):
+
+    # Opening the file for writing, see _openForWriting
+    openAttempts = 8
+    openRetryIntervalInS = 0.01
+    maxOpenRetryIntervalInS = 0.5
+
+    def __init__(self, logFileName, systemState, logKeys, maxLogLinesPerSet=None, swmr=False, timeStampKey=None,
+                 flushPolicy=None, journal=None):
 
         self.systemState = systemState
         self.logKeys = logKeys
 
-        # Each data set in our HDF5 file will have a time stamp. We want each data set to contain at most
-        # maxLogLinesPerSet lines
+        # e.g. "DAQINPUT.Pressure/currentValue" is looked up as systemState["DAQINPUT.Pressure"]["currentValue"]. The
+        # key paths are split once here instead of for every line
+        self.keyPaths = dict((k, compileKeyPath(logKeys[k])) for k in logKeys)
+
+        # Each data set in our HDF5 file will have a time stamp. When the buffer is written and when a new data set is
+        # started is up to the flush policy, which is configured in the INI file if not given. With maxLogLinesPerSet
+        # a data set holds at most that many lines as well
+        loggerName = os.path.splitext(os.path.basename(logFileName))[0]
+        settings = dataLoggerSettings(systemState, loggerName)
+
+        self.flushPolicy = flushPolicy if flushPolicy is not None else flushPolicyFromSettings(systemState, loggerName)
         self.maxLogLinesPerSet = maxLogLinesPerSet
 
-        # We will not continuously write data to the HDF5 file, but write to a buffer first instead
+        # If timeStampKey is given, the time (time.time() or the time stamps given to logBlock) of every line is
+        # logged in a data set of that name
+        self.timeStampKey = timeStampKey
+        self.dataSetKeys = list(self.logKeys) + ([timeStampKey] if timeStampKey else [])
+        self.bytesPerLine = len(self.dataSetKeys) * numpy.dtype(numpy.float64).itemsize
+
+        # We will not continuously write data to the HDF5 file, but write to a buffer first instead. The buffer holds
+        # a numpy array per key which is written to the file as it is. It grows when a block of lines does not fit
         self.dataBuffer = dict()
-        # initialise the buffer
-        for k in self.logKeys:
-            self.dataBuffer[k] = []
+        self.linesInBuffer = 0
+        self.timeOfOldestLine = None
+        self._allocateBuffer(self.flushPolicy.expectedLinesPerWrite(self.bytesPerLine))
 
-        self.maxLogLinesInBuffer = 5
-        self.linesWritten = 0  # Every time when linesWritten % maxLogLinesInBuffer == 0, the buffer is reset
-        # And every time linesWritten == maxLogLinesPerSet, a new set is made with the current time stamp.
-        # self.linesWritten is then reset to zero
+        self.linesWritten = 0  # lines logged since the current data set was started
 
         self.logFileName = logFileName
 
         self.logFile = None
         self.logData = None
 
+        # The data set we are writing to and when it was started. Looking for the most recent data set means going
+        # through all data sets, so this is only done for the first write
+        self.dataSetName = None
+        self.timeDataSetStarted = None
+
+        # With a journal (the journal setting in the INI file if not given), lines that are logged survive the
+        # process being killed before they are written to the HDF5 file, see dataJournal
+        if journal is None:
+            journal = bool(settings.get("journal", 0))
+
+        self.journal = None
+
+        if journal:
+            replayJournal(logFileName)  # left behind by an earlier logger that did not close
+            self.journal = dataJournal(journalFileName(logFileName), self.dataSetKeys)
+
+        # In SWMR (single writer, multiple reader) mode the log file is kept open while logging and flushed after
+        # every write, so it can be read during the run, e.g. with python -m measurix tail. No new data sets can be
+        # made while other processes may be reading the file, so in this mode a run is logged to one data set, whatever
+        # the flush policy says
+        self.swmr = swmr
+        self.timeOfLastWrite = time.time()
+
+        metricsPrefix = loggerName
+        self.flushLatencyMetric = metrics.histogram(metricsPrefix + ".flushLatencyInS")
+        self.bytesWrittenMetric = metrics.counter(metricsPrefix + ".bytesWritten")
+        self.stateReadLatencyMetric = metrics.histogram(metricsPrefix + ".stateReadLatencyInS")
+
     def _findMostRecentLogData(self):
 
         mostRecentDateStamp = 0
@@ -114,94 +622,296 @@ class dataLogger(object):
 
         if mostRecentDateString == "":
             return self._makeNewDataSet()
-        else:
-            return self.logFile[mostRecentDateString]
+
+        logData = self.logFile[mostRecentDateString]
+
+        # e.g. a set made by a logger with other keys
+        if any(k not in logData for k in self.dataSetKeys):
+            return self._makeNewDataSet()
+
+        self._makeJournalAttributes(logData)
+
+        self.dataSetName = mostRecentDateString
+        self.timeDataSetStarted = mostRecentDateStamp
+
+        return logData
+
+    def _currentLogData(self):
+
+        if self.dataSetName is not None and self.dataSetName in self.logFile:
+            return self.logFile[self.dataSetName]
+
+        return self._findMostRecentLogData()
 
     def _makeNewDataSet(self):
 
         dateStringNow = time.strftime("%Y%m%d-%H%M%S")
 
-        for k in self.logKeys:
+        for k in self.dataSetKeys:
             logDataPath = "{}/{}".format(dateStringNow, k)
             self.logFile.create_dataset(logDataPath, (0, 1), maxshape=(None, 1), dtype=numpy.float64)
 
+        # Where the values came from in the system state, so a log can be replayed into it (see replay.py)
+        self.logFile[dateStringNow].attrs["logKeys"] = json.dumps(self.logKeys)
+        self.logFile[dateStringNow].attrs["timeStampKey"] = self.timeStampKey or ""
+        self._makeJournalAttributes(self.logFile[dateStringNow])
+
+        self.dataSetName = dateStringNow
+        self.timeDataSetStarted = time.mktime(time.strptime(dateStringNow, "%Y%m%d-%H%M%S"))
+
         return self.logFile[dateStringNow]
 
+    def _makeJournalAttributes(self, logData):
+
+        # The last line of the journal that is in a data set. A SWMR writer can't make attributes, so they are made
+        # with a fixed size when the set is opened, before SWMR mode is switched on, and only overwritten after that
+        if self.journal is None or "journalSequence" in logData.attrs:
+            return
+
+        logData.attrs.create("journalId", "", dtype="S%i" % dataJournal.idLength)
+        logData.attrs.create("journalSequence", 0, dtype=numpy.int64)
+
+    def _newDataSetIsDue(self):
+
+        # Data sets are named after the second they were started in, so at most one is started per second
+        if self.dataSetName == time.strftime("%Y%m%d-%H%M%S"):
+            return False
+
+        if self.maxLogLinesPerSet is not None and self.linesWritten >= self.maxLogLinesPerSet:
+            return True
+
+        dataSetSizeInBytes = self.logData[self.dataSetKeys[0]].shape[0] * self.bytesPerLine
+
+        return self.flushPolicy.newDataSetIsDue(time.time() - self.timeDataSetStarted, dataSetSizeInBytes)
+
+    def _openSWMR(self):
+
+        self.logFile = self._openForWriting(libver="latest")
+        self.logData = self._currentLogData()
+
+        try:
+            self.logFile.swmr_mode = True
+        except ValueError, e:  # e.g. the file was made without SWMR support
+            logChannel.warning("not logging to %s in SWMR mode: %s", self.logFileName, e)
+            self.logFile.close()
+            self.logFile = None
+            self.logData = None
+            self.swmr = False
+
+    def _openForWriting(self, **kwargs):
+
+        # HDF5 locks the file while a reader has it open, e.g. python -m measurix tail following a file that is not
+        # written in SWMR mode, which opens it for every poll. The open is tried again with a growing delay; the lines
+        # stay in the buffer until they are written
+        retryIntervalInS = self.openRetryIntervalInS
+
+        for attempt in range(self.openAttempts):
+
+            try:
+                return h5py.File(self.logFileName, "a", **kwargs)
+            except IOError:
+                if attempt == self.openAttempts - 1:
+                    raise
+
+            time.sleep(retryIntervalInS)
+            retryIntervalInS = min(2 * retryIntervalInS, self.maxOpenRetryIntervalInS)
+
     def _writeBufferToFile(self):
 
-        self.logFile = h5py.File(self.logFileName, "a")
-        self.logData = self._findMostRecentLogData()
+        tFlush = time.time()
+        bytesWritten = 0
 
-        if self.linesWritten >= self.maxLogLinesPerSet:
-            self.logData = self._makeNewDataSet()
-            self.linesWritten = 0
+        if self.swmr and self.logFile is None:
+            self._openSWMR()
 
-        for k in self.logKeys:
+        if not self.swmr:
+
+            self.logFile = self._openForWriting()
+            self.logData = self._currentLogData()
+
+            if self._newDataSetIsDue():
+                self.logData = self._makeNewDataSet()
+                self.linesWritten = self.linesInBuffer
+
+        numberOfLines = self.linesInBuffer
+
+        for k in self.dataSetKeys:
             m = self.logData[k].shape[0]
-            self.logData[k].resize(m + len(self.dataBuffer[k]), axis=0)
-            self.logData[k][m:, 0] = numpy.array(self.dataBuffer[k])
-            self.dataBuffer[k] = []
+            self.logData[k].resize(m + numberOfLines, axis=0)
+            self.logData[k][m:, 0] = self.dataBuffer[k][:numberOfLines]
+            bytesWritten += numberOfLines * self.logData[k].dtype.itemsize
 
-        self.logFile.close()
-        self.logFile = None
-        self.logData = None
+        if self.journal is not None:
+            # Written together with the lines, so a replay can tell which lines made it into the file
+            self.logData.attrs.modify("journalId", self.journal.journalId)
+            self.logData.attrs.modify("journalSequence", self.journal.appended)
+
+        self.linesInBuffer = 0
+
+        # Size the buffer for the lines expected until the next write, if it is far off
+        self.flushPolicy.observeWrite(numberOfLines, time.time() - self.timeOfLastWrite)
+        expectedLines = self.flushPolicy.expectedLinesPerWrite(self.bytesPerLine)
+        capacity = len(self.dataBuffer[self.dataSetKeys[0]])
+
+        if expectedLines > capacity or expectedLines < capacity // 4:
+            self._allocateBuffer(expectedLines)
+
+        if self.swmr:
+            self.logFile.flush()  # makes the new lines visible to the readers
+        else:
+            self.logFile.close()
+            self.logFile = None
+            self.logData = None
+
+        if self.journal is not None:
+            self.journal.commit(self.journal.appended)
+
+        self.timeOfLastWrite = time.time()
+        self.flushLatencyMetric.observe(time.time() - tFlush)
+        self.bytesWrittenMetric.inc(bytesWritten)
+
+    def _allocateBuffer(self, numberOfLines):
+
+        # Keeps the lines in the buffer
+        for k in self.dataSetKeys:
+
+            buffer = numpy.empty(numberOfLines, dtype=numpy.float64)
+
+            if k in self.dataBuffer:
+                buffer[:self.linesInBuffer] = self.dataBuffer[k][:self.linesInBuffer]
+
+            self.dataBuffer[k] = buffer
+
+    def _reserveLines(self, numberOfLines):
+
+        # Returns the slice of the buffer for the next numberOfLines lines
+        capacity = len(self.dataBuffer[self.dataSetKeys[0]]) if self.dataSetKeys else 0
+
+        if self.linesInBuffer + numberOfLines > capacity:
+            self._allocateBuffer(max(self.linesInBuffer + numberOfLines, 2 * capacity))
 
-    def _getValueFromSystemStateGivenKey(self, key):
+        if not self.linesInBuffer:
+            self.timeOfOldestLine = time.time()
 
-        # e.g. key can be "DAQINPUT.Pressure/currentValue". Get the value systemState[DAQINPUT.Pressure][currentValue]
-        dictTmp = self.systemState
+        lines = slice(self.linesInBuffer, self.linesInBuffer + numberOfLines)
 
-        for k in key.split("/"):
+        self.linesInBuffer += numberOfLines
+        self.linesWritten += numberOfLines
 
-            if k not in dictTmp.keys():
-                return None
+        return lines
 
-            dictTmp = dictTmp[k]
+    def _readState(self, keys):
 
-            if type(dictTmp) != dict:
-                break
+        # The values of keys in the system state, read in one go
+        tRead = time.time()
 
-        return dictTmp
+        state = self._snapshot(sorted(set(self.keyPaths[k][0] for k in keys))) if keys else None
+        values = dict((k, lookUpKeyPath(state, self.keyPaths[k])) for k in keys)
 
-    def doLog(self, additionalKeys=None):
+        self.stateReadLatencyMetric.observe(time.time() - tRead)
 
+        return values
+
+    def _snapshot(self, topLevelKeys):
+
+        # A manager dict is a proxy of which every access is a round trip to the manager process, so the state is
+        # read in one go: one get for a single key, a copy for more. A plain dict is used as it is
+        if isinstance(self.systemState, dict):
+            return self.systemState
+
+        if len(topLevelKeys) == 1:
+            return {topLevelKeys[0]: self.systemState.get(topLevelKeys[0], None)}
+
+        return self.systemState.copy()
+
+    def doLog(self, additionalKeys=None, timeStamp=None):
+
+        # timeStamp is kept if the logger has a timeStampKey, time.time() is used if it is not given
         if not additionalKeys:
             additionalKeys = dict()
 
-        if self.linesWritten % self.maxLogLinesInBuffer == 0 and self.linesWritten:
-            self._writeBufferToFile()  # will also reset the buffer
+        values = self._readState([k for k in self.logKeys if k not in additionalKeys])
+        values.update((k, additionalKeys[k]) for k in self.logKeys if k in additionalKeys)
+
+        line = self._reserveLines(1).start
 
         for k in self.logKeys:
+            self.dataBuffer[k][line] = numpy.nan if values[k] is None else values[k]
+
+        if self.timeStampKey:
+            self.dataBuffer[self.timeStampKey][line] = time.time() if timeStamp is None else timeStamp
+
+        self._journalLines(slice(line, line + 1))
+        self._writeBufferIfDue()
+
+    def _journalLines(self, lines):
+
+        if self.journal is not None:
+            self.journal.append(numpy.column_stack([self.dataBuffer[k][lines] for k in self.dataSetKeys]))
 
-            if k in additionalKeys:
-                value = additionalKeys[k]
+    def _writeBufferIfDue(self):
+
+        if self.flushPolicy.writeIsDue(self.linesInBuffer * self.bytesPerLine, time.time() - self.timeOfOldestLine):
+            self._writeBufferToFile()  # will also reset the buffer
+
+    def logBlock(self, values, timeStamps=None):
+
+        # Logs a block of lines in one go, e.g. the samples of a device which are read many at a time. values maps
+        # log keys to arrays of equal length. Keys which are not in values are read from the system state once and
+        # repeated for every line of the block. timeStamps are only kept if the logger has a timeStampKey; the
+        # time of the call is used for every line if they are not given
+        lengths = set(len(numpy.atleast_1d(v)) for v in values.values())
+
+        if timeStamps is not None:
+            lengths.add(len(timeStamps))
+
+        if len(lengths) != 1:
+            raise ValueError("the arrays of a block must be of equal length, got lengths %s" % sorted(lengths))
+
+        numberOfLines = lengths.pop()
+
+        if not numberOfLines:
+            return
+
+        stateValues = self._readState([k for k in self.logKeys if k not in values])
+        lines = self._reserveLines(numberOfLines)
+
+        for k in self.logKeys:
+            if k in values:
+                self.dataBuffer[k][lines] = values[k]
             else:
-                value = self._getValueFromSystemStateGivenKey(self.logKeys[k])
+                self.dataBuffer[k][lines] = numpy.nan if stateValues[k] is None else stateValues[k]
 
-            self.dataBuffer[k].append(value)
+        if self.timeStampKey:
+            self.dataBuffer[self.timeStampKey][lines] = time.time() if timeStamps is None else timeStamps
 
-        self.linesWritten += 1
+        self._journalLines(lines)
+        self._writeBufferIfDue()
 
     def getLogData(self):
 
-        self.logFile = h5py.File(self.logFileName, "a")
-        self.logData = self._findMostRecentLogData()
+        # Copy of the most recent data set. The file is opened read only, use dataLogReader to go through large logs
+        if self.logFile is not None:
+            return dict((k, numpy.array(self.logData[k])) for k in self.logData)
 
-        logDataCopy = dict()
+        if not os.path.exists(self.logFileName):
+            return dict((k, numpy.zeros((0, 1))) for k in self.logKeys)
 
-        for k in self.logData:
-            logDataCopy[k] = numpy.array(self.logData[k])
+        with dataLogReader(self.logFileName) as reader:
 
-        self.logFile.close()
-        self.logFile = None
-        self.logData = None
+            setNames = reader.setNames()
+
+            if not setNames:
+                return dict((k, numpy.zeros((0, 1))) for k in self.logKeys)
 
-        return logDataCopy
+            group = reader.logFile[setNames[-1]]
+
+            return dict((k, numpy.array(group[k])) for k in group)
 
     def setAttrs(self, key, value):
 
         if self.logFile == None:
-            self.logFile = h5py.File(self.logFileName, "a")
+            self.logFile = self._openForWriting()
             self.logFile.attrs[key] = value
             self.logFile.close()
             self.logFile = None
@@ -209,4 +919,314 @@ class dataLogger(object):
             self.logFile.attrs[key] = value
 
     def close(self):
+
         self._writeBufferToFile()
+
+        if self.logFile is not None:
+            self.logFile.close()
+            self.logFile = None
+            self.logData = None
+
+        if self.journal is not None:
+            self.journal.close(remove=True)
+            self.journal = None
+
+
+def logDataSetNames(logFile):
+
+    # The data sets of a log file are named after the time they were started, e.g. 20170102-134501
+    names = []
+
+    for name in logFile:
+        try:
+            time.strptime(name, "%Y%m%d-%H%M%S")
+        except ValueError:
+            continue
+        names.append(name)
+
+    return sorted(names)  # the time format sorts chronologically
+
+
+class runningStatistics(object):
+    # Count, mean, standard deviation, minimum and maximum of data that is seen one chunk at a time. NaNs are skipped
+
+    def __init__(self):
+
+        self.count = 0
+        self.mean = 0.0
+        self.M2 = 0.0  # sum of squared differences from the mean
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def update(self, values):
+
+        values = numpy.asarray(values, dtype=numpy.float64)
+        values = values[~numpy.isnan(values)]
+
+        if not values.size:
+            return
+
+        count = values.size
+        mean = values.mean()
+        M2 = ((values - mean) ** 2).sum()
+
+        # Combine the statistics of the chunk with what we had (Chan et al.)
+        total = self.count + count
+        delta = mean - self.mean
+
+        self.mean += delta * count / total
+        self.M2 += M2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+    def toDict(self):
+
+        if not self.count:
+            return {"count": 0}
+
+        return {"count": self.count, "mean": self.mean, "std": (self.M2 / self.count) ** 0.5, "min": self.min,
+                "max": self.max}
+
+
+class dataLogReader(object):
+    # Read only access to a log file written by dataLogger. The file is opened in SWMR (single writer, multiple
+    # reader) mode when the HDF5 library allows it, so it can be read while a recipe is logging to it. The data is
+    # read in chunks of chunkSize lines into buffers that are allocated once; the arrays handed out are views of
+    # these buffers and are overwritten by the next chunk, copy them to keep them.
+
+    def __init__(self, logFileName, chunkSize=65536):
+
+        self.logFileName = logFileName
+        self.chunkSize = chunkSize
+        self.buffers = dict()  # key, dtype, shape of a line -> buffer of chunkSize lines
+
+        try:
+            self.logFile = h5py.File(logFileName, "r", swmr=True)
+        except (IOError, ValueError, TypeError):  # TypeError: h5py without SWMR support
+            self.logFile = h5py.File(logFileName, "r")
+
+        self.swmr = getattr(self.logFile, "swmr_mode", False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+
+        if self.logFile is not None:
+            self.logFile.close()
+            self.logFile = None
+
+    def setNames(self):
+        # Oldest first
+        return logDataSetNames(self.logFile)
+
+    def keys(self):
+
+        keys = set()
+
+        for setName in self.setNames():
+            keys.update(self.logFile[setName].keys())
+
+        return sorted(keys)
+
+    def numberOfLines(self, key=None):
+
+        numberOfLines = 0
+
+        for setName in self.setNames():
+            group = self.logFile[setName]
+            setKeys = [key] if key is not None else group.keys()
+            numberOfLines += min([self._refreshed(group[k]).shape[0] for k in setKeys if k in group] or [0])
+
+        return numberOfLines
+
+    def _refreshed(self, dataSet):
+
+        # In SWMR mode the size of a data set is only updated when we ask for it
+        if self.swmr:
+            dataSet.refresh()
+
+        return dataSet
+
+    def _buffer(self, key, dataSet):
+
+        # Every key gets a buffer of its own, as all keys of a chunk are handed out together
+        bufferKey = (key, dataSet.dtype.str, dataSet.shape[1:])
+
+        if bufferKey not in self.buffers:
+            self.buffers[bufferKey] = numpy.empty((self.chunkSize,) + dataSet.shape[1:], dtype=dataSet.dtype)
+
+        return self.buffers[bufferKey]
+
+    def iterateChunks(self, keys=None, setNames=None):
+
+        # Yields (data set name, {key: array}) with at most chunkSize lines per array, oldest data first. Columns
+        # (n x 1 data sets, as written by dataLogger) are handed out as 1D arrays
+        for setName in (setNames if setNames is not None else self.setNames()):
+
+            group = self.logFile[setName]
+            dataSets = dict((k, self._refreshed(group[k])) for k in (keys if keys else group.keys()) if k in group)
+
+            if not dataSets:
+                continue
+
+            numberOfLines = min(dataSet.shape[0] for dataSet in dataSets.values())
+            buffers = dict((k, self._buffer(k, dataSet)) for k, dataSet in dataSets.items())
+
+            for start in range(0, numberOfLines, self.chunkSize):
+
+                stop = min(start + self.chunkSize, numberOfLines)
+                chunk = dict()
+
+                for k, dataSet in dataSets.items():
+
+                    dataSet.read_direct(buffers[k], numpy.s_[start:stop], numpy.s_[0:stop - start])
+                    view = buffers[k][:stop - start]
+
+                    if view.ndim == 2 and view.shape[1] == 1:
+                        view = view[:, 0]
+
+                    chunk[k] = view
+
+                yield setName, chunk
+
+    def statistics(self, keys=None):
+
+        # Running statistics per key over all data sets, without loading a full series
+        statistics = dict()
+
+        for setName, chunk in self.iterateChunks(keys):
+            for k, values in chunk.items():
+                statistics.setdefault(k, runningStatistics()).update(values)
+
+        return dict((k, s.toDict()) for k, s in statistics.items())
+
+
+def iterateLogChunks(logFileName, keys=None, chunkSize=65536):
+
+    # Yields (data set name, {key: array}) with at most chunkSize lines per array, oldest data first. The arrays
+    # are only valid until the next chunk is read, see dataLogReader
+    with dataLogReader(logFileName, chunkSize) as reader:
+        for item in reader.iterateChunks(keys):
+            yield item
+
+
+def isSWMRFile(logFile):
+    # Files written in SWMR mode have a superblock of version 3 or later
+    return logFile.id.get_create_plist().get_version()[0] >= 3
+
+
+class dataLogTail(object):
+    # Follows a log file while it is being written. poll() returns the lines added since the previous poll; the
+    # first poll returns what is in the file already if fromStart, otherwise only lines added after the first poll.
+    # Files written in SWMR mode are kept open between polls. Other files are opened for every poll only, as the
+    # logger can't open a file for writing while it is open elsewhere (it waits for it, see dataLogger._openForWriting)
+
+    def __init__(self, logFileName, keys=None, fromStart=False, reopenIntervalInS=1.0):
+
+        self.logFileName = logFileName
+        self.keys = keys
+        self.fromStart = fromStart
+        self.reopenIntervalInS = reopenIntervalInS
+
+        self.reader = None
+        self.timeOpened = None
+        self.linesRead = None  # data set name -> number of lines handed out
+
+    def _open(self):
+
+        if self.reader is None:
+            self.reader = dataLogReader(self.logFileName)
+            self.timeOpened = time.time()
+
+    def _reopen(self):
+        self.close()
+        self._open()
+
+    def close(self):
+
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def _newLines(self):
+
+        newLines = []
+
+        for setName in self.reader.setNames():
+
+            group = self.reader.logFile[setName]
+            dataSets = dict((k, self.reader._refreshed(group[k])) for k in (self.keys or group.keys()) if k in group)
+
+            if not dataSets:
+                continue
+
+            numberOfLines = min(dataSet.shape[0] for dataSet in dataSets.values())
+            start = self.linesRead.get(setName, 0)
+
+            if numberOfLines > start:
+                lines = dict((k, dataSet[start:numberOfLines, 0]) for k, dataSet in dataSets.items())
+                newLines.append((setName, lines))
+                self.linesRead[setName] = numberOfLines
+
+        return newLines
+
+    def poll(self):
+
+        # Returns a list of (data set name, {key: array}), oldest first
+        if not os.path.exists(self.logFileName):
+            return []
+
+        try:
+            self._open()
+        except IOError:  # e.g. the logger has the file open for writing right now
+            return []
+
+        try:
+            if self.linesRead is None:
+
+                self.linesRead = dict()
+
+                if not self.fromStart:
+                    self._newLines()
+                    return []
+
+            newLines = self._newLines()
+
+            # A file kept open only shows the data sets that existed when it was opened, e.g. not those of a next run
+            if not newLines and self.reader.swmr and time.time() - self.timeOpened >= self.reopenIntervalInS:
+                try:
+                    self._reopen()
+                except IOError:
+                    return []
+
+                newLines = self._newLines()
+
+            return newLines
+        finally:
+            if self.reader is not None and not isSWMRFile(self.reader.logFile):
+                self.close()
+
+    def follow(self, pollIntervalInS=0.2, timeoutInS=None):
+
+        # Yields (data set name, {key: array}) as lines are added. Stops when nothing was added for timeoutInS
+        tLastLine = time.time()
+
+        try:
+            while timeoutInS is None or time.time() - tLastLine < timeoutInS:
+
+                newLines = self.poll()
+
+                for item in newLines:
+                    yield item
+
+                if newLines:
+                    tLastLine = time.time()
+                else:
+                    time.sleep(pollIntervalInS)
+        finally:
+            self.close()